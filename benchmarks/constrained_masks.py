@@ -0,0 +1,138 @@
+"""
+Mede o custo das máscaras da decodificação restrita (GrammarMasker) no vocabulário real.
+
+Gera um JSON de exemplo para cada schema do main, tokeniza e, como na geração, pede a máscara
+de cada passo: a primeira passada mostra o custo de montar as máscaras (estados novos) e a
+segunda o custo com o cache quente. Use o resultado para decidir constrained_decoding.
+
+Uso:
+  uv run python benchmarks/constrained_masks.py                       # tokenizer do cpu_model_id
+  uv run python benchmarks/constrained_masks.py --tokenizer Qwen/Qwen2.5-VL-7B-Instruct
+  uv run python benchmarks/constrained_masks.py --synthetic           # sem transformers
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main
+from config import settings
+from inference.constrained import GrammarMasker, JsonSchemaGrammar, SchemaConstraint, TokenVocabulary
+
+SCHEMAS = {
+    "endereço": main._ADDRESS_SCHEMA,
+    "consumo": main._CONSUMPTION_SCHEMA,
+    "recortes": main._CROPS_SCHEMA,
+    "contrato": main._CONTRACT_SCHEMA,
+}
+
+
+def _real_vocabulary(model_id: str) -> tuple[list[tuple[int, str]], Any]:
+    from transformers import AutoTokenizer
+
+    tok = AutoTokenizer.from_pretrained(model_id)
+    # Mesmo filtro de vocabulary() nos backends
+    skip = set(tok.all_special_ids or [])
+    skip.update(getattr(tok, "added_tokens_decoder", None) or {})
+    ids = [i for i in range(len(tok)) if i not in skip]
+    return list(zip(ids, tok.batch_decode([[i] for i in ids]))), tok
+
+
+def _synthetic_vocabulary(size: int = 151_000) -> list[tuple[int, str]]:
+    """Vocabulário no estilo BPE (palavras com espaço à frente, pontuação JSON, dígitos)."""
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyzáéíóúãõçABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    punct = '{}[]":,.-_/\\()!?;\'*#@%&+=<>|`~^$ \n\t'
+    toks = {chr(c) for c in range(32, 0x250)} | {"\n", "\t", "\r"} | {str(i) for i in range(1000)}
+    toks.update(a + b for a in punct for b in punct)
+    while len(toks) < size:
+        word = "".join(rng.choice(letters) for _ in range(rng.randint(2, 12)))
+        r = rng.random()
+        if r < 0.5:
+            word = " " + word
+        elif r < 0.55:
+            word += '":'
+        elif r < 0.6:
+            word = '"' + word
+        elif r < 0.63:
+            word = "\n" + " " * rng.randint(0, 8) + word
+        toks.add(word)
+    return list(enumerate(sorted(toks)))
+
+
+def _example(schema: dict[str, Any]) -> Any:
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == "object":
+        return {k: _example(v) for k, v in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_example(schema.get("items", {}))] * min(3, schema.get("maxItems") or 3)
+    return {"string": "Rua das Flores, 123", "number": 1234.56, "integer": 180, "boolean": False}.get(kind)
+
+
+def _greedy_pieces(text: str, by_text: dict[str, int]) -> list[str]:
+    longest = max(map(len, by_text))
+    pieces, i = [], 0
+    while i < len(text):
+        for n in range(min(longest, len(text) - i), 0, -1):
+            if text[i:i + n] in by_text:
+                pieces.append(text[i:i + n])
+                i += n
+                break
+        else:
+            raise ValueError(f"caractere fora do vocabulário: {text[i]!r}")
+    return pieces
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", default=settings.cpu_model_id, help="tokenizer do Hugging Face")
+    parser.add_argument("--synthetic", action="store_true", help="vocabulário sintético (sem transformers)")
+    args = parser.parse_args()
+
+    tok = None
+    if args.synthetic:
+        vocab_list = _synthetic_vocabulary()
+    else:
+        vocab_list, tok = _real_vocabulary(args.tokenizer)
+    t0 = time.perf_counter()
+    vocab = TokenVocabulary(vocab_list)
+    print(f"vocabulário: {len(vocab)} tokens, indexado em {(time.perf_counter() - t0) * 1000:.0f}ms")
+    by_text = {text: tid for tid, text in vocab_list if text}
+
+    print(f"{'schema':<10} {'tokens':>7} {'estados':>8} {'frio':>9} {'pior':>8} {'quente':>8}")
+    for name, schema in SCHEMAS.items():
+        text = json.dumps(_example(schema), ensure_ascii=False, indent=2)
+        if tok is not None:
+            pieces = [tok.decode([i]) for i in tok.encode(text, add_special_tokens=False)]
+        else:
+            pieces = _greedy_pieces(text, by_text)
+        masker = GrammarMasker(JsonSchemaGrammar(schema), vocab, [-1])
+        timings = []
+        for _ in range(2):
+            cursor = SchemaConstraint(masker)
+            worst = 0.0
+            t0 = time.perf_counter()
+            for piece in pieces:
+                t1 = time.perf_counter()
+                cursor.allowed()
+                worst = max(worst, time.perf_counter() - t1)
+                cursor.advance(piece)
+            timings.append((time.perf_counter() - t0, worst))
+        (cold, worst), (warm, _) = timings
+        print(
+            f"{name:<10} {len(pieces):>7} {masker.computed:>8} {cold * 1000:>7.0f}ms "
+            f"{worst * 1000:>6.1f}ms {warm * 1000:>6.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,114 @@
+"""
+Compara o caminho antigo dos recortes (PNG temporário para o YOLO, recorte relido e regravado
+pelo cv2, recorte aberto de novo pelo PIL) com o recorte em memória da imagem já decodificada.
+O YOLO fica de fora: mede só o custo de disco + encode/decode que o pipeline deixou de pagar.
+
+Uso:
+  uv run python benchmarks/crop_io.py fatura.png --runs 10
+  uv run python benchmarks/crop_io.py --synthetic --runs 10   # imagem gerada na hora
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image, ImageDraw
+
+from config import settings
+
+try:
+    import cv2
+
+    _HAS_CV2 = True
+except ImportError:
+    cv2 = None
+    _HAS_CV2 = False
+
+# Caixas típicas (fração da página) dos recortes de cliente e de consumo
+BOXES = [(0.05, 0.10, 0.60, 0.30), (0.05, 0.55, 0.95, 0.80)]
+
+
+def _boxes(img: Image.Image) -> list[tuple[int, int, int, int]]:
+    w, h = img.size
+    return [(int(x1 * w), int(y1 * h), int(x2 * w), int(y2 * h)) for x1, y1, x2, y2 in BOXES]
+
+
+def _temp_path(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def _legacy(img: Image.Image) -> list[Image.Image]:
+    paths = [_temp_path(".png")]
+    img.save(paths[0], format="PNG")
+    crops = []
+    try:
+        for x1, y1, x2, y2 in _boxes(img):
+            # crop_image relia a imagem inteira para cada recorte e gravava o recorte em disco
+            path = _temp_path(".png")
+            paths.append(path)
+            if _HAS_CV2:
+                full = cv2.imread(paths[0], cv2.IMREAD_UNCHANGED)
+                cv2.imwrite(path, full[y1:y2, x1:x2])
+            else:
+                with Image.open(paths[0]) as full:
+                    full.crop((x1, y1, x2, y2)).save(path, format="PNG")
+            crops.append(Image.open(path).convert("RGB"))
+    finally:
+        for path in paths:
+            os.unlink(path)
+    return crops
+
+
+def _in_memory(img: Image.Image) -> list[Image.Image]:
+    return [img.crop(box) for box in _boxes(img)]
+
+
+MODES = {"legado (PNG + disco)": _legacy, "em memória": _in_memory}
+
+
+def _synthetic() -> Image.Image:
+    """Página de fatura com o tamanho que o pipeline usa (max_pixels, proporção A4)."""
+    h = int((settings.max_pixels * 842 / 595) ** 0.5)
+    w = settings.max_pixels // h
+    img = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(img)
+    for row in range(0, h, 24):
+        draw.text((20, row), f"{row:05d}  consumo {row * 7 % 900} kWh  R$ {row * 1.37:.2f}", fill="black")
+        draw.line((0, row + 20, w, row + 20), fill=(180, 180, 180))
+    return img
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+    if not args.image and not args.synthetic:
+        parser.error("informe a imagem ou --synthetic")
+
+    img = _synthetic() if args.synthetic else Image.open(args.image).convert("RGB")
+    print(f"imagem {img.width}x{img.height}, {len(BOXES)} recortes, cv2={'sim' if _HAS_CV2 else 'não (PIL)'}\n")
+    for mode, fn in MODES.items():
+        fn(img)  # aquecimento
+        times = []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            crops = fn(img)
+            times.append((time.perf_counter() - t0) * 1000)
+            for c in crops:
+                c.close()
+        print(f"{mode:22s} mediana {statistics.median(times):7.1f}ms  máx {max(times):7.1f}ms")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,112 @@
+"""
+Compara a latência dos recortes: duas gerações (cliente + consumo) vs. uma geração multi-imagem.
+
+Uso:
+  uv run python benchmarks/crops_combined.py cliente.png consumo.png --runs 5
+  uv run python benchmarks/crops_combined.py --fake --runs 5   # sem modelo (FakeBackend)
+
+Com o modelo real, o engine é o mesmo do main (config.py: inference_mode, batch_max_size etc.);
+o modo "paralelo" só sobrepõe as gerações com batch_max_size > 1 ou inference_mode="process".
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image
+
+import main
+from inference.backends import FakeBackend
+from inference.engine import InferenceEngine
+
+
+async def _separate_sequential(customer: Image.Image, consumption: Image.Image) -> tuple[dict, dict]:
+    return await main._infer_customer(customer), await main._infer_consumption(consumption)
+
+
+async def _separate_parallel(customer: Image.Image, consumption: Image.Image) -> tuple[dict, dict]:
+    c, k = await asyncio.gather(main._infer_customer(customer), main._infer_consumption(consumption))
+    return c, k
+
+
+async def _combined(customer: Image.Image, consumption: Image.Image) -> tuple[dict, dict]:
+    return await main._infer_crops_combined(customer, consumption)
+
+
+MODES = {
+    "separadas (sequencial)": _separate_sequential,
+    "separadas (paralelo)": _separate_parallel,
+    "combinada (multi-imagem)": _combined,
+}
+
+
+def _agreement(a: tuple[dict, dict], b: tuple[dict, dict]) -> str:
+    keys = list(main._ADDRESS_SCHEMA["properties"])
+    same = sum(1 for k in keys if a[0].get(k) == b[0].get(k))
+    same_consumo = a[1].get("consumo_lista") == b[1].get("consumo_lista")
+    return f"endereço {same}/{len(keys)} campos iguais, consumo_lista {'igual' if same_consumo else 'diferente'}"
+
+
+async def _run(customer: Image.Image, consumption: Image.Image, runs: int) -> None:
+    # Aquecimento: carrega prefixos no cache e compila as gramáticas antes de medir
+    for fn in MODES.values():
+        await fn(customer, consumption)
+
+    results: dict[str, tuple[dict, dict]] = {}
+    print(f"{'modo':<26} {'média':>9} {'p50':>9} {'mín':>9}")
+    for name, fn in MODES.items():
+        samples = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            results[name] = await fn(customer, consumption)
+            samples.append((time.perf_counter() - t0) * 1000)
+        print(
+            f"{name:<26} {statistics.mean(samples):>7.0f}ms {statistics.median(samples):>7.0f}ms "
+            f"{min(samples):>7.0f}ms"
+        )
+    print(f"combinada vs separadas: {_agreement(results['combinada (multi-imagem)'], results['separadas (paralelo)'])}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("customer_crop", nargs="?", help="recorte de dados do cliente/endereço")
+    parser.add_argument("consumption_crop", nargs="?", help="recorte do histórico de consumo")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--fake", action="store_true", help="usa FakeBackend em vez do modelo")
+    parser.add_argument("--fake-prefill-ms", type=float, default=400.0)
+    parser.add_argument("--fake-step-ms", type=float, default=15.0)
+    parser.add_argument("--verbose", action="store_true", help="mantém os logs do pipeline")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        main.log = lambda msg: None
+
+    if args.fake:
+        main.ENGINE = InferenceEngine(
+            FakeBackend(delay_s=args.fake_prefill_ms / 1000, step_delay_s=args.fake_step_ms / 1000),
+            max_batch_size=2,
+        )
+    elif main.ENGINE is None:
+        parser.error("modelo indisponível (mlx-vlm não instalado); use --fake")
+
+    if args.customer_crop and args.consumption_crop:
+        customer = Image.open(args.customer_crop).convert("RGB")
+        consumption = Image.open(args.consumption_crop).convert("RGB")
+    elif args.fake:
+        customer = Image.new("RGB", (900, 300), "white")
+        consumption = Image.new("RGB", (700, 500), "white")
+    else:
+        parser.error("informe os dois recortes (cliente e consumo)")
+
+    asyncio.run(_run(customer, consumption, args.runs))
+    main.ENGINE.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,111 @@
+"""
+Compara o carregamento de fotos grandes: legado (decode em resolução cheia + convert RGB +
+LANCZOS para max_pixels) vs. decode_downscaled (escala da DCT no decoder + BICUBIC final).
+
+Uso:
+  uv run python benchmarks/image_decode.py foto.jpg --runs 5
+  uv run python benchmarks/image_decode.py --synthetic --runs 5   # foto 12MP gerada na hora
+
+Cada modo roda num processo novo; o pico é o aumento do RSS máximo (ru_maxrss) em relação ao
+processo já aquecido.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image
+
+from config import settings
+from utils.image_decode import decode_downscaled, target_size
+
+
+def _legacy(raw: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(raw)).convert("RGB")
+    size = target_size(*img.size, settings.max_pixels)
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    return img
+
+
+def _downscaled(raw: bytes) -> Image.Image:
+    return decode_downscaled(raw, settings.max_pixels)[0]
+
+
+MODES = {"legado (cheia + LANCZOS)": _legacy, "decode reduzido": _downscaled}
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reporta KB; macOS reporta bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _measure(mode: str, raw: bytes, runs: int, out: multiprocessing.Queue) -> None:
+    fn = MODES[mode]
+    # Aquecimento com uma imagem minúscula: carrega os decoders sem inflar o pico medido
+    tiny = io.BytesIO()
+    Image.new("RGB", (16, 16)).save(tiny, format="JPEG")
+    fn(tiny.getvalue())
+    base = _max_rss_mb()
+    times, sizes = [], set()
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        img = fn(raw)
+        times.append((time.perf_counter() - t0) * 1000)
+        sizes.add(img.size)
+        img.close()
+    out.put((statistics.median(times), max(times), _max_rss_mb() - base, sorted(sizes)))
+
+
+def _synthetic_photo(out: multiprocessing.Queue) -> None:
+    """Foto de celular 4000x3000 (JPEG q92): gradiente + ruído, que não comprime bem."""
+    w, h = 4000, 3000
+    noise = Image.effect_noise((w, h), 40).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+    photo = Image.blend(gradient, noise, 0.5)
+    buf = io.BytesIO()
+    photo.save(buf, format="JPEG", quality=92)
+    out.put(buf.getvalue())
+
+
+def _run(ctx: multiprocessing.context.BaseContext, target, *args):
+    out = ctx.Queue()
+    proc = ctx.Process(target=target, args=(*args, out))
+    proc.start()
+    result = out.get()
+    proc.join()
+    return result
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    if not args.image and not args.synthetic:
+        parser.error("informe a imagem ou --synthetic")
+
+    ctx = multiprocessing.get_context("spawn")
+    # A foto sintética nasce noutro processo: o RSS máximo passa do pai para os filhos
+    raw = _run(ctx, _synthetic_photo) if args.synthetic else Path(args.image).read_bytes()
+    with Image.open(io.BytesIO(raw)) as im:
+        print(f"{im.format} {im.width}x{im.height}, {len(raw) / 1e6:.1f}MB, max_pixels={settings.max_pixels:,}\n")
+
+    for mode in MODES:
+        median_ms, max_ms, peak_mb, sizes = _run(ctx, _measure, mode, raw, args.runs)
+        dims = ", ".join(f"{sw}x{sh}" for sw, sh in sizes)
+        print(f"{mode:26s} mediana {median_ms:7.1f}ms  máx {max_ms:7.1f}ms  pico +{peak_mb:6.1f}MB  saída {dims}")
+
+
+if __name__ == "__main__":
+    main_cli()
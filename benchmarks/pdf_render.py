@@ -0,0 +1,157 @@
+"""
+Compara a renderização de PDFs: legado (zoom fixo 3.0 + encode/decode PNG + resize para
+max_pixels) vs. PdfPages (DPI calculado para max_pixels, pixmap RGB direto no PIL).
+
+Também compara as duas formas de obter os recortes (caixas típicas de cliente e consumo):
+página inteira em source_max_pixels + recorte, vs. prévia em full_max_pixels + só as caixas
+renderizadas de novo em alta (clip, como o pipeline faz com PDFs).
+
+Uso:
+  uv run python benchmarks/pdf_render.py fatura.pdf --runs 5
+  uv run python benchmarks/pdf_render.py --synthetic --pages 3 --runs 5   # PDF gerado na hora
+
+Mede latência por página (mediana) e pico de memória por página: cada modo roda num processo
+novo e o pico é o aumento do RSS máximo (ru_maxrss) em relação ao processo já aquecido.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pymupdf
+from PIL import Image
+
+from config import settings
+from utils.pdf_pages import PdfPages
+
+
+def _legacy(raw: bytes, index: int, password: str | None) -> Image.Image:
+    doc = pymupdf.open(stream=raw, filetype="pdf")
+    if doc.needs_pass:
+        doc.authenticate(password or "")
+    try:
+        pix = doc.load_page(index).get_pixmap(matrix=pymupdf.Matrix(3.0, 3.0), alpha=False)
+        img = Image.open(io.BytesIO(pix.tobytes("png"))).convert("RGB")
+    finally:
+        doc.close()
+    # Mesmo resize que o _load_image aplicava depois
+    w, h = img.size
+    if w * h > settings.max_pixels:
+        scale = (settings.max_pixels / float(w * h)) ** 0.5
+        img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.Resampling.LANCZOS)
+    return img
+
+
+def _adaptive(raw: bytes, index: int, password: str | None) -> Image.Image:
+    with PdfPages(raw, password) as pdf:
+        return pdf.render(index, settings.max_pixels, settings.pdf_max_dpi)
+
+
+# Caixas típicas (fração da página) dos recortes de cliente e de consumo
+CROP_BOXES = [(0.05, 0.10, 0.60, 0.30), (0.05, 0.55, 0.95, 0.80)]
+
+
+def _page_then_crop(raw: bytes, index: int, password: str | None) -> Image.Image:
+    with PdfPages(raw, password) as pdf:
+        page = pdf.render(index, settings.source_max_pixels, settings.pdf_max_dpi)
+    w, h = page.size
+    for x1, y1, x2, y2 in CROP_BOXES:
+        page.crop((int(x1 * w), int(y1 * h), int(x2 * w), int(y2 * h))).close()
+    return page
+
+
+def _preview_then_clip(raw: bytes, index: int, password: str | None) -> Image.Image:
+    with PdfPages(raw, password) as pdf:
+        preview = pdf.render(index, settings.full_max_pixels, settings.pdf_max_dpi)
+        w, h = pdf.page_size(index)
+        for x1, y1, x2, y2 in CROP_BOXES:
+            rect = (x1 * w, y1 * h, x2 * w, y2 * h)
+            pdf.render_clip(index, rect, settings.crop_max_pixels, settings.pdf_crop_max_dpi).close()
+    return preview
+
+
+MODES = {
+    "legado (3.0x + PNG)": _legacy,
+    "adaptativo (PdfPages)": _adaptive,
+    "página alta + recortes": _page_then_crop,
+    "prévia + clip": _preview_then_clip,
+}
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reporta KB; macOS reporta bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _measure(mode: str, raw: bytes, pages: int, runs: int, password: str | None, out: multiprocessing.Queue) -> None:
+    fn = MODES[mode]
+    # Aquecimento com uma página minúscula: carrega o MuPDF sem inflar o pico medido
+    tiny = pymupdf.open()
+    tiny.new_page(width=10, height=10)
+    fn(tiny.tobytes(), 0, None)
+    base = _max_rss_mb()
+    times, sizes = [], set()
+    for _ in range(runs):
+        for index in range(pages):
+            t0 = time.perf_counter()
+            img = fn(raw, index, password)
+            times.append((time.perf_counter() - t0) * 1000)
+            sizes.add(img.size)
+            img.close()
+    out.put((statistics.median(times), max(times), _max_rss_mb() - base, sorted(sizes)))
+
+
+def _synthetic_pdf(pages: int) -> bytes:
+    """PDF A4 com texto e tabelas desenhadas, parecido com uma fatura escaneada em vetor."""
+    doc = pymupdf.open()
+    for p in range(pages):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((40, 60), f"FATURA DE ENERGIA - página {p + 1}", fontsize=16)
+        for row in range(40):
+            y = 100 + row * 17
+            page.draw_rect(pymupdf.Rect(40, y, 555, y + 15), color=(0.6, 0.6, 0.6), width=0.5)
+            page.insert_text((45, y + 11), f"{row:02d}/2025   consumo {300 + row * 7} kWh   R$ {row * 13.37:.2f}", fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf", nargs="?")
+    parser.add_argument("--password")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--pages", type=int, default=1, help="páginas medidas (a partir da primeira)")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    if not args.pdf and not args.synthetic:
+        parser.error("informe o PDF ou --synthetic")
+
+    raw = _synthetic_pdf(args.pages) if args.synthetic else Path(args.pdf).read_bytes()
+    with PdfPages(raw, args.password) as pdf:
+        pages = min(args.pages, len(pdf))
+        w, h = pdf.page_size(0)
+    print(f"{pages} página(s), página 1 com {w:.0f}x{h:.0f}pt, max_pixels={settings.max_pixels:,}\n")
+
+    ctx = multiprocessing.get_context("spawn")
+    for mode in MODES:
+        out = ctx.Queue()
+        proc = ctx.Process(target=_measure, args=(mode, raw, pages, args.runs, args.password, out))
+        proc.start()
+        median_ms, max_ms, peak_mb, sizes = out.get()
+        proc.join()
+        dims = ", ".join(f"{sw}x{sh}" for sw, sh in sizes)
+        print(f"{mode:24s} mediana {median_ms:7.1f}ms  máx {max_ms:7.1f}ms  pico +{peak_mb:6.1f}MB  saída {dims}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,243 @@
+"""
+Extração em massa fora da API: lê um manifesto JSONL e roda o mesmo pipeline do /extract/energy
+num pool de processos, gravando um JSONL de resultados à medida que cada fatura termina.
+
+Manifesto (uma fatura por linha; "id" e "password", para PDFs protegidos, são opcionais):
+  {"path": "faturas/0001.png", "concessionaria": "equatorial", "uf": "GO", "id": "0001"}
+  {"path": "faturas/0002.pdf", "concessionaria": "equatorial", "uf": "GO", "password": "123"}
+
+Uso:
+  uv run python bulk_extract.py manifesto.jsonl --out resultados.jsonl --workers 2
+  uv run python bulk_extract.py manifesto.jsonl --out resultados.jsonl --retry-errors   # retoma
+
+O arquivo de saída é o checkpoint: ao rodar de novo com o mesmo --out, as faturas já gravadas
+(por "id", ou path + concessionaria + uf) são puladas, então uma execução interrompida continua
+de onde parou. Cada worker carrega o modelo uma vez (config.py vale igual à API).
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Iterator
+
+# Estado de cada processo worker: módulo main carregado (modelo residente) + event loop próprio
+_MAIN: Any = None
+_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def _worker_init(verbose: bool) -> None:
+    global _MAIN, _LOOP
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    import main
+
+    _MAIN = main
+    _LOOP = asyncio.new_event_loop()
+
+
+def _worker_run(path: str, concessionaria: str, uf: str, password: str | None = None) -> dict[str, Any]:
+    """Uma fatura no pipeline completo; erros viram {"status": "error"} em vez de exceção."""
+    from fastapi import HTTPException
+
+    t0 = time.perf_counter()
+    out: dict[str, Any] = {}
+    try:
+        raw = Path(path).read_bytes()
+        content_type = _MAIN._IMAGE_EXTENSIONS.get(Path(path).suffix.lower())
+        _MAIN._check_engine()
+        _MAIN._check_extraction_fields(concessionaria, uf, content_type)
+        _MAIN._check_upload_size(raw)
+        payload, headers = _LOOP.run_until_complete(
+            _MAIN._extract_when_admitted(raw, concessionaria, uf, pdf_password=password)
+        )
+        out.update(status="ok", cache=headers.get("X-Cache"), result=payload)
+    except HTTPException as e:
+        out.update(status="error", status_code=e.status_code, error=str(e.detail))
+    except OSError as e:
+        out.update(status="error", status_code=400, error=f"arquivo ilegível: {e}")
+    except Exception as e:
+        out.update(status="error", status_code=500, error=f"{type(e).__name__}: {e}")
+    out["ms"] = int((time.perf_counter() - t0) * 1000)
+    return out
+
+
+def _item_key(item: dict[str, Any]) -> str:
+    return str(item.get("id") or f"{item.get('path')}|{item.get('concessionaria')}|{item.get('uf')}")
+
+
+def _read_manifest(path: Path) -> Iterator[tuple[int, dict[str, Any]]]:
+    with path.open(encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[bulk] linha {lineno} do manifesto ignorada: {e}", file=sys.stderr)
+                continue
+            yield lineno, item
+
+
+def _load_checkpoint(out_path: Path, retry_errors: bool) -> set[str]:
+    """Chaves já concluídas no arquivo de saída (linhas truncadas por um crash são ignoradas)."""
+    done: set[str] = set()
+    if not out_path.exists():
+        return done
+    with out_path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # JSON válido sem chave (linha editada à mão, de outra ferramenta) não conta como feito
+            key = row.get("key") if isinstance(row, dict) else None
+            if key is None:
+                continue
+            if row.get("status") == "ok" or not retry_errors:
+                done.add(key)
+    return done
+
+
+class _Writer:
+    """Append no JSONL de saída com fsync periódico (o arquivo é o checkpoint)."""
+
+    def __init__(self, path: Path, fsync_every: int):
+        # Garante que a próxima linha não cole numa linha truncada pelo crash anterior (só o
+        # último byte é lido: a saída de um lote grande não passa pela memória)
+        needs_newline = False
+        if path.exists() and path.stat().st_size > 0:
+            with path.open("rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self.f = path.open("a", encoding="utf-8")
+        if needs_newline:
+            self.f.write("\n")
+        self.fsync_every = max(1, fsync_every)
+        self.pending = 0
+
+    def write(self, row: dict[str, Any]) -> None:
+        self.f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.f.flush()
+        self.pending += 1
+        if self.pending >= self.fsync_every:
+            os.fsync(self.f.fileno())
+            self.pending = 0
+
+    def close(self) -> None:
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+def run(args: argparse.Namespace) -> int:
+    manifest, out_path = Path(args.manifest), Path(args.out)
+    done = _load_checkpoint(out_path, args.retry_errors)
+    if done:
+        print(f"[bulk] retomando: {len(done)} faturas já concluídas em {out_path}", flush=True)
+    writer = _Writer(out_path, args.fsync_every)
+
+    def new_pool() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=get_context("spawn"),
+            initializer=_worker_init,
+            initargs=(args.verbose,),
+        )
+
+    pool = new_pool()
+    items = ((n, it) for n, it in _read_manifest(manifest) if _item_key(it) not in done)
+    in_flight: dict[Future, tuple[int, dict[str, Any], int]] = {}
+    retry: list[tuple[int, dict[str, Any], int]] = []
+    max_in_flight = args.workers * 2
+    t0 = time.perf_counter()
+    ok = errors = 0
+    exhausted = False
+
+    def submit(lineno: int, item: dict[str, Any], attempt: int) -> None:
+        # Caminhos relativos são relativos ao manifesto, não ao diretório atual
+        path = manifest.parent / str(item.get("path"))
+        fut = pool.submit(
+            _worker_run, str(path), str(item.get("concessionaria") or ""), str(item.get("uf") or ""), item.get("password")
+        )
+        in_flight[fut] = (lineno, item, attempt)
+
+    try:
+        while True:
+            # Mantém o pool ocupado sem materializar o manifesto inteiro em memória
+            while len(in_flight) < max_in_flight and (retry or not exhausted):
+                if retry:
+                    submit(*retry.pop())
+                    continue
+                nxt = next(items, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                submit(nxt[0], nxt[1], 1)
+            if not in_flight:
+                break
+
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for fut in finished:
+                lineno, item, attempt = in_flight.pop(fut)
+                try:
+                    result = fut.result()
+                except BrokenProcessPool:
+                    # Worker morreu (ex: falta de memória): a fatura volta para a fila até max_attempts
+                    broken = True
+                    if attempt < args.max_attempts:
+                        retry.append((lineno, item, attempt + 1))
+                        continue
+                    result = {"status": "error", "status_code": 500, "error": "worker morreu durante a extração"}
+                row = {"key": _item_key(item), "line": lineno, **{k: item.get(k) for k in ("path", "concessionaria", "uf")}, **result}
+                writer.write(row)
+                ok += row["status"] == "ok"
+                errors += row["status"] != "ok"
+                total = ok + errors
+                if total % args.progress_every == 0:
+                    rate = total / (time.perf_counter() - t0)
+                    print(f"[bulk] {total} concluídas ({ok} ok, {errors} erros) {rate:.2f}/s", flush=True)
+            if broken:
+                # O executor quebrado falha todos os futures pendentes: reenfileira e recria o pool
+                for lineno, item, attempt in in_flight.values():
+                    retry.append((lineno, item, attempt))
+                in_flight.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                print("[bulk] worker morreu; recriando o pool", flush=True)
+                pool = new_pool()
+    except KeyboardInterrupt:
+        print("[bulk] interrompido; rode de novo com o mesmo --out para continuar", flush=True)
+        return 130
+    finally:
+        writer.close()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.perf_counter() - t0
+    print(f"[bulk] fim: {ok} ok, {errors} erros em {elapsed:.1f}s -> {out_path}", flush=True)
+    return 0 if errors == 0 else 1
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSONL com path, concessionaria, uf (e id opcional)")
+    parser.add_argument("--out", required=True, help="JSONL de resultados (também é o checkpoint)")
+    parser.add_argument("--workers", type=int, default=1, help="processos, cada um com o modelo carregado")
+    parser.add_argument("--retry-errors", action="store_true", help="reprocessa faturas que terminaram em erro")
+    parser.add_argument("--max-attempts", type=int, default=2, help="tentativas por fatura se o worker morrer")
+    parser.add_argument("--fsync-every", type=int, default=20, help="linhas entre fsyncs do arquivo de saída")
+    parser.add_argument("--progress-every", type=int, default=50)
+    parser.add_argument("--verbose", action="store_true", help="mantém os logs do pipeline dos workers")
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -16,9 +16,138 @@ class Settings(BaseModel):
     # 10M pixels pode resultar em tensores de ~80GB+ durante processamento
     # 1.5M pixels é suficiente para OCR de documentos e reduz alocação para ~12GB
     max_pixels: int = 1_500_000
+    # PDFs: cada página é renderizada só quando necessária, no DPI que cabe em max_pixels,
+    # limitado a pdf_max_dpi (páginas pequenas não são ampliadas além disso)
+    pdf_max_dpi: int = 300
+    # Orçamento de resolução por região (todos limitados a max_pixels, o teto de uma imagem no
+    # modelo): a página é decodificada/renderizada em até source_max_pixels; o YOLO roda numa
+    # prévia de detection_max_pixels; os recortes saem da fonte e vão ao modelo com até
+    # crop_max_pixels; a imagem completa vai com full_max_pixels
+    source_max_pixels: int = 8_000_000
+    detection_max_pixels: int = 1_000_000
+    crop_max_pixels: int = 1_500_000
+    full_max_pixels: int = 1_000_000
+    # Os dois detectores YOLO rodam sobre o mesmo tensor pré-processado; com
+    # detection_parallel, cada modelo num thread (um por modelo, nunca o mesmo em dois)
+    detection_parallel: bool = True
+    # PDFs: o YOLO roda na página renderizada no tamanho da imagem completa e só as caixas
+    # detectadas são renderizadas de novo (clip) em alta, até pdf_crop_max_dpi
+    pdf_clip_render: bool = True
+    pdf_crop_max_dpi: int = 600
+    # Pixels por token de imagem (lado): Qwen2.5-VL = patch 14 x merge 2. Só para relatório
+    vision_patch_px: int = 28
     max_concurrency: int = 2
     request_timeout_s: int = 45
 
+    # Admissão das extrações: até admission_max_active pipelines simultâneos (0 = max_concurrency)
+    # e até admission_max_queue esperando, ordenados pela prioridade do header
+    # admission_priority_header (inteiro ou low/normal/high). Fila cheia ou espera acima de
+    # admission_queue_timeout_s → 429 com Retry-After
+    admission_max_active: int = 0
+    admission_max_queue: int = 32
+    admission_queue_timeout_s: float = 30.0
+    admission_priority_header: str = "X-Priority"
+
+    # "thread": engine único no processo da API (modelo carregado no boot)
+    # "process": pool de max_concurrency workers, cada um com o modelo residente
+    inference_mode: str = "thread"
+    # Worker é reciclado ao passar deste RSS (0 = sem limite) ou após N jobs (0 = sem limite)
+    worker_max_rss_mb: int = 0
+    worker_max_jobs: int = 0
+
+    # Backend de inferência: "mlx" (Apple Silicon), "cpu" (transformers/torch em Linux x86)
+    # ou "fake" (determinístico, para testes e benchmarks sem modelo)
+    inference_backend: str = "mlx"
+    # Pesos do backend cpu em formato transformers (os do mlx-community não servem fora do MLX)
+    cpu_model_id: str = "Qwen/Qwen2.5-VL-7B-Instruct"
+    # Quantização dinâmica int8 das camadas Linear no carregamento (~4x menos memória que fp32)
+    cpu_quantize: bool = True
+    # Threads do torch no backend cpu (0 = todos os núcleos, os.cpu_count())
+    cpu_threads: int = 0
+    # Latências simuladas do backend fake: prefill e cada passo de decode
+    fake_prefill_ms: int = 0
+    fake_step_ms: int = 0
+
+    # Continuous batching no engine: até N gerações compartilham cada passo de decode (1 = desativado).
+    # Com o lote vazio, o primeiro job espera até batch_wait_ms por outros antes do prefill.
+    batch_max_size: int = 1
+    batch_wait_ms: int = 10
+
+    # Cache LRU do KV do prefixo estático dos prompts (base.md + spec), em MB (0 = desativado)
+    prefix_cache_mb: int = 1024
+    # Para a geração assim que o primeiro objeto/lista JSON de topo fecha (evita decodificar texto extra)
+    json_early_stop: bool = True
+    # Decodificação restrita ao JSON Schema de cada extração (endereço, consumo, contrato):
+    # tokens que quebrariam o JSON são mascarados na amostragem. Desligada até o custo das
+    # máscaras ser medido no vocabulário real (benchmarks/constrained_masks.py)
+    constrained_decoding: bool = False
+
+    # Timeout de cada etapa do pipeline da requisição (recorte cliente, recorte consumo e imagem
+    # completa). Cliente e consumo rodam em paralelo; a imagem completa espera o endereço.
+    # É o único limite de tempo da geração; etapa sem entrada aqui usa request_timeout_s.
+    stage_timeouts_s: dict[str, float] = {"customer": 45.0, "consumption": 45.0, "crops": 60.0, "full": 60.0}
+    # Envia os recortes de cliente e consumo numa única geração multi-imagem (etapa "crops")
+    # em vez de duas gerações separadas; o JSON combinado é separado em endereço + consumo
+    combined_crops: bool = False
+
+    # PDFs nativos (com camada de texto): campos lidos por rótulo com as regras de
+    # prompts/text_rules.json não vão para o modelo; o modelo só gera os que faltarem.
+    # Abaixo de text_layer_min_words palavras o PDF é tratado como escaneado
+    text_layer_enabled: bool = True
+    text_layer_min_words: int = 50
+    # Inclui "origem_campos" na resposta: de onde veio cada campo (text, rule, customer,
+    # consumption, crops, full, request ou default)
+    field_provenance: bool = True
+
+    # Faturas com várias páginas (PDF/TIFF): miniaturas de até page_thumbnail_side px passam
+    # pelos dois YOLO (e, em PDF nativo, pela densidade de texto) para escolher a página de
+    # cada recorte; só as escolhidas são renderizadas em resolução cheia. Páginas além de
+    # page_ranking_max_pages não são avaliadas
+    page_ranking_enabled: bool = True
+    page_ranking_max_pages: int = 10
+    page_thumbnail_side: int = 640
+
+    # Modelo draft para decodificação especulativa (mesmo tokenizer do model_id, ex:
+    # mlx-community/Qwen2.5-VL-3B-Instruct-4bit). None desativa; só atua com temperature=0
+    draft_model_id: str | None = None
+    # Tokens propostos pelo draft por rodada de verificação do modelo principal
+    draft_tokens: int = 4
+
+    # Cache de resultados por conteúdo (reenvios da mesma fatura): LRU em memória em MB
+    # (0 = desativado) + camada em disco com evicção por tamanho (result_cache_dir=None desliga o disco)
+    result_cache_mb: int = 64
+    result_cache_dir: str | None = ".cache/results"
+    result_cache_disk_mb: int = 1024
+    # Reaproveita a extração de uploads quase idênticos (re-encode, outra qualidade de JPEG);
+    # exige o cache de resultados. Desligado por padrão: o dHash/pHash de 256 bits só acha
+    # candidatos (até near_dup_max_distance bits; re-encodes chegam a ~10). Faturas diferentes
+    # do mesmo layout (outro cliente, valor, leituras) ficam a 0-3 bits, tão perto quanto um
+    # re-encode. Por isso o candidato só é servido se a assinatura de detalhe (página em cinza
+    # com 640 px de largura, ~60KB por entrada) não diferir em nenhum pixel mais que
+    # near_dup_max_detail_diff (0-255) e, em PDF com camada de texto, se os campos lidos do
+    # texto baterem com os do resultado guardado
+    near_dup_enabled: bool = False
+    near_dup_max_distance: int = 12
+    near_dup_max_detail_diff: int = 96
+    near_dup_max_entries: int = 2_000
+
+    # Lote (/extract/energy/batch): máximo de arquivos por requisição e quantas faturas do lote
+    # disputam a admissão ao mesmo tempo (0 = admission_max_active efetivo)
+    batch_max_files: int = 500
+    batch_max_parallel: int = 0
+
+    # API assíncrona (/jobs/extract/energy): fila persistente em SQLite drenada por jobs_workers
+    # loops locais; jobs interrompidos por reinício voltam para a fila até jobs_max_attempts
+    jobs_db_path: str = ".cache/jobs.sqlite3"
+    jobs_workers: int = 1
+    jobs_max_attempts: int = 3
+    jobs_callback_timeout_s: float = 10.0
+    # Hosts aceitos como callback_url. Vazio = qualquer host cujos endereços sejam todos públicos
+    # (loopback, redes privadas e link-local são recusados na submissão e a cada envio)
+    jobs_callback_allowed_hosts: list[str] = []
+    # Jobs terminados (e seus resultados) são apagados após este prazo
+    jobs_retention_h: int = 72
+
     prompts_dir: str = "prompts"
 
 
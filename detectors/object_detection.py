@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 os.environ['MKL_NUM_THREADS'] = '1'
 os.environ['MKL_DYNAMIC'] = 'FALSE'
@@ -19,13 +22,19 @@ torch.set_num_interop_threads(1)
 torch.backends.mkldnn.enabled = False
 torch.backends.mkldnn.allow_tf32 = False
 
+import numpy as np
 from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from ultralytics.utils.ops import scale_boxes
+
+try:
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:  # ultralytics < 8.3.167
+    from ultralytics.utils.ops import non_max_suppression
 
 if hasattr(torch.utils.data, 'get_worker_info'):
     pass
 
-from utils.image_manipulator_service import ImageManipulatorService
-from utils.temp_file_manager import TempFileManager
 
 consumption_path = os.path.join(os.path.dirname(__file__), "models", "consumption.pt")
 customer_data_detector_path = os.path.join(os.path.dirname(__file__), "models", "customer_data_detector.pt")
@@ -77,16 +86,36 @@ def get_yolo_customer_data_model():
         
     return _yolo_customer_data_model_cache
 
+@dataclass
+class RegionDetection:
+    """Melhor caixa de cada detector (x1, y1, x2, y2 na imagem de entrada) e tempos em ms."""
+
+    customer_box: tuple | None = None
+    customer_conf: float = 0.0
+    consumption_box: tuple | None = None
+    consumption_conf: float = 0.0
+    timings: dict = field(default_factory=dict)
+
+
 class ObjectDetection:
 
+    # Tamanho de entrada dos dois modelos (treinados em 640) e limiares das detecções
+    imgsz = 640
+    conf = 0.25
+    iou = 0.45
+
     def __init__(self):
         self.consumption_model = get_yolo_consumption_model()  # Usar singleton
         self.customer_data_model = get_yolo_customer_data_model()  # Usar singleton
-        self.image_manipulator = ImageManipulatorService()
-        self.temp_file_manager = TempFileManager()
+        self.stride = max(
+            int(m.model.stride.max()) if hasattr(m.model, "stride") else 32
+            for m in (self.consumption_model, self.customer_data_model)
+        )
+        # Thread extra para o segundo modelo no detect_regions(parallel=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yolo")
 
     def detect_consumption_objects(self, image_path):
-        """Detecta objetos de consumo na imagem"""
+        """Detecta objetos de consumo na imagem (caminho ou imagem PIL já carregada)"""
         try:
             consumption_results = self.consumption_model(
                 image_path, 
@@ -106,7 +135,7 @@ class ObjectDetection:
                     raise RuntimeError(f"YOLO inference failed: PyTorch threading conflict in multiprocessing environment. Original error: {error_msg}")
 
     def detect_customer_data_objects(self, image_path):
-        """Detecta objetos de dados do cliente na imagem"""
+        """Detecta objetos de dados do cliente na imagem (caminho ou imagem PIL já carregada)"""
         try:
             customer_data_results = self.customer_data_model(
                 image_path, 
@@ -125,94 +154,87 @@ class ObjectDetection:
                 else:
                     raise RuntimeError(f"YOLO inference failed: PyTorch threading conflict in multiprocessing environment. Original error: {error_msg}")
 
-    def detect_and_crop_consumption(self, image_path):
-        """
-        Detecta objetos de consumo na imagem e retorna path do recorte
-        
-        Args:
-            image_path (str): Caminho da imagem original
-            
-        Returns:
-            str: Path do recorte de consumo ou None se não encontrar objetos
-        """
-        consumption_results = self.detect_consumption_objects(image_path)
-        
-        consumption_crop_path = None
-
-        if consumption_results and len(consumption_results) > 0:
-            for result in consumption_results:
-                if result.boxes is not None and len(result.boxes) > 0:
-                    if len(result.boxes.xyxy) > 0:
-                        confs = result.boxes.conf.cpu().numpy()
-                        best_idx = int(confs.argmax())
-
-                        bbox = result.boxes.xyxy[best_idx].tolist()
-                        
-                        if len(bbox) == 4 and all(isinstance(coord, (int, float)) for coord in bbox):
-                            bbox_tuple = tuple(int(coord) for coord in bbox)
-                            consumption_crop_path = self.image_manipulator.crop_image(image_path, bbox_tuple)
-                            if consumption_crop_path:
-                                self.temp_file_manager.add_temp_file(consumption_crop_path)
-                            break
-                        else:
-                            raise ValueError(f"Bbox inválido: {bbox} - deve ter 4 coordenadas (x1, y1, x2, y2)")
-                    else:
-                        raise ValueError("Nenhum objeto detectado na imagem")
-        return consumption_crop_path
-
-    def detect_and_crop_customer_data(self, image_path):
+    def detect_regions(self, image, customer=True, consumption=True, parallel=True):
         """
-        Detecta objetos de dados do cliente na imagem e retorna path do recorte
-        
-        Args:
-            image_path (str): Caminho da imagem original
-            
+        Os dois detectores numa passada: a imagem é redimensionada (letterbox) e normalizada uma
+        vez e o mesmo tensor vai aos dois modelos, em paralelo quando parallel=True (cada modelo
+        num thread; o PyTorch solta o GIL durante o forward). customer/consumption desligam um
+        dos modelos.
+
         Returns:
-            str: Path do recorte de dados do cliente ou None se não encontrar objetos
+            RegionDetection: melhor caixa de cada modelo e tempos (preprocess, customer,
+            consumption e total) em ms
         """
-        customer_data_results = self.detect_customer_data_objects(image_path)
-        
-        customer_data_crop_path = None
-
-        if customer_data_results and len(customer_data_results) > 0:
-            for result in customer_data_results:
-                if result.boxes is not None and len(result.boxes) > 0:
-                    if len(result.boxes.xyxy) > 0:
-                        confs = result.boxes.conf.cpu().numpy()
-                        best_idx = int(confs.argmax())
-
-                        bbox = result.boxes.xyxy[best_idx].tolist()
-                        
-                        if len(bbox) == 4 and all(isinstance(coord, (int, float)) for coord in bbox):
-                            bbox_tuple = tuple(int(coord) for coord in bbox)
-                            customer_data_crop_path = self.image_manipulator.crop_image(image_path, bbox_tuple)
-                            if customer_data_crop_path:
-                                self.temp_file_manager.add_temp_file(customer_data_crop_path)
-                            break
-                        else:
-                            raise ValueError(f"Bbox inválido: {bbox} - deve ter 4 coordenadas (x1, y1, x2, y2)")
-                    else:
-                        raise ValueError("Nenhum objeto detectado na imagem")
-        return customer_data_crop_path
-
-    def cleanup_temp_files(self):
+        t0 = time.perf_counter()
+        tensor = self._preprocess([image])
+        out = RegionDetection(timings={"preprocess": (time.perf_counter() - t0) * 1000})
+
+        jobs = []
+        if customer:
+            jobs.append(("customer", self.customer_data_model))
+        if consumption:
+            jobs.append(("consumption", self.consumption_model))
+        if parallel and len(jobs) == 2:
+            future = self._executor.submit(self._forward, jobs[1][1], tensor)
+            results = [self._forward(jobs[0][1], tensor), future.result()]
+        else:
+            results = [self._forward(model, tensor) for _, model in jobs]
+
+        for (name, _), (dets, elapsed_ms) in zip(jobs, results):
+            out.timings[name] = elapsed_ms
+            det = dets[0]
+            if len(det) == 0:
+                continue
+            best = det[int(det[:, 4].argmax())]
+            box = scale_boxes(tensor.shape[2:], best[None, :4].clone(), (image.height, image.width))[0]
+            setattr(out, f"{name}_box", tuple(float(coord) for coord in box.tolist()))
+            setattr(out, f"{name}_conf", float(best[4]))
+        out.timings["total"] = (time.perf_counter() - t0) * 1000
+        return out
+
+    def _preprocess(self, images):
+        """Imagens PIL -> tensor NCHW float em [0, 1], com letterbox para imgsz x imgsz."""
+        letterbox = LetterBox(new_shape=(self.imgsz, self.imgsz), auto=False, stride=self.stride)
+        # PIL já é RGB (a ordem que os modelos esperam depois do pré-processamento do YOLO)
+        batch = np.stack([letterbox(image=np.asarray(im.convert("RGB"))) for im in images])
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+        return torch.from_numpy(batch).float().div_(255.0)
+
+    def _forward(self, yolo, tensor):
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            preds = yolo.model(tensor)
+        preds = preds[0] if isinstance(preds, (list, tuple)) else preds
+        if getattr(yolo.model, "end2end", False):
+            # Modelos sem NMS (end2end) já saem como (x1, y1, x2, y2, conf, classe)
+            dets = [p[p[:, 4] > self.conf] for p in preds]
+        else:
+            dets = non_max_suppression(preds, conf_thres=self.conf, iou_thres=self.iou)
+        return dets, (time.perf_counter() - t0) * 1000
+
+    def score_pages(self, images):
         """
-        Remove todos os arquivos temporários criados durante as detecções
+        Maior confiança de cada detector em cada imagem: [(cliente, consumo), ...].
+        Usado para escolher a página de cada recorte em faturas com várias páginas;
+        miniaturas no tamanho de entrada do YOLO (640px) bastam.
         """
-        self.temp_file_manager.cleanup_temp_files()
-
-    def get_temp_files_info(self):
-        """
-        Retorna informações sobre os arquivos temporários criados
-        """
-        return self.temp_file_manager.get_temp_files_info()
+        if not images:
+            return []
+        # Um único tensor (lote) pré-processado para os dois modelos
+        tensor = self._preprocess(images)
+        customer_dets, _ = self._forward(self.customer_data_model, tensor)
+        consumption_dets, _ = self._forward(self.consumption_model, tensor)
+        return [
+            (self._best_confidence(customer), self._best_confidence(consumption))
+            for customer, consumption in zip(customer_dets, consumption_dets)
+        ]
+
+    @staticmethod
+    def _best_confidence(det):
+        return float(det[:, 4].max()) if len(det) else 0.0
 
     def __del__(self):
-        """
-        Destructor para garantir limpeza dos arquivos temporários
-        """
         try:
-            self.temp_file_manager.cleanup_temp_files()
+            self._executor.shutdown(wait=False)
         except Exception:
             pass  # Ignorar erros durante a limpeza no destructor
-        
\ No newline at end of file
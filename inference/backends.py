@@ -0,0 +1,1026 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from importlib.util import find_spec
+from typing import Any
+
+from PIL import Image
+
+from inference.constrained import GrammarMasker, JsonSchemaGrammar, SchemaConstraint, TokenVocabulary, schema_key
+from inference.json_stop import JsonStopTracker
+from inference.prefix_cache import PrefixCache
+from utils.log import log
+
+_HAS_MLX_VLM = find_spec("mlx_vlm") is not None
+# Backend CPU (Linux x86): transformers + torch, pesos quantizados em int8 no carregamento
+_HAS_TORCH_VLM = find_spec("torch") is not None and find_spec("transformers") is not None
+
+# Uma imagem ou várias no mesmo prompt (ex: os dois recortes numa única geração)
+ImageInput = Image.Image | list[Image.Image]
+if _HAS_MLX_VLM:
+    import mlx.core as mx
+    from mlx_vlm import load as _mlx_load
+    from mlx_vlm.models import cache as _mlx_cache
+    from mlx_vlm.prompt_utils import get_chat_template
+    from mlx_vlm.utils import load_config as _mlx_load_config
+    from mlx_vlm.utils import prepare_inputs
+if _HAS_TORCH_VLM:
+    import torch
+    from transformers import DynamicCache
+
+
+@dataclass
+class Sequence:
+    """
+    Uma geração em andamento: estado opaco do backend (KV cache etc.) + tokens já emitidos.
+
+    O prompt completo é prefix + prompt. Quando prefix_key é informado, o prefixo é estático
+    (arquivos de prompt) e o backend pode reaproveitar o KV dele via PrefixCache.
+    Com constraint, cada token amostrado fica restrito ao JSON Schema da extração.
+    kind identifica o tipo de prompt (customer, consumption, crops, full) nas estatísticas.
+    """
+
+    image: ImageInput
+    prompt: str
+    max_tokens: int
+    prefix: str = ""
+    prefix_key: tuple | None = None
+    tokens: list[int] = field(default_factory=list)
+    state: Any = None
+    finish_reason: str | None = None
+    stop_tracker: JsonStopTracker | None = None
+    constraint: SchemaConstraint | None = None
+    kind: str | None = None
+
+
+@dataclass
+class GenerationOutput:
+    """Resultado de uma geração: texto + contagem de tokens e motivo de parada."""
+
+    text: str
+    tokens: int
+    max_tokens: int
+    finish_reason: str | None
+
+    @property
+    def early_stopped(self) -> bool:
+        return self.finish_reason == "json_complete"
+
+    @property
+    def tokens_saved(self) -> int:
+        """Teto de tokens de decode evitados pela parada antecipada (até max_tokens)."""
+        return self.max_tokens - self.tokens if self.early_stopped else 0
+
+
+class InferenceBackend:
+    """
+    Interface de um backend de geração: imagem + prompt -> texto bruto do modelo.
+
+    A geração é exposta em passos (prefill + decode_step) para que o BatchScheduler possa
+    intercalar várias sequências no mesmo passo de decode. Os backends são chamados sempre
+    a partir de um único thread (o do InferenceEngine ou o loop principal de um worker do
+    WorkerPool).
+    """
+
+    name = "base"
+    max_tokens = 1500
+    prefix_cache: PrefixCache | None = None
+    # Encerra a geração assim que o primeiro valor JSON de topo fecha
+    json_early_stop = True
+    eos_ids: set[int] = set()
+    _maskers: dict[str, GrammarMasker] | None = None
+    _vocab: TokenVocabulary | None = None
+
+    def prefill(self, seq: Sequence) -> int:
+        """Processa prompt + imagem, preenche seq.state e retorna o primeiro token amostrado."""
+        raise NotImplementedError
+
+    def decode_step(self, seqs: list[Sequence], tokens: list[int]) -> list[int]:
+        """Alimenta o último token de cada sequência e retorna o próximo token de cada uma."""
+        raise NotImplementedError
+
+    def is_eos(self, token: int) -> bool:
+        raise NotImplementedError
+
+    def detokenize(self, tokens: list[int]) -> str:
+        raise NotImplementedError
+
+    def token_text(self, token: int) -> str:
+        """Texto de um token isolado (suficiente para os caracteres estruturais do JSON)."""
+        return self.detokenize([token])
+
+    def vocabulary(self) -> list[tuple[int, str]]:
+        """(id, texto) de cada token que pode ser amostrado; usado pela decodificação restrita."""
+        raise NotImplementedError
+
+    def _mask_array(self, ids: list[int]) -> Any:
+        return ids
+
+    def constraint_for(self, schema: dict[str, Any]) -> SchemaConstraint:
+        """Cursor novo na gramática do schema (compilada e mascarada uma vez por backend)."""
+        if self._maskers is None:
+            self._maskers = {}
+        key = schema_key(schema)
+        masker = self._maskers.get(key)
+        if masker is None:
+            if self._vocab is None:
+                t0 = time.perf_counter()
+                self._vocab = TokenVocabulary(self.vocabulary())
+                log(
+                    f"[constrained] vocabulário indexado: {len(self._vocab)} tokens "
+                    f"em {(time.perf_counter() - t0) * 1000:.0f}ms"
+                )
+            masker = self._maskers[key] = GrammarMasker(
+                JsonSchemaGrammar(schema), self._vocab, sorted(self.eos_ids), to_array=self._mask_array
+            )
+        return SchemaConstraint(masker)
+
+    def release(self, seq: Sequence) -> None:
+        seq.state = None
+
+    def new_sequence(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> Sequence:
+        return Sequence(
+            image, prompt, self.max_tokens,
+            prefix=prefix,
+            prefix_key=prefix_key,
+            stop_tracker=JsonStopTracker() if self.json_early_stop else None,
+            constraint=self.constraint_for(schema) if schema is not None else None,
+            kind=kind,
+        )
+
+    def advance(self, seq: Sequence, token: int) -> bool:
+        """Registra o token amostrado na sequência; retorna True quando ela terminou."""
+        if self.is_eos(token):
+            seq.finish_reason = "eos"
+            return True
+        seq.tokens.append(token)
+        if seq.constraint is not None:
+            seq.constraint.advance(self.token_text(token))
+            if seq.constraint.complete:
+                seq.finish_reason = "json_complete"
+                return True
+        if seq.stop_tracker is not None and seq.stop_tracker.feed(self.token_text(token)):
+            seq.finish_reason = "json_complete"
+            return True
+        if len(seq.tokens) >= seq.max_tokens:
+            seq.finish_reason = "length"
+            return True
+        return False
+
+    def output(self, seq: Sequence) -> GenerationOutput:
+        return GenerationOutput(
+            text=self.detokenize(seq.tokens),
+            tokens=len(seq.tokens),
+            max_tokens=seq.max_tokens,
+            finish_reason=seq.finish_reason,
+        )
+
+    def generate(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> GenerationOutput:
+        seq = self.new_sequence(image, prompt, prefix, prefix_key, schema, kind)
+        try:
+            token = self.prefill(seq)
+            while not self.advance(seq, token):
+                token = self.decode_step([seq], [token])[0]
+        finally:
+            self.release(seq)
+        return self.output(seq)
+
+    def stats(self) -> dict[str, Any]:
+        out: dict[str, Any] = {}
+        if self.prefix_cache is not None:
+            out["prefix_cache"] = self.prefix_cache.stats()
+        if self._maskers:
+            out["constrained"] = {
+                "grammars": len(self._maskers),
+                "masked_states": sum(m.computed for m in self._maskers.values()),
+            }
+        return out
+
+    def close(self) -> None:
+        pass
+
+
+@dataclass
+class _MlxState:
+    cache: list
+    rope_delta: int
+    # Decodificação especulativa: KV do modelo draft, tokens já verificados ainda não entregues
+    # e tokens emitidos que o draft ainda não processou
+    draft_cache: list | None = None
+    draft_rope_delta: int = 0
+    draft_backlog: list[int] = field(default_factory=list)
+    pending: list[int] = field(default_factory=list)
+
+
+@dataclass
+class _MlxPrefix:
+    """KV do prefixo já processado: (keys, values) por camada + número de tokens."""
+
+    layers: list
+    length: int
+
+
+_SPEC_COUNTERS = ("rounds", "proposed", "accepted", "tokens", "draft_ms", "verify_ms")
+
+
+def speculative_summary(counters: dict[str, float]) -> dict[str, Any]:
+    """
+    Contadores brutos da decodificação especulativa + métricas derivadas.
+    speedup_est compara com um decode token a token que custasse um passe de verificação por token.
+    """
+    out: dict[str, Any] = {k: round(counters.get(k, 0), 1) for k in _SPEC_COUNTERS}
+    rounds, proposed = counters.get("rounds", 0), counters.get("proposed", 0)
+    spent_ms = counters.get("draft_ms", 0) + counters.get("verify_ms", 0)
+    out["accept_rate"] = round(counters.get("accepted", 0) / proposed, 3) if proposed else None
+    out["tokens_per_round"] = round(counters.get("tokens", 0) / rounds, 2) if rounds else None
+    out["speedup_est"] = (
+        round(counters.get("tokens", 0) * (counters.get("verify_ms", 0) / rounds) / spent_ms, 2)
+        if rounds and spent_ms else None
+    )
+    return out
+
+
+class MlxBackend(InferenceBackend):
+    """
+    Backend MLX-VLM que reutiliza o modelo/processor carregados no boot (sem recarregar por chamada).
+
+    Com um modelo draft (mesmo tokenizer, ex: Qwen2.5-VL-3B), o decode é especulativo: o draft
+    propõe draft_tokens tokens e o modelo principal verifica todos num único passe. Só com
+    temperature=0: a verificação gulosa garante a mesma saída do decode normal.
+    """
+
+    name = "mlx"
+
+    def __init__(
+        self,
+        model: Any,
+        processor: Any,
+        config: Any,
+        *,
+        max_tokens: int,
+        temperature: float,
+        prefix_cache_mb: int = 0,
+        json_early_stop: bool = True,
+        draft: tuple[Any, Any, Any] | None = None,
+        draft_tokens: int = 4,
+    ):
+        if not _HAS_MLX_VLM:
+            raise RuntimeError("Dependência MLX-VLM indisponível para inferência.")
+        self.model = model
+        self.processor = processor
+        self.config = config
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.json_early_stop = json_early_stop
+        self._token_text: dict[int, str] = {}
+        self.prefix_cache = PrefixCache(prefix_cache_mb * 1024 * 1024) if prefix_cache_mb > 0 else None
+
+        self.tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+        eos = getattr(model.config, "eos_token_id", None)
+        eos_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        if getattr(self.tokenizer, "eos_token_id", None) is not None:
+            eos_ids.add(self.tokenizer.eos_token_id)
+        self.eos_ids = {int(t) for t in eos_ids if t is not None}
+
+        # (model, processor, config) do draft; desligado fora do decode guloso
+        self.draft = draft
+        self.draft_tokens = max(1, draft_tokens)
+        if draft is not None and temperature != 0:
+            print("[spec] temperature > 0: decodificação especulativa desativada", flush=True)
+            self.draft = None
+        self._spec: dict[str, dict[str, float]] = {}
+
+    def _sample(self, logits: Any, seq: Sequence | None = None) -> Any:
+        allowed = seq.constraint.allowed() if seq is not None and seq.constraint is not None else None
+        return self._sample_allowed(logits, allowed)
+
+    def _sample_allowed(self, logits: Any, allowed: Any) -> Any:
+        if allowed is not None:
+            # Amostra só entre os tokens que o schema permite e mapeia de volta para o id real
+            logits = mx.take(logits, allowed, axis=-1)
+        if self.temperature == 0:
+            y = mx.argmax(logits, axis=-1)
+        else:
+            y = mx.random.categorical(logits * (1 / self.temperature))
+        return y if allowed is None else mx.take(allowed, y)
+
+    def _mask_array(self, ids: list[int]) -> Any:
+        return mx.array(ids, dtype=mx.uint32)
+
+    def vocabulary(self) -> list[tuple[int, str]]:
+        tok = self.tokenizer
+        # Tokens especiais/adicionados (<|im_end|>, <|vision_start|> ...) nunca entram no JSON
+        skip = set(getattr(tok, "all_special_ids", None) or [])
+        skip.update(getattr(tok, "added_tokens_decoder", None) or {})
+        ids = [i for i in range(len(tok)) if i not in skip]
+        texts = tok.batch_decode([[i] for i in ids]) if hasattr(tok, "batch_decode") else [tok.decode([i]) for i in ids]
+        self._token_text.update(zip(ids, texts))
+        return list(zip(ids, texts))
+
+    def prefill(self, seq: Sequence) -> int:
+        images = [im if im.mode == "RGB" else im.convert("RGB") for im in _as_image_list(seq.image)]
+
+        if seq.prefix and seq.prefix_key is not None and self.prefix_cache is not None:
+            y = self._prefill_with_prefix(seq, images)
+        else:
+            y = self._prefill_full(seq, images)
+        if self.draft is not None:
+            self._prefill_draft(seq, images)
+        return y
+
+    def _format(self, seq: Sequence, images: list[Image.Image]) -> str:
+        return get_chat_template(self.processor, _user_messages(seq, len(images)), add_generation_prompt=True)
+
+    def _prefill_full(self, seq: Sequence, images: list[Image.Image]) -> int:
+        # Mesmo layout do caminho com cache de prefixo: com ou sem cache, o modelo vê o mesmo prompt
+        input_ids, pixel_values, mask, extra = self._prepare(self._format(seq, images), images)
+
+        cache = _mlx_cache.make_prompt_cache(self.model.language_model)
+        out = self.model(input_ids, pixel_values, cache=cache, mask=mask, **extra)
+        y = self._sample(out.logits[:, -1, :], seq)
+        mx.eval(y)
+
+        # O delta do M-RoPE fica num atributo compartilhado do modelo; guardamos por sequência
+        # para poder intercalar sequências diferentes no decode
+        delta = getattr(self.model.language_model, "_rope_deltas", None)
+        seq.state = _MlxState(cache=cache, rope_delta=_first_int(delta))
+        return int(y.item())
+
+    def _prepare(self, formatted: str, images: list[Image.Image]) -> tuple[Any, Any, Any, dict]:
+        inputs = prepare_inputs(
+            self.processor,
+            images=images,
+            prompts=formatted,
+            image_token_index=getattr(self.model.config, "image_token_index", None),
+            add_special_tokens=True,
+        )
+        input_ids = inputs.pop("input_ids")
+        pixel_values = inputs.pop("pixel_values", None)
+        mask = inputs.pop("attention_mask", None)
+        return input_ids, pixel_values, mask, inputs
+
+    def _prefill_with_prefix(self, seq: Sequence, images: list[Image.Image]) -> int:
+        """
+        Prefill com o prefixo estático em cache: o texto do prefixo vai antes das imagens na
+        mensagem do usuário (_user_messages), então só imagens + sufixo dinâmico passam pelo modelo.
+        """
+        formatted = self._format(seq, images)
+        input_ids, pixel_values, mask, extra = self._prepare(formatted, images)
+
+        # Tokens do prefixo = tudo antes do início da imagem (token especial, fronteira estável)
+        head = formatted.split("<|vision_start|>", 1)[0]
+        prefix_ids = self.tokenizer(head, add_special_tokens=False).input_ids
+        n_prefix = len(prefix_ids)
+        if n_prefix == 0 or input_ids[0, :n_prefix].tolist() != list(prefix_ids):
+            seq.prefix_key = None
+            return self._prefill_full(seq, images)
+
+        lm = self.model.language_model
+        cached = self.prefix_cache.get(seq.prefix_key)
+        if cached is None:
+            cached = self._build_prefix(prefix_ids)
+            nbytes = sum(k.nbytes + v.nbytes for k, v in cached.layers)
+            self.prefix_cache.put(seq.prefix_key, cached, nbytes)
+
+        cache = _mlx_cache.make_prompt_cache(lm)
+        for c, (k, v) in zip(cache, cached.layers):
+            # KVCache concatena ao crescer, então o snapshot em cache nunca é alterado
+            c.keys, c.values, c.offset = k, v, cached.length
+
+        grid_thw = extra.get("image_grid_thw")
+        position_ids, deltas = lm.get_rope_index(input_ids, grid_thw, None, mask)
+        suffix_ids = input_ids[:, n_prefix:]
+        inputs_embeds = self.model.get_input_embeddings(suffix_ids, pixel_values, grid_thw)
+        out = lm(suffix_ids, inputs_embeds, cache=cache, position_ids=position_ids[:, :, n_prefix:])
+        y = self._sample(out.logits[:, -1, :], seq)
+        mx.eval(y)
+
+        seq.state = _MlxState(cache=cache, rope_delta=_first_int(deltas))
+        return int(y.item())
+
+    def _build_prefix(self, prefix_ids: list[int]) -> _MlxPrefix:
+        lm = self.model.language_model
+        n = len(prefix_ids)
+        cache = _mlx_cache.make_prompt_cache(lm)
+        # Prefixo só de texto: as três componentes do M-RoPE são a própria posição
+        position_ids = mx.broadcast_to(mx.arange(n).reshape(1, 1, n), (3, 1, n))
+        lm(mx.array([prefix_ids]), cache=cache, position_ids=position_ids)
+        layers = [(c.keys[..., :n, :], c.values[..., :n, :]) for c in cache]
+        mx.eval(layers)
+        return _MlxPrefix(layers=layers, length=n)
+
+    def _prefill_draft(self, seq: Sequence, images: list[Image.Image]) -> None:
+        """Prefill do draft com o prompt completo (sem cache de prefixo: o modelo é pequeno)."""
+        model, processor, config = self.draft
+        formatted = get_chat_template(processor, _user_messages(seq, len(images)), add_generation_prompt=True)
+        inputs = prepare_inputs(
+            processor,
+            images=images,
+            prompts=formatted,
+            image_token_index=getattr(model.config, "image_token_index", None),
+            add_special_tokens=True,
+        )
+        input_ids = inputs.pop("input_ids")
+        pixel_values = inputs.pop("pixel_values", None)
+        mask = inputs.pop("attention_mask", None)
+        cache = _mlx_cache.make_prompt_cache(model.language_model)
+        out = model(input_ids, pixel_values, cache=cache, mask=mask, **inputs)
+        mx.eval(out.logits)
+        st: _MlxState = seq.state
+        st.draft_cache = cache
+        st.draft_rope_delta = _first_int(getattr(model.language_model, "_rope_deltas", None))
+
+    def decode_step(self, seqs: list[Sequence], tokens: list[int]) -> list[int]:
+        out: list[int | None] = [None] * len(seqs)
+        plain = []
+        for i, (seq, token) in enumerate(zip(seqs, tokens)):
+            st: _MlxState = seq.state
+            if st.pending:
+                # Tokens já verificados numa rodada especulativa anterior
+                out[i] = st.pending.pop(0)
+            elif st.draft_cache is not None:
+                emitted = self._speculate(seq, token)
+                out[i], st.pending = emitted[0], emitted[1:]
+            else:
+                plain.append(i)
+
+        # Monta o grafo das demais sequências e avalia num único mx.eval por passo
+        ys = []
+        for i in plain:
+            seq, token = seqs[i], tokens[i]
+            st = seq.state
+            position = st.cache[0].offset + st.rope_delta
+            position_ids = mx.full((3, 1, 1), position, dtype=mx.int32)
+            logits = self.model.language_model(
+                mx.array([[token]]), cache=st.cache, position_ids=position_ids
+            ).logits
+            ys.append(self._sample(logits[:, -1, :], seq))
+        if ys:
+            mx.eval(ys)
+            for i, y in zip(plain, ys):
+                out[i] = int(y.item())
+        return out
+
+    def _speculate(self, seq: Sequence, token: int) -> list[int]:
+        """
+        Uma rodada especulativa: o draft propõe até draft_tokens tokens (respeitando o schema) e o
+        modelo principal processa [token, propostas...] num passe só. Aceita o maior prefixo em
+        que as propostas coincidem com o argmax do principal, mais o token do principal na
+        primeira divergência; o KV dos dois modelos é recortado para o que foi aceito.
+        """
+        st: _MlxState = seq.state
+        draft_lm = self.draft[0].language_model
+        grammar = seq.constraint.masker.grammar if seq.constraint is not None else None
+        states = [seq.constraint.state] if seq.constraint is not None else [None]
+
+        t0 = time.perf_counter()
+        feed = st.draft_backlog + [token]
+        proposals: list[int] = []
+        for _ in range(self.draft_tokens):
+            logits = _lm_forward(draft_lm, st.draft_cache, st.draft_rope_delta, feed)
+            d = self._sample_allowed(logits[:, -1, :], self._allowed_at(seq, states[-1]))
+            mx.eval(d)
+            d = int(d.item())
+            proposals.append(d)
+            nxt = grammar.feed(states[-1], self.token_text(d)) if states[-1] is not None else None
+            states.append(nxt)
+            if self.is_eos(d) or (nxt is not None and grammar.is_complete(nxt)):
+                break
+            feed = [d]
+        t1 = time.perf_counter()
+
+        inputs = [token] + proposals
+        logits = _lm_forward(self.model.language_model, st.cache, st.rope_delta, inputs)
+        targets = [
+            self._sample_allowed(logits[:, i, :], self._allowed_at(seq, states[i]))
+            for i in range(len(inputs))
+        ]
+        mx.eval(targets)
+        targets = [int(t.item()) for t in targets]
+        t2 = time.perf_counter()
+
+        n = 0
+        while n < len(proposals) and proposals[n] == targets[n] and not self.is_eos(proposals[n]):
+            n += 1
+        emitted = proposals[:n] + [targets[n]]
+
+        # Principal processou token + todas as propostas; mantém token + as n aceitas
+        _trim_cache(st.cache, len(proposals) - n)
+        # Draft processou backlog + token + propostas[:-1]; a última proposta nunca entrou nele
+        if n < len(proposals):
+            _trim_cache(st.draft_cache, len(proposals) - 1 - n)
+            st.draft_backlog = []
+        else:
+            st.draft_backlog = proposals[-1:]
+
+        c = self._spec.setdefault(seq.kind or "default", dict.fromkeys(_SPEC_COUNTERS, 0))
+        c["rounds"] += 1
+        c["proposed"] += len(proposals)
+        c["accepted"] += n
+        c["tokens"] += len(emitted)
+        c["draft_ms"] += (t1 - t0) * 1000
+        c["verify_ms"] += (t2 - t1) * 1000
+        return emitted
+
+    def _allowed_at(self, seq: Sequence, state: tuple | None) -> Any:
+        if seq.constraint is None or state is None:
+            return None
+        return seq.constraint.masker.allowed(state)
+
+    def stats(self) -> dict[str, Any]:
+        out = super().stats()
+        if self._spec:
+            out["speculative"] = {kind: speculative_summary(c) for kind, c in self._spec.items()}
+        return out
+
+    def is_eos(self, token: int) -> bool:
+        return token in self.eos_ids
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+    def token_text(self, token: int) -> str:
+        text = self._token_text.get(token)
+        if text is None:
+            text = self._token_text[token] = self.tokenizer.decode([token])
+        return text
+
+    def release(self, seq: Sequence) -> None:
+        seq.state = None
+        _clear_mlx_cache()
+
+
+def load_mlx_backend(
+    model_id: str,
+    max_tokens: int,
+    temperature: float,
+    prefix_cache_mb: int = 0,
+    json_early_stop: bool = True,
+    draft_model_id: str | None = None,
+    draft_tokens: int = 4,
+) -> MlxBackend:
+    """Carrega o modelo e monta o backend (usado pelos workers do pool, um carregamento por processo)."""
+    if not _HAS_MLX_VLM:
+        raise RuntimeError("Dependência MLX-VLM indisponível para inferência.")
+    model, processor = _mlx_load(model_id)
+    config = _mlx_load_config(model_id)
+    draft = None
+    if draft_model_id:
+        draft_model, draft_processor = _mlx_load(draft_model_id)
+        draft = (draft_model, draft_processor, _mlx_load_config(draft_model_id))
+    return MlxBackend(
+        model, processor, config,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        prefix_cache_mb=prefix_cache_mb,
+        json_early_stop=json_early_stop,
+        draft=draft,
+        draft_tokens=draft_tokens,
+    )
+
+
+def _user_messages(seq: Sequence, num_images: int) -> list[dict[str, Any]]:
+    """
+    Mensagem do usuário em todos os backends: prefixo estático, imagens e o prompt dinâmico.
+    O prefixo vem antes das imagens para que o KV dele possa ser reaproveitado (PrefixCache).
+    """
+    content: list[dict[str, Any]] = [{"type": "text", "text": seq.prefix}] if seq.prefix else []
+    content += [{"type": "image"} for _ in range(num_images)]
+    content.append({"type": "text", "text": seq.prompt})
+    return [{"role": "user", "content": content}]
+
+
+def _as_image_list(image: ImageInput) -> list[Image.Image]:
+    return list(image) if isinstance(image, (list, tuple)) else [image]
+
+
+def _lm_forward(lm: Any, cache: list, rope_delta: int, tokens: list[int]) -> Any:
+    """Passe só de texto no language model a partir do KV atual; retorna os logits de cada posição."""
+    n = len(tokens)
+    start = cache[0].offset + rope_delta
+    position_ids = mx.broadcast_to(mx.arange(start, start + n).reshape(1, 1, n), (3, 1, n))
+    return lm(mx.array([tokens]), cache=cache, position_ids=position_ids).logits
+
+
+def _trim_cache(cache: list, n: int) -> None:
+    if n > 0:
+        for c in cache:
+            c.trim(n)
+
+
+def _first_int(x: Any) -> int:
+    if x is None:
+        return 0
+    return int(mx.array(x).reshape(-1)[0].item())
+
+
+def _clear_mlx_cache() -> None:
+    try:
+        if hasattr(mx, "clear_cache"):
+            mx.clear_cache()
+    except Exception:
+        pass
+
+
+@dataclass
+class _CpuState:
+    cache: Any
+    length: int
+    rope_delta: int
+
+
+class CpuBackend(InferenceBackend):
+    """
+    Backend CPU com transformers/torch para servidores Linux sem Apple Silicon.
+
+    Carrega os pesos originais do Qwen2.5-VL (não os do mlx-community) e, com quantize=True,
+    converte as camadas Linear para int8 (quantização dinâmica do torch). Sem cache de prefixo:
+    o prompt completo passa pelo prefill a cada geração. Com mais de uma sequência no lote, o
+    passo de decode é um único forward com os caches alinhados por padding.
+    """
+
+    name = "cpu"
+
+    def __init__(
+        self,
+        model: Any,
+        processor: Any,
+        *,
+        max_tokens: int,
+        temperature: float,
+        json_early_stop: bool = True,
+    ):
+        if not _HAS_TORCH_VLM:
+            raise RuntimeError("Dependências torch/transformers indisponíveis para inferência em CPU.")
+        self.model = model
+        self.processor = processor
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.json_early_stop = json_early_stop
+        self._token_text: dict[int, str] = {}
+
+        self.tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+        eos = getattr(model.generation_config, "eos_token_id", None) or getattr(model.config, "eos_token_id", None)
+        eos_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        if getattr(self.tokenizer, "eos_token_id", None) is not None:
+            eos_ids.add(self.tokenizer.eos_token_id)
+        self.eos_ids = {int(t) for t in eos_ids if t is not None}
+
+    def _sample(self, logits: Any, seq: Sequence) -> int:
+        allowed = seq.constraint.allowed() if seq.constraint is not None else None
+        if allowed is not None:
+            logits = logits.index_select(-1, allowed)
+        if self.temperature == 0:
+            y = int(logits.argmax(-1).item())
+        else:
+            probs = torch.softmax(logits.float() / self.temperature, dim=-1)
+            y = int(torch.multinomial(probs, 1).item())
+        return y if allowed is None else int(allowed[y].item())
+
+    def _mask_array(self, ids: list[int]) -> Any:
+        return torch.tensor(ids, dtype=torch.long)
+
+    def vocabulary(self) -> list[tuple[int, str]]:
+        tok = self.tokenizer
+        skip = set(getattr(tok, "all_special_ids", None) or [])
+        skip.update(getattr(tok, "added_tokens_decoder", None) or {})
+        ids = [i for i in range(len(tok)) if i not in skip]
+        texts = tok.batch_decode([[i] for i in ids])
+        self._token_text.update(zip(ids, texts))
+        return list(zip(ids, texts))
+
+    def prefill(self, seq: Sequence) -> int:
+        images = [im if im.mode == "RGB" else im.convert("RGB") for im in _as_image_list(seq.image)]
+        text = self.processor.apply_chat_template(
+            _user_messages(seq, len(images)), tokenize=False, add_generation_prompt=True
+        )
+        inputs = self.processor(text=[text], images=images, return_tensors="pt")
+        with torch.inference_mode():
+            out = self.model(**inputs, use_cache=True)
+        # Posição 3D (M-RoPE) do decode = comprimento do cache + delta calculado no prefill;
+        # guardado por sequência porque o modelo mantém só o delta da última chamada
+        rope_delta = getattr(out, "rope_deltas", None)
+        seq.state = _CpuState(
+            cache=out.past_key_values,
+            length=int(inputs["input_ids"].shape[1]),
+            rope_delta=int(rope_delta.reshape(-1)[0].item()) if rope_delta is not None else 0,
+        )
+        return self._sample(out.logits[0, -1, :], seq)
+
+    def decode_step(self, seqs: list[Sequence], tokens: list[int]) -> list[int]:
+        if len(seqs) == 1:
+            return [self._decode_one(seqs[0], tokens[0])]
+        return self._decode_batch(seqs, tokens)
+
+    def _decode_one(self, seq: Sequence, token: int) -> int:
+        st: _CpuState = seq.state
+        position_ids = torch.full((3, 1, 1), st.length + st.rope_delta, dtype=torch.long)
+        with torch.inference_mode():
+            logits = self.model(
+                input_ids=torch.tensor([[token]]),
+                past_key_values=st.cache,
+                position_ids=position_ids,
+                cache_position=torch.tensor([st.length]),
+                use_cache=True,
+            ).logits
+        st.length += 1
+        return self._sample(logits[0, -1, :], seq)
+
+    def _decode_batch(self, seqs: list[Sequence], tokens: list[int]) -> list[int]:
+        """
+        Um forward para o lote inteiro: o KV de cada sequência recebe padding à esquerda até o
+        maior comprimento e é empilhado no eixo do batch, com a máscara de atenção zerando o
+        padding. Os pesos são lidos uma vez por passo em vez de uma vez por sequência; o custo
+        extra é copiar o KV do lote a cada passo.
+        """
+        states: list[_CpuState] = [seq.state for seq in seqs]
+        longest = max(st.length for st in states)
+        layers = []
+        for layer in zip(*(st.cache.to_legacy_cache() for st in states)):
+            keys = [torch.nn.functional.pad(k, (0, 0, longest - k.shape[2], 0)) for k, _ in layer]
+            values = [torch.nn.functional.pad(v, (0, 0, longest - v.shape[2], 0)) for _, v in layer]
+            layers.append((torch.cat(keys), torch.cat(values)))
+
+        attention_mask = torch.zeros((len(seqs), longest + 1), dtype=torch.long)
+        for i, st in enumerate(states):
+            attention_mask[i, longest - st.length:] = 1
+        # Posição M-RoPE real de cada sequência (não depende do padding)
+        positions = torch.tensor([st.length + st.rope_delta for st in states], dtype=torch.long)
+        with torch.inference_mode():
+            out = self.model(
+                input_ids=torch.tensor([[t] for t in tokens]),
+                past_key_values=DynamicCache.from_legacy_cache(tuple(layers)),
+                attention_mask=attention_mask,
+                position_ids=positions.view(1, -1, 1).expand(3, -1, -1),
+                cache_position=torch.tensor([longest]),
+                use_cache=True,
+            )
+
+        # Cada sequência volta a ter o seu cache: a fatia dela, sem o padding e com o token novo
+        merged = out.past_key_values.to_legacy_cache()
+        result = []
+        for i, (seq, st) in enumerate(zip(seqs, states)):
+            start = longest - st.length
+            st.cache = DynamicCache.from_legacy_cache(
+                tuple((k[i:i + 1, :, start:], v[i:i + 1, :, start:]) for k, v in merged)
+            )
+            st.length += 1
+            result.append(self._sample(out.logits[i, -1, :], seq))
+        return result
+
+    def is_eos(self, token: int) -> bool:
+        return token in self.eos_ids
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+    def token_text(self, token: int) -> str:
+        text = self._token_text.get(token)
+        if text is None:
+            text = self._token_text[token] = self.tokenizer.decode([token])
+        return text
+
+
+def load_cpu_backend(
+    model_id: str,
+    max_tokens: int,
+    temperature: float,
+    json_early_stop: bool = True,
+    quantize: bool = True,
+    threads: int = 0,
+) -> CpuBackend:
+    """Carrega o modelo transformers em CPU (fp32 + int8 dinâmico nas Linear, ou bf16 sem quantização)."""
+    if not _HAS_TORCH_VLM:
+        raise RuntimeError("Dependências torch/transformers indisponíveis para inferência em CPU.")
+    from transformers import AutoModelForImageTextToText, AutoProcessor
+
+    # Sempre explícito: detectors/object_detection fixa o torch do processo em 1 thread para o
+    # YOLO, e os workers spawnados herdam OMP/MKL_NUM_THREADS=1 do ambiente
+    torch.set_num_threads(threads if threads > 0 else os.cpu_count() or 1)
+    processor = AutoProcessor.from_pretrained(model_id)
+    model = AutoModelForImageTextToText.from_pretrained(
+        model_id, torch_dtype=torch.float32 if quantize else torch.bfloat16
+    )
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return CpuBackend(
+        model, processor,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        json_early_stop=json_early_stop,
+    )
+
+
+BACKENDS = ("mlx", "cpu", "fake")
+
+
+def backend_available(name: str) -> bool:
+    """Se as dependências do backend estão instaladas neste ambiente."""
+    if name == "mlx":
+        return _HAS_MLX_VLM
+    if name == "cpu":
+        return _HAS_TORCH_VLM
+    return name == "fake"
+
+
+def load_backend(
+    name: str,
+    *,
+    model_id: str,
+    max_tokens: int,
+    temperature: float,
+    prefix_cache_mb: int = 0,
+    json_early_stop: bool = True,
+    draft_model_id: str | None = None,
+    draft_tokens: int = 4,
+    cpu_model_id: str | None = None,
+    cpu_quantize: bool = True,
+    cpu_threads: int = 0,
+    fake_delay_s: float = 0.0,
+    fake_step_delay_s: float = 0.0,
+) -> InferenceBackend:
+    """
+    Monta o backend pelo nome configurado (inference_backend). Como função de módulo, serve
+    de factory picklável para os workers do WorkerPool via functools.partial.
+    """
+    if name == "mlx":
+        return load_mlx_backend(
+            model_id, max_tokens, temperature, prefix_cache_mb, json_early_stop,
+            draft_model_id=draft_model_id, draft_tokens=draft_tokens,
+        )
+    if name == "cpu":
+        return load_cpu_backend(
+            cpu_model_id or model_id, max_tokens, temperature, json_early_stop,
+            quantize=cpu_quantize, threads=cpu_threads,
+        )
+    if name == "fake":
+        return FakeBackend(
+            fake_delay_s,
+            step_delay_s=fake_step_delay_s,
+            max_tokens=max_tokens,
+            prefix_cache_mb=prefix_cache_mb,
+            json_early_stop=json_early_stop,
+        )
+    raise ValueError(f"inference_backend desconhecido: {name!r} (opções: {', '.join(BACKENDS)})")
+
+
+_FAKE_CUSTOMER = {
+    "cep": "74.000-000",
+    "bairro": "SETOR CENTRAL",
+    "estado": "GO",
+    "cidade": "GOIANIA",
+    "rua": "RUA 1",
+    "numero": "100",
+    "complemento": "",
+}
+
+_FAKE_CONSUMPTION = {
+    "consumo_lista": [
+        {"mes_ano": "10/2025", "consumo": 150},
+        {"mes_ano": "09/2025", "consumo": 140},
+        {"mes_ano": "08/2025", "consumo": 160},
+    ]
+}
+
+_FAKE_FULL = {
+    "cod_cliente": "123456",
+    "conta_contrato": "",
+    "complemento": "",
+    "distribuidora": "",
+    "num_instalacao": "987654",
+    "classificacao": "",
+    "tipo_instalacao": "",
+    "tensao_nominal": "",
+    "alta_tensao": False,
+    "mes_referencia": "10/2025",
+    "valor_fatura": 123.45,
+    "vencimento": "10/11/2025",
+    "proximo_leitura": "",
+    "aliquota_icms": None,
+    "baixa_renda": False,
+    "energia_ativa_injetada": False,
+    "energia_reativa": False,
+    "orgao_publico": False,
+    "parcelamentos": False,
+    "tarifa_branca": False,
+    "ths_verde": False,
+    "faturas_venc": False,
+    "valores_em_aberto": [],
+    "nome_cliente": "CLIENTE TESTE",
+}
+
+_FAKE_EOS = -1
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Backend determinístico para testes/benchmarks sem MLX.
+    Escolhe a resposta pelo tipo de prompt (endereço, consumo ou imagem completa) e a emite
+    caractere a caractere, com latências simuladas de prefill (delay_s) e por passo de decode
+    (step_delay_s, pago uma vez por passo independentemente do tamanho do lote).
+    Com schema, caracteres que a gramática não permite são descartados (ex: cercas ```json).
+    """
+
+    name = "fake"
+    eos_ids = {_FAKE_EOS}
+
+    def __init__(
+        self,
+        delay_s: float = 0.0,
+        responses: dict[str, Any] | None = None,
+        *,
+        step_delay_s: float = 0.0,
+        max_tokens: int = 1500,
+        prefix_cache_mb: int = 0,
+        json_early_stop: bool = True,
+    ):
+        self.json_early_stop = json_early_stop
+        self.delay_s = delay_s
+        self.step_delay_s = step_delay_s
+        self.max_tokens = max_tokens
+        self.prefix_cache = PrefixCache(prefix_cache_mb * 1024 * 1024) if prefix_cache_mb > 0 else None
+        self.responses = {
+            "customer": _FAKE_CUSTOMER,
+            "consumption": _FAKE_CONSUMPTION,
+            "full": _FAKE_FULL,
+            "crops": {**_FAKE_CUSTOMER, **_FAKE_CONSUMPTION},
+        }
+        if responses:
+            self.responses.update(responses)
+        self.calls = 0
+
+    @staticmethod
+    def classify_prompt(prompt: str) -> str:
+        if "DUAS imagens" in prompt:
+            return "crops"
+        if "APENAS dados de consumo" in prompt:
+            return "consumption"
+        if "APENAS o endereço do cliente" in prompt:
+            return "customer"
+        return "full"
+
+    def response_for(self, prompt: str) -> str:
+        payload = self.responses[self.classify_prompt(prompt)]
+        return payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+
+    def prefill(self, seq: Sequence) -> int:
+        self.calls += 1
+        if seq.prefix and seq.prefix_key is not None and self.prefix_cache is not None:
+            if self.prefix_cache.get(seq.prefix_key) is None:
+                self.prefix_cache.put(seq.prefix_key, seq.prefix, len(seq.prefix.encode("utf-8")))
+        if self.delay_s > 0:
+            time.sleep(self.delay_s)
+        seq.state = [self.response_for(seq.prefix + seq.prompt), 0]
+        return self._next(seq)
+
+    def _next(self, seq: Sequence) -> int:
+        text, pos = seq.state
+        allowed = seq.constraint.allowed() if seq.constraint is not None else None
+        while pos < len(text):
+            token = ord(text[pos])
+            pos += 1
+            if allowed is None or token in allowed:
+                seq.state[1] = pos
+                return token
+        seq.state[1] = pos
+        return _FAKE_EOS
+
+    def decode_step(self, seqs: list[Sequence], tokens: list[int]) -> list[int]:
+        if self.step_delay_s > 0:
+            time.sleep(self.step_delay_s)
+        return [self._next(seq) for seq in seqs]
+
+    def is_eos(self, token: int) -> bool:
+        return token == _FAKE_EOS
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return "".join(chr(t) for t in tokens)
+
+    def token_text(self, token: int) -> str:
+        return chr(token)
+
+    def vocabulary(self) -> list[tuple[int, str]]:
+        return [(c, chr(c)) for c in [9, 10, 13, *range(0x20, 0x250)]]
+
+    def _mask_array(self, ids: list[int]) -> Any:
+        return frozenset(ids)
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import dataclass, field
+from typing import Any
+
+from inference.backends import ImageInput, InferenceBackend, Sequence
+
+
+@dataclass
+class _Job:
+    future: Future
+    image: ImageInput
+    prompt: str
+    prefix: str = ""
+    prefix_key: tuple | None = None
+    schema: dict[str, Any] | None = None
+    kind: str | None = None
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class BatchScheduler:
+    """
+    Continuous batching na frente do backend.
+
+    Jobs pendentes entram no lote entre dois passos de decode (após uma janela curta de
+    espera quando o lote está vazio), todas as sequências ativas avançam juntas em cada
+    decode_step, e cada uma sai do lote assim que termina, liberando a vaga para o próximo job.
+
+    O future de um job fica pendente até o resultado: cancelá-lo (timeout ou cliente que
+    desistiu) tira a sequência do lote antes do próximo passo. Erro de um job (schema, máscara,
+    tokenizer) falha só aquele job; se o loop morrer, todos os futures pendentes falham.
+    """
+
+    def __init__(self, backend: InferenceBackend, *, max_batch_size: int, wait_ms: float):
+        self.backend = backend
+        self.max_batch_size = max(1, max_batch_size)
+        self.wait_s = max(0.0, wait_ms) / 1000.0
+
+        self._lock = threading.Lock()
+        self._steps = 0
+        self._occupancy_sum = 0
+        self._occupancy_max = 0
+        self._occupancy_hist = [0] * (self.max_batch_size + 1)
+        self._tokens = 0
+        self._decode_s = 0.0
+        self._active = 0
+        self._cancelled = 0
+        self._stopped = False
+
+    def enqueue(self, jobs: queue.Queue, job: _Job) -> None:
+        """Põe o job na fila do loop; com o loop encerrado, falha o job na hora."""
+        with self._lock:
+            if not self._stopped:
+                jobs.put(job)
+                return
+        _fail(job.future, RuntimeError("engine de inferência encerrado"))
+
+    def _release(self, seq: Sequence) -> None:
+        try:
+            self.backend.release(seq)
+        except Exception:
+            pass
+
+    def _admit(self, jobs: queue.Queue, active: list[tuple[_Job, Sequence, int]]) -> None:
+        free = self.max_batch_size - len(active)
+        if free <= 0:
+            return
+
+        admitted: list[_Job] = []
+        if not active:
+            # Lote vazio: bloqueia até chegar um job e espera a janela para agrupar mais
+            job = jobs.get()
+            if job is None:
+                raise _Stop
+            admitted.append(job)
+            deadline = time.perf_counter() + self.wait_s
+            while len(admitted) < free:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    job = jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    jobs.put(None)
+                    break
+                admitted.append(job)
+        else:
+            # Lote em andamento: só pega o que já está na fila, sem atrasar o próximo passo
+            while len(admitted) < free:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    jobs.put(None)
+                    break
+                admitted.append(job)
+
+        for job in admitted:
+            if job.future.cancelled():
+                self._count_cancelled()
+                continue
+            seq = None
+            try:
+                seq = self.backend.new_sequence(
+                    job.image, job.prompt, job.prefix, job.prefix_key, job.schema, job.kind
+                )
+                token = self.backend.prefill(seq)
+                done = self.backend.advance(seq, token)
+            except Exception as e:
+                if seq is not None:
+                    self._release(seq)
+                _fail(job.future, e)
+                continue
+            if done:
+                self._finish(job, seq)
+            else:
+                active.append((job, seq, token))
+
+    def _finish(self, job: _Job, seq: Sequence) -> None:
+        try:
+            output = self.backend.output(seq)
+        except Exception as e:
+            _fail(job.future, e)
+        else:
+            _resolve(job.future, output)
+        finally:
+            self._release(seq)
+
+    def _drop_cancelled(self, active: list[tuple[_Job, Sequence, int]]) -> list[tuple[_Job, Sequence, int]]:
+        still = []
+        for job, seq, token in active:
+            if job.future.cancelled():
+                self._release(seq)
+                self._count_cancelled()
+            else:
+                still.append((job, seq, token))
+        return still
+
+    def _count_cancelled(self) -> None:
+        with self._lock:
+            self._cancelled += 1
+
+    def run_forever(self, jobs: queue.Queue) -> None:
+        """Loop do thread do engine; termina ao receber None na fila."""
+        active: list[tuple[_Job, Sequence, int]] = []
+        try:
+            self._loop(jobs, active)
+        finally:
+            # Último recurso (saída normal ou exceção inesperada): nenhum future fica sem resposta
+            with self._lock:
+                self._stopped = True
+                self._active = 0
+            error = RuntimeError("engine de inferência encerrado")
+            for job, seq, _ in active:
+                self._release(seq)
+                _fail(job.future, error)
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    _fail(job.future, error)
+
+    def _loop(self, jobs: queue.Queue, active: list[tuple[_Job, Sequence, int]]) -> None:
+        while True:
+            try:
+                self._admit(jobs, active)
+            except _Stop:
+                return
+            # Jobs cancelados (timeout, cliente desistiu) liberam a vaga antes do próximo passo
+            active[:] = self._drop_cancelled(active)
+            if not active:
+                with self._lock:
+                    self._active = 0
+                continue
+
+            t0 = time.perf_counter()
+            seqs = [seq for _, seq, _ in active]
+            try:
+                next_tokens = self.backend.decode_step(seqs, [tok for _, _, tok in active])
+            except Exception as e:
+                for job, seq, _ in active:
+                    self._release(seq)
+                    _fail(job.future, e)
+                active.clear()
+                continue
+            elapsed = time.perf_counter() - t0
+
+            n = len(active)
+            with self._lock:
+                self._steps += 1
+                self._occupancy_sum += n
+                self._occupancy_max = max(self._occupancy_max, n)
+                self._occupancy_hist[n] += 1
+                self._tokens += n
+                self._decode_s += elapsed
+
+            still: list[tuple[_Job, Sequence, int]] = []
+            for (job, seq, _), token in zip(active, next_tokens):
+                try:
+                    done = self.backend.advance(seq, token)
+                except Exception as e:
+                    self._release(seq)
+                    _fail(job.future, e)
+                    continue
+                if done:
+                    self._finish(job, seq)
+                else:
+                    still.append((job, seq, token))
+            active[:] = still
+            with self._lock:
+                self._active = len(active)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            steps = self._steps
+            return {
+                "max_batch_size": self.max_batch_size,
+                "wait_ms": int(self.wait_s * 1000),
+                "active": self._active,
+                "cancelled": self._cancelled,
+                "steps": steps,
+                "occupancy_avg": round(self._occupancy_sum / steps, 2) if steps else 0.0,
+                "occupancy_max": self._occupancy_max,
+                "occupancy_hist": {str(i): c for i, c in enumerate(self._occupancy_hist) if i and c},
+                "decoded_tokens": self._tokens,
+                "decode_tokens_per_s": round(self._tokens / self._decode_s, 1) if self._decode_s else 0.0,
+            }
+
+
+class _Stop(Exception):
+    pass
+
+
+def _resolve(fut: Future, output: Any) -> None:
+    # O future pode ter sido cancelado entre a checagem e o resultado
+    try:
+        fut.set_result(output)
+    except InvalidStateError:
+        pass
+
+
+def _fail(fut: Future, error: BaseException) -> None:
+    try:
+        fut.set_exception(error)
+    except InvalidStateError:
+        pass
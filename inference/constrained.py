@@ -0,0 +1,397 @@
+from __future__ import annotations
+
+import json
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_WS = " \t\n\r"
+_DIGITS = "0123456789"
+_HEX = "0123456789abcdefABCDEF"
+_NUM_END = frozenset({"0", "i", "f", "x"})
+# Limite superior para pular todos os tokens com um prefixo na lista ordenada
+_MAX_CHAR = "\U0010ffff"
+# Topo da pilha dentro de uma string JSON, fora de escape
+_IN_STRING = ("S", 0)
+_SPECIAL_RE = re.compile(r'["\\\x00-\x1f]')
+
+
+class JsonSchemaGrammar:
+    """
+    Autômato de pilha, caractere a caractere, para o subconjunto de JSON Schema dos prompts.
+
+    Suporta object (properties na ordem declarada, todas obrigatórias), array (items, maxItems),
+    string, number, integer, boolean, null e listas de tipos (ex: ["string", "null"]).
+    O estado é uma tupla imutável (pilha, espaços seguidos) e pode ser usado como chave de cache.
+    """
+
+    def __init__(self, schema: dict[str, Any], *, max_ws: int = 16):
+        self.max_ws = max_ws
+        self._nodes: list[tuple[str, Any]] = []
+        self._root = self._compile(schema)
+
+    def _add(self, kind: str, data: Any = None) -> int:
+        self._nodes.append((kind, data))
+        return len(self._nodes) - 1
+
+    def _compile(self, schema: dict[str, Any]) -> int:
+        types = schema.get("type")
+        if isinstance(types, list):
+            if len(types) == 1:
+                return self._compile({**schema, "type": types[0]})
+            return self._add("union", tuple(self._compile({**schema, "type": t}) for t in types))
+        if types == "object":
+            props = tuple((k, self._compile(v)) for k, v in schema.get("properties", {}).items())
+            return self._add("object", props)
+        if types == "array":
+            return self._add("array", (self._compile(schema.get("items", {})), schema.get("maxItems")))
+        if types in ("string", "number", "integer", "boolean", "null"):
+            return self._add(types)
+        raise ValueError(f"tipo de schema não suportado na decodificação restrita: {types!r}")
+
+    @property
+    def initial(self) -> tuple:
+        return ((("V", self._root),), 0)
+
+    @staticmethod
+    def is_complete(state: tuple) -> bool:
+        return not state[0]
+
+    def feed(self, state: tuple | None, text: str) -> tuple | None:
+        """Consome um trecho; retorna o novo estado ou None se o trecho viola o schema."""
+        for ch in text:
+            if state is None:
+                return None
+            state = self.step(state, ch)
+        return state
+
+    def step(self, state: tuple, ch: str) -> tuple | None:
+        stack, ws = state
+        # Número termina no primeiro caractere que não o continua; esse caractere vai para o frame de baixo
+        while stack and stack[-1][0] == "N":
+            nxt = _number_step(stack[-1], ch)
+            if nxt is not None:
+                return (stack[:-1] + (nxt,), 0)
+            if stack[-1][1] not in _NUM_END:
+                return None
+            stack = stack[:-1]
+
+        if stack and stack[-1][0] not in "SL" and ch in _WS:
+            if ws >= self.max_ws:
+                return None
+            return (stack, ws + 1)
+        stack = self._consume(stack, ch)
+        return None if stack is None else (stack, 0)
+
+    def _consume(self, stack: tuple, ch: str) -> tuple | None:
+        if not stack:
+            return None
+        top = stack[-1]
+        rest = stack[:-1]
+        kind = top[0]
+
+        if kind == "S":
+            k = top[1]
+            if k == 0:
+                if ch == '"':
+                    return rest
+                if ch == "\\":
+                    return rest + (("S", 1),)
+                return None if ord(ch) < 0x20 else stack
+            if k == 1:
+                if ch in '"\\/bfnrt':
+                    return rest + (("S", 0),)
+                return rest + (("S", 2),) if ch == "u" else None
+            if ch not in _HEX:
+                return None
+            return rest + (("S", k + 1 if k < 5 else 0),)
+
+        if kind == "L":
+            _, text, pos = top
+            if ch != text[pos]:
+                return None
+            return rest if pos + 1 == len(text) else rest + (("L", text, pos + 1),)
+
+        if kind == "V":
+            frames = self._start(top[1], ch)
+            return None if frames is None else rest + frames
+
+        if kind == "O":
+            _, nid, idx, phase = top
+            props = self._nodes[nid][1]
+            if phase == "k":
+                if ch == "}" and not props:
+                    return rest
+                if ch == '"' and idx < len(props):
+                    return rest + (("O", nid, idx, "c"), ("L", props[idx][0] + '"', 0))
+                return None
+            if phase == "c":
+                return rest + (("O", nid, idx, "s"), ("V", props[idx][1])) if ch == ":" else None
+            if ch == "," and idx + 1 < len(props):
+                return rest + (("O", nid, idx + 1, "k"),)
+            if ch == "}" and idx + 1 == len(props):
+                return rest
+            return None
+
+        if kind == "A":
+            _, nid, count, phase = top
+            item, max_items = self._nodes[nid][1]
+            if phase in "fs" and ch == "]":
+                return rest
+            if phase == "s":
+                if ch == "," and (max_items is None or count < max_items):
+                    return rest + (("A", nid, count, "v"),)
+                return None
+            if phase == "f" and max_items == 0:
+                return None
+            frames = self._start(item, ch)
+            if frames is None:
+                return None
+            # Sem maxItems a contagem não muda nada: mantê-la em 0 faz os itens repetirem estados
+            count = count + 1 if max_items is not None else 0
+            return rest + (("A", nid, count, "s"),) + frames
+
+        return None
+
+    def _start(self, nid: int, ch: str) -> tuple | None:
+        """Frames que iniciam um valor do nó nid a partir do primeiro caractere."""
+        kind, data = self._nodes[nid]
+        if kind == "union":
+            for sub in data:
+                frames = self._start(sub, ch)
+                if frames is not None:
+                    return frames
+            return None
+        if kind == "string":
+            return (("S", 0),) if ch == '"' else None
+        if kind in ("number", "integer"):
+            int_only = kind == "integer"
+            if ch == "-":
+                return (("N", "-", int_only),)
+            if ch == "0":
+                return (("N", "0", int_only),)
+            return (("N", "i", int_only),) if ch in _DIGITS else None
+        if kind == "boolean":
+            if ch == "t":
+                return (("L", "rue", 0),)
+            return (("L", "alse", 0),) if ch == "f" else None
+        if kind == "null":
+            return (("L", "ull", 0),) if ch == "n" else None
+        if kind == "object":
+            return (("O", nid, 0, "k"),) if ch == "{" else None
+        if kind == "array":
+            return (("A", nid, 0, "f"),) if ch == "[" else None
+        return None
+
+
+def _number_step(frame: tuple, ch: str) -> tuple | None:
+    _, phase, int_only = frame
+    digit = ch in _DIGITS
+    if phase == "-":
+        if ch == "0":
+            return ("N", "0", int_only)
+        return ("N", "i", int_only) if digit else None
+    if phase in ("0", "i"):
+        if digit and phase == "i":
+            return frame
+        if int_only:
+            return None
+        if ch == ".":
+            return ("N", ".", int_only)
+        return ("N", "e", int_only) if ch in "eE" else None
+    if phase in (".", "f"):
+        if digit:
+            return ("N", "f", int_only)
+        return ("N", "e", int_only) if phase == "f" and ch in "eE" else None
+    if phase == "e":
+        if ch in "+-":
+            return ("N", "s", int_only)
+        return ("N", "x", int_only) if digit else None
+    if phase in ("s", "x"):
+        return ("N", "x", int_only) if digit else None
+    return None
+
+
+class TokenVocabulary:
+    """
+    Texto de cada token do tokenizer, ordenado para percorrer prefixos compartilhados de uma vez.
+
+    Tokens "simples" (sem aspas, barra invertida ou caracteres de controle) são sempre válidos
+    dentro de uma string JSON e ficam numa lista à parte para não serem reavaliados um a um.
+    Dentro de uma string, o prefixo simples de um token especial também não muda o estado:
+    os especiais ficam agrupados pelo sufixo a partir do primeiro caractere não simples
+    (ex: 'valor",' -> '",'), e só os sufixos distintos são percorridos.
+    last_special guarda, por token, a posição do último caractere não simples (-1 se nenhum):
+    ao abrir uma string, a faixa de tokens com o mesmo prefixo e só caracteres simples depois
+    dele é aceita inteira, sem percorrer caractere a caractere.
+    """
+
+    def __init__(self, tokens: list[tuple[int, str]]):
+        ordered = sorted((text, tid) for tid, text in tokens if text)
+        self.texts = [t for t, _ in ordered]
+        self.ids = [i for _, i in ordered]
+        self.last_special = [_last_special(t) for t in self.texts]
+        self.plain_ids: list[int] = []
+        groups: dict[str, list[int]] = {}
+        for text, tid, last in zip(self.texts, self.ids, self.last_special):
+            if last < 0:
+                self.plain_ids.append(tid)
+                continue
+            groups.setdefault(text[_SPECIAL_RE.search(text).start():], []).append(tid)
+        self.suffix_texts = sorted(groups)
+        self.suffix_ids = [groups[t] for t in self.suffix_texts]
+        self.suffix_last = [_last_special(t) for t in self.suffix_texts]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+
+def _last_special(text: str) -> int:
+    found = -1
+    for m in _SPECIAL_RE.finditer(text):
+        found = m.start()
+    return found
+
+
+class GrammarMasker:
+    """
+    Conjunto de tokens permitidos por estado do autômato (a gramática no nível de token).
+
+    Os conjuntos são calculados sob demanda e memorizados por estado (LRU de max_states);
+    to_array converte a lista de ids para o formato do backend (ex: mx.array) uma única vez
+    por estado.
+    """
+
+    def __init__(
+        self,
+        grammar: JsonSchemaGrammar,
+        vocab: TokenVocabulary,
+        eos_ids: list[int],
+        *,
+        to_array: Callable[[list[int]], Any] = list,
+        max_states: int = 4096,
+    ):
+        self.grammar = grammar
+        self.vocab = vocab
+        self.max_states = max_states
+        self._to_array = to_array
+        self._eos = to_array(sorted(eos_ids))
+        self._cache: OrderedDict[Hashable, Any] = OrderedDict()
+        self.computed = 0
+
+    def allowed(self, state: tuple | None) -> Any:
+        """Tokens permitidos no estado; None (sem restrição) se a sequência já saiu da gramática."""
+        if state is None:
+            return None
+        if self.grammar.is_complete(state):
+            return self._eos
+        cached = self._cache.get(state)
+        if cached is not None:
+            self._cache.move_to_end(state)
+            return cached
+        vocab = self.vocab
+        if state[0][-1] == _IN_STRING:
+            ids = list(vocab.plain_ids)
+            for i in self._walk(state, vocab.suffix_texts, vocab.suffix_last):
+                ids.extend(vocab.suffix_ids[i])
+        else:
+            ids = [vocab.ids[i] for i in self._walk(state, vocab.texts, vocab.last_special)]
+        # Vocabulário sem saída válida: libera o EOS e deixa o fallback de parse decidir
+        value = self._to_array(ids) if ids else self._eos
+        self._cache[state] = value
+        if len(self._cache) > self.max_states:
+            self._cache.popitem(last=False)
+        self.computed += 1
+        return value
+
+    def _walk(self, state: tuple, texts: list[str], last_special: list[int]) -> list[int]:
+        """
+        Índices (em texts) dos tokens válidos a partir do estado, testados em ordem lexicográfica
+        reaproveitando o estado do prefixo comum.
+        """
+        step = self.grammar.step
+        out: list[int] = []
+        states = [state]
+        prev = ""
+        i, n = 0, len(texts)
+        while i < n:
+            text = texts[i]
+            k, lim = 0, min(len(prev), len(text), len(states) - 1)
+            while k < lim and prev[k] == text[k]:
+                k += 1
+            del states[k + 1:]
+            st = states[k]
+            plain_run = False
+            while k < len(text):
+                before = st
+                st = step(st, text[k])
+                if st is None:
+                    break
+                states.append(st)
+                k += 1
+                if st[0] and st[0][-1] == _IN_STRING and before[0][-1] != _IN_STRING:
+                    # String recém-aberta: caracteres simples não mudam o estado, então cada
+                    # token com este prefixo só é testado a partir do próximo caractere especial
+                    end = bisect_left(texts, text[:k] + _MAX_CHAR, i + 1)
+                    out.extend(self._in_string(st, k, texts, last_special, i, end))
+                    prev = text[:k]
+                    i = end
+                    plain_run = True
+                    break
+            if plain_run:
+                continue
+            if st is None:
+                # Nenhum token com este prefixo pode ser válido
+                dead = text[: k + 1]
+                prev = text[:k]
+                i = bisect_left(texts, dead + _MAX_CHAR, i + 1)
+                continue
+            out.append(i)
+            prev = text
+            i += 1
+        return out
+
+    def _in_string(
+        self, state: tuple, k: int, texts: list[str], last_special: list[int], lo: int, hi: int
+    ) -> list[int] | range:
+        """Tokens texts[lo:hi], que compartilham os k primeiros caracteres, válidos dentro da string."""
+        if max(last_special[lo:hi]) < k:
+            return range(lo, hi)
+        feed = self.grammar.feed
+        out = []
+        for i in range(lo, hi):
+            if last_special[i] < k:
+                out.append(i)
+                continue
+            text = texts[i]
+            if feed(state, text[_SPECIAL_RE.search(text, k).start():]) is not None:
+                out.append(i)
+        return out
+
+
+class SchemaConstraint:
+    """Cursor de uma sequência na gramática: tokens permitidos no passo atual e avanço por token."""
+
+    __slots__ = ("masker", "state")
+
+    def __init__(self, masker: GrammarMasker):
+        self.masker = masker
+        self.state: tuple | None = masker.grammar.initial
+
+    @property
+    def complete(self) -> bool:
+        return self.state is not None and self.masker.grammar.is_complete(self.state)
+
+    def allowed(self) -> Any:
+        # Fora da gramática (estado None) a geração segue sem restrição
+        return self.masker.allowed(self.state)
+
+    def advance(self, text: str) -> None:
+        if self.state is not None:
+            self.state = self.masker.grammar.feed(self.state, text)
+
+
+def schema_key(schema: dict[str, Any]) -> str:
+    # A ordem das properties faz parte da gramática, então a chave não ordena as chaves
+    return json.dumps(schema, ensure_ascii=False)
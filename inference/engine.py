@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from inference.backends import GenerationOutput, ImageInput, InferenceBackend
+from inference.batching import BatchScheduler, _Job
+
+
+class InferenceEngine:
+    """
+    Serve todas as gerações a partir de um modelo residente.
+
+    As chamadas rodam num único thread dedicado: o modelo é carregado uma vez no boot e o
+    thread do event loop nunca bloqueia na geração. Com max_batch_size > 1 esse thread roda
+    o BatchScheduler (continuous batching); caso contrário atende um job por vez.
+    """
+
+    def __init__(
+        self,
+        backend: InferenceBackend,
+        name: str = "vlm-engine",
+        *,
+        max_batch_size: int = 1,
+        batch_wait_ms: float = 0.0,
+    ):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._calls = 0
+        self._errors = 0
+        self._busy_s = 0.0
+        self._tokens = 0
+        self._early_stops = 0
+        self._tokens_saved = 0
+
+        self.scheduler: BatchScheduler | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        if max_batch_size > 1:
+            self.scheduler = BatchScheduler(backend, max_batch_size=max_batch_size, wait_ms=batch_wait_ms)
+            self._jobs: queue.Queue = queue.Queue()
+            self._thread = threading.Thread(
+                target=self.scheduler.run_forever, args=(self._jobs,), name=name, daemon=True
+            )
+            self._thread.start()
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def submit(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> Future:
+        with self._lock:
+            self._pending += 1
+        if self.scheduler is None:
+            return self._executor.submit(self._run, image, prompt, prefix, prefix_key, schema, kind)
+
+        fut: Future = Future()
+        t0 = time.perf_counter()
+        fut.add_done_callback(lambda f: self._account_future(t0, f))
+        self.scheduler.enqueue(self._jobs, _Job(fut, image, prompt, prefix, prefix_key, schema, kind))
+        return fut
+
+    async def infer(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> GenerationOutput:
+        return await asyncio.wrap_future(self.submit(image, prompt, prefix, prefix_key, schema, kind))
+
+    def _run(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str,
+        prefix_key: tuple | None,
+        schema: dict[str, Any] | None,
+        kind: str | None,
+    ) -> GenerationOutput:
+        t0 = time.perf_counter()
+        output = None
+        try:
+            output = self.backend.generate(image, prompt, prefix, prefix_key, schema, kind)
+            return output
+        finally:
+            self._account(t0, output)
+
+    def _account_future(self, t0: float, fut: Future) -> None:
+        output = None
+        if not fut.cancelled() and fut.exception() is None:
+            output = fut.result()
+        self._account(t0, output)
+
+    def _account(self, t0: float, output: GenerationOutput | None) -> None:
+        with self._lock:
+            self._pending -= 1
+            self._calls += 1
+            self._busy_s += time.perf_counter() - t0
+            if output is None:
+                self._errors += 1
+                return
+            self._tokens += output.tokens
+            if output.early_stopped:
+                self._early_stops += 1
+                self._tokens_saved += output.tokens_saved
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            out = {
+                "backend": self.backend.name,
+                "pending": self._pending,
+                "calls": self._calls,
+                "errors": self._errors,
+                "busy_ms": int(self._busy_s * 1000),
+                "generated_tokens": self._tokens,
+                "json_early_stops": self._early_stops,
+                "tokens_saved_max": self._tokens_saved,
+            }
+        if self.scheduler is not None:
+            out["batching"] = self.scheduler.stats()
+        out.update(self.backend.stats())
+        return out
+
+    def shutdown(self) -> None:
+        if self.scheduler is not None:
+            self._jobs.put(None)
+            self._thread.join()
+        else:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self.backend.close()
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+
+class JsonStopTracker:
+    """
+    Rastreia incrementalmente chaves/colchetes do texto gerado e sinaliza quando o primeiro
+    valor JSON de topo ({...} ou [...]) fecha. Texto antes do JSON (ex: ```json) é ignorado;
+    chaves dentro de strings não contam.
+    """
+
+    __slots__ = ("depth", "started", "in_string", "escape", "done", "chars")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.done = False
+        self.chars = 0
+
+    def feed(self, text: str) -> bool:
+        """Consome um trecho decodificado; retorna True quando o JSON de topo está completo."""
+        if self.done:
+            return True
+        for ch in text:
+            self.chars += 1
+            if not self.started:
+                if ch in "{[":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    return True
+        return False
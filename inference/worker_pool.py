@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from PIL import Image
+
+from inference.backends import GenerationOutput, ImageInput, InferenceBackend, speculative_summary
+
+# Metal/MLX não sobrevive a fork: os workers sempre nascem via spawn
+_CTX = mp.get_context("spawn")
+
+_STOP = None
+
+# Limites que detectors/object_detection grava no ambiente da API (YOLO em 1 thread). O spawn
+# herda o ambiente, e o modelo do worker não deve rodar preso a eles
+_THREAD_LIMIT_ENV = (
+    "OMP_NUM_THREADS",
+    "OMP_WAIT_POLICY",
+    "MKL_NUM_THREADS",
+    "MKL_DYNAMIC",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+
+
+def _current_rss_bytes() -> int | None:
+    try:
+        if os.uname().sysname == "Linux":
+            with open("/proc/self/statm", encoding="utf-8") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        import resource
+
+        # No macOS só há o pico (ru_maxrss em bytes); serve como proxy de inchaço
+        return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    except Exception:
+        return None
+
+
+def _worker_main(conn: Any, backend_factory: Callable[[], InferenceBackend], max_rss_bytes: int, max_jobs: int) -> None:
+    """Loop do processo worker: carrega o backend uma vez e atende jobs até ser reciclado."""
+    for name in _THREAD_LIMIT_ENV:
+        os.environ.pop(name, None)
+    backend = backend_factory()
+    conn.send(("ready", os.getpid()))
+    jobs = 0
+    while True:
+        try:
+            header = conn.recv()
+        except (EOFError, OSError):
+            break
+        if header is _STOP:
+            break
+
+        job_id, prompt, layouts, prefix, prefix_key, schema, kind = header
+        raws = [conn.recv_bytes() for _ in layouts]
+        try:
+            images = [Image.frombytes(mode, size, raw) for (mode, size), raw in zip(layouts, raws)]
+            del raws
+            image = images[0] if len(images) == 1 else images
+            status, value = "ok", backend.generate(image, prompt, prefix, prefix_key, schema, kind)
+        except Exception as e:
+            status, value = "error", f"{type(e).__name__}: {e}"
+        jobs += 1
+
+        rss = _current_rss_bytes()
+        recycle = (max_rss_bytes > 0 and rss is not None and rss > max_rss_bytes) or (
+            max_jobs > 0 and jobs >= max_jobs
+        )
+        conn.send((job_id, status, value, rss, recycle, backend.stats()))
+        if recycle:
+            break
+
+    try:
+        backend.close()
+    finally:
+        conn.close()
+
+
+class _Worker:
+    """Handle do lado da API para um processo worker (processo + ponta do Pipe)."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Any = None
+        self.conn: Any = None
+        self.jobs = 0
+        self.restarts = 0
+        self.last_rss: int | None = None
+        self.backend_stats: dict[str, Any] = {}
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class WorkerPool:
+    """
+    Pool de processos de inferência pré-iniciados, cada um com o modelo residente.
+
+    Expõe a mesma interface do InferenceEngine (submit/infer/stats/shutdown). Os jobs
+    trafegam por Pipe local: cabeçalho (prompt, modo e tamanho) + bytes crus de cada imagem.
+    Workers que morrem ou passam do limite de memória são reiniciados automaticamente.
+    """
+
+    def __init__(
+        self,
+        backend_factory: Callable[[], InferenceBackend],
+        size: int,
+        *,
+        max_rss_mb: int = 0,
+        max_jobs: int = 0,
+        job_timeout_s: float = 120.0,
+        start_timeout_s: float = 600.0,
+        name: str = "vlm-pool",
+    ):
+        self.backend_factory = backend_factory
+        self.size = max(1, size)
+        self.max_rss_bytes = max(0, max_rss_mb) * 1024 * 1024
+        self.max_jobs = max(0, max_jobs)
+        self.job_timeout_s = job_timeout_s
+        self.start_timeout_s = start_timeout_s
+        self.name = name
+
+        self._jobs: queue.Queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._calls = 0
+        self._errors = 0
+        self._crashes = 0
+        self._recycles = 0
+        self._tokens = 0
+        self._early_stops = 0
+        self._tokens_saved = 0
+
+        self._workers = [_Worker(i) for i in range(self.size)]
+        for w in self._workers:
+            self._spawn(w)
+        self._threads = [
+            threading.Thread(target=self._dispatch_loop, args=(w,), name=f"{name}-{w.index}", daemon=True)
+            for w in self._workers
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _spawn(self, w: _Worker) -> None:
+        parent_conn, child_conn = _CTX.Pipe(duplex=True)
+        proc = _CTX.Process(
+            target=_worker_main,
+            args=(child_conn, self.backend_factory, self.max_rss_bytes, self.max_jobs),
+            name=f"{self.name}-worker-{w.index}",
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+        w.process, w.conn = proc, parent_conn
+
+    def _wait_ready(self, w: _Worker) -> None:
+        if not w.conn.poll(self.start_timeout_s):
+            raise RuntimeError(f"worker {w.index} não ficou pronto em {self.start_timeout_s:.0f}s")
+        msg = w.conn.recv()
+        if not (isinstance(msg, tuple) and msg and msg[0] == "ready"):
+            raise RuntimeError(f"worker {w.index} respondeu handshake inesperado: {msg!r}")
+        print(f"[pool] worker {w.index} pronto (pid={msg[1]})", flush=True)
+
+    def _restart(self, w: _Worker, reason: str) -> None:
+        print(f"[pool] reiniciando worker {w.index}: {reason}", flush=True)
+        try:
+            if w.process is not None and w.process.is_alive():
+                w.process.kill()
+            if w.process is not None:
+                w.process.join(timeout=5)
+        except Exception:
+            pass
+        try:
+            if w.conn is not None:
+                w.conn.close()
+        except Exception:
+            pass
+        w.restarts += 1
+        if not self._closed:
+            self._spawn(w)
+
+    def _dispatch_loop(self, w: _Worker) -> None:
+        ready = False
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                break
+            fut, image, prompt, prefix, prefix_key, schema, kind = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+
+            try:
+                if not ready or not w.alive:
+                    if ready:
+                        with self._lock:
+                            self._crashes += 1
+                        self._restart(w, "processo morto")
+                    self._wait_ready(w)
+                    ready = True
+
+                job_id = next(self._ids)
+                images = image if isinstance(image, list) else [image]
+                layouts = [(im.mode, im.size) for im in images]
+                w.conn.send((job_id, prompt, layouts, prefix, prefix_key, schema, kind))
+                for im in images:
+                    w.conn.send_bytes(im.tobytes())
+                if not w.conn.poll(self.job_timeout_s):
+                    raise TimeoutError(f"worker {w.index} sem resposta em {self.job_timeout_s:.0f}s")
+                rid, status, value, rss, recycle, backend_stats = w.conn.recv()
+            except Exception as e:
+                # Crash, pipe quebrado ou travamento: descarta o processo e falha só este job
+                with self._lock:
+                    self._errors += 1
+                    self._crashes += 1
+                self._restart(w, f"{type(e).__name__}: {e}")
+                ready = False
+                fut.set_exception(RuntimeError(f"falha no worker de inferência: {e}"))
+                continue
+
+            w.jobs += 1
+            w.last_rss = rss
+            w.backend_stats = backend_stats
+            with self._lock:
+                self._calls += 1
+                if status != "ok":
+                    self._errors += 1
+                else:
+                    self._tokens += value.tokens
+                    if value.early_stopped:
+                        self._early_stops += 1
+                        self._tokens_saved += value.tokens_saved
+            if status == "ok":
+                fut.set_result(value)
+            else:
+                fut.set_exception(RuntimeError(value))
+
+            if recycle:
+                with self._lock:
+                    self._recycles += 1
+                w.process.join(timeout=30)
+                self._restart(w, f"reciclagem (rss={rss}, jobs={w.jobs})")
+                ready = False
+
+    def submit(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> Future:
+        if self._closed:
+            raise RuntimeError("pool de inferência encerrado")
+        if isinstance(image, (list, tuple)):
+            image = [im if im.mode in ("RGB", "L") else im.convert("RGB") for im in image]
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        fut: Future = Future()
+        self._jobs.put((fut, image, prompt, prefix, prefix_key, schema, kind))
+        return fut
+
+    async def infer(
+        self,
+        image: ImageInput,
+        prompt: str,
+        prefix: str = "",
+        prefix_key: tuple | None = None,
+        schema: dict[str, Any] | None = None,
+        kind: str | None = None,
+    ) -> GenerationOutput:
+        return await asyncio.wrap_future(self.submit(image, prompt, prefix, prefix_key, schema, kind))
+
+    def stats(self) -> dict[str, Any]:
+        # Cada worker tem o seu cache de prefixo; os contadores são somados para a visão do pool
+        prefix_cache: dict[str, int] = {}
+        constrained: dict[str, int] = {}
+        speculative: dict[str, dict[str, float]] = {}
+        for w in self._workers:
+            for k, v in w.backend_stats.get("prefix_cache", {}).items():
+                prefix_cache[k] = prefix_cache.get(k, 0) + v
+            for k, v in w.backend_stats.get("constrained", {}).items():
+                constrained[k] = constrained.get(k, 0) + v
+            for kind, c in (w.backend_stats.get("speculative") or {}).items():
+                acc = speculative.setdefault(kind, {})
+                for k, v in c.items():
+                    if v is not None and k not in ("accept_rate", "tokens_per_round", "speedup_est"):
+                        acc[k] = acc.get(k, 0) + v
+        with self._lock:
+            return {
+                "backend": "pool",
+                "size": self.size,
+                "pending": self._jobs.qsize(),
+                "calls": self._calls,
+                "errors": self._errors,
+                "crashes": self._crashes,
+                "recycles": self._recycles,
+                "generated_tokens": self._tokens,
+                "json_early_stops": self._early_stops,
+                "tokens_saved_max": self._tokens_saved,
+                "prefix_cache": prefix_cache or None,
+                "constrained": constrained or None,
+                "speculative": {k: speculative_summary(c) for k, c in speculative.items()} or None,
+                "workers": [
+                    {
+                        "index": w.index,
+                        "pid": w.process.pid if w.process is not None else None,
+                        "alive": w.alive,
+                        "jobs": w.jobs,
+                        "restarts": w.restarts,
+                        "rss": w.last_rss,
+                    }
+                    for w in self._workers
+                ],
+            }
+
+    def shutdown(self) -> None:
+        self._closed = True
+        for _ in self._threads:
+            self._jobs.put(_STOP)
+        for t in self._threads:
+            t.join(timeout=5)
+        deadline = time.time() + 10
+        for w in self._workers:
+            try:
+                w.conn.send(_STOP)
+            except Exception:
+                pass
+            if w.process is not None:
+                w.process.join(timeout=max(0.1, deadline - time.time()))
+                if w.process.is_alive():
+                    w.process.kill()
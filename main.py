@@ -3,23 +3,37 @@ from __future__ import annotations
 import asyncio
 import datetime
 import gc
+import hashlib
 import io
 import json
 import os
 import sys
 import time
-import tempfile
-import subprocess
+import zipfile
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 from importlib.util import find_spec
 from typing import Any, Dict, Optional, Tuple
 import re
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
 from PIL import Image, ImageEnhance
 
 from config import settings
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.image_decode import decode_downscaled
+from utils.job_queue import JobError, JobRunner, JobStore, check_callback_url
+from utils.log import log
+from utils.pdf_pages import PdfError, PdfPages, is_pdf
+from utils.perceptual_hash import NearDuplicateIndex, detail_difference, detail_signature, image_hashes
+from utils.resolution_plan import fit_pixels, vision_tokens
+from utils.result_cache import ResultCache
+from utils.single_flight import SingleFlight
+from utils.stage_dag import Stage, run_dag, server_timing
+from utils.page_ranking import PAGE_KINDS, pick_pages, text_page_scores
+from utils.text_layer import TextExtraction, extract_fields, layout_rows, merge_rules
 
 # Importa detecção de objetos para recortes
 try:
@@ -32,18 +46,27 @@ except ImportError as e:
 
 _HAS_MLX_VLM = find_spec("mlx_vlm") is not None
 if _HAS_MLX_VLM:
-    from mlx_vlm import generate, load
-    from mlx_vlm.prompt_utils import apply_chat_template
+    from mlx_vlm import load
     from mlx_vlm.utils import load_config
 
+from inference.backends import ImageInput, MlxBackend, backend_available, load_backend
+from inference.engine import InferenceEngine
+from inference.worker_pool import WorkerPool
 
-app = FastAPI(title="Energy Extractor (MLX-VLM + Qwen2.5-VL)")
 
-PROMPTS_DIR = Path(settings.prompts_dir).resolve()
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    # Os loops da fila de jobs precisam do event loop do servidor
+    JOBS.start()
+    try:
+        yield
+    finally:
+        await JOBS.stop()
 
 
-def log(msg: str) -> None:
-    print(msg, flush=True)
+app = FastAPI(title="Energy Extractor (MLX-VLM + Qwen2.5-VL)", lifespan=_lifespan)
+
+PROMPTS_DIR = Path(settings.prompts_dir).resolve()
 
 
 def _key(s: str) -> str:
@@ -204,20 +227,87 @@ def _log_system_metrics(tag: str) -> None:
 
 
 MODEL = PROCESSOR = CONFIG = None
+ENGINE: InferenceEngine | WorkerPool | None = None
 OBJECT_DETECTOR = None
 
-if not _HAS_MLX_VLM:
+# Parâmetros de load_backend comuns ao pool e ao engine em thread
+_BACKEND_OPTIONS: Dict[str, Any] = {
+    "model_id": settings.model_id,
+    "max_tokens": settings.max_tokens,
+    "temperature": settings.temperature,
+    "prefix_cache_mb": settings.prefix_cache_mb,
+    "json_early_stop": settings.json_early_stop,
+    "draft_model_id": settings.draft_model_id,
+    "draft_tokens": settings.draft_tokens,
+    "cpu_model_id": settings.cpu_model_id,
+    "cpu_quantize": settings.cpu_quantize,
+    "cpu_threads": settings.cpu_threads,
+    "fake_delay_s": settings.fake_prefill_ms / 1000,
+    "fake_step_delay_s": settings.fake_step_ms / 1000,
+}
+
+if not backend_available(settings.inference_backend):
+    if settings.inference_backend == "mlx":
+        log(
+            "[boot] missing dependency: mlx-vlm (module: mlx_vlm). "
+            "Use the project venv (e.g. `uv sync` then `uv run uvicorn main:app --reload`) "
+            f"or install it into {sys.executable}. "
+            'On Linux use inference_backend="cpu".'
+        )
+    elif settings.inference_backend == "cpu":
+        log(
+            "[boot] missing dependency: torch/transformers (inference_backend=cpu). "
+            f"Install them into {sys.executable} (e.g. `uv pip install torch transformers accelerate`)."
+        )
+    else:
+        log(f"[boot] inference_backend desconhecido: {settings.inference_backend!r} (opções: mlx, cpu, fake)")
+elif settings.inference_mode == "process":
+    # Cada worker carrega o modelo uma única vez; o processo da API não carrega nada
     log(
-        "[boot] missing dependency: mlx-vlm (module: mlx_vlm). "
-        "Use the project venv (e.g. `uv sync` then `uv run uvicorn main:app --reload`) "
-        f"or install it into {sys.executable}."
+        f"[boot] iniciando pool de {settings.max_concurrency} workers de inferência "
+        f"({settings.inference_backend}): {settings.model_id}"
     )
+    ENGINE = WorkerPool(
+        partial(load_backend, settings.inference_backend, **_BACKEND_OPTIONS),
+        size=settings.max_concurrency,
+        max_rss_mb=settings.worker_max_rss_mb,
+        max_jobs=settings.worker_max_jobs,
+        job_timeout_s=settings.request_timeout_s * 2,
+    )
+elif settings.inference_backend != "mlx":
+    log(f"[boot] carregando backend {settings.inference_backend}")
+    ENGINE = InferenceEngine(
+        load_backend(settings.inference_backend, **_BACKEND_OPTIONS),
+        max_batch_size=settings.batch_max_size,
+        batch_wait_ms=settings.batch_wait_ms,
+    )
+    log(f"[boot] backend {settings.inference_backend} pronto")
+    _log_system_metrics("[boot][mem]")
 else:
     log(f"[boot] loading model: {settings.model_id}")
     MODEL, PROCESSOR = load(settings.model_id)
     CONFIG = load_config(settings.model_id)
     log("[boot] model loaded")
+    DRAFT = None
+    if settings.draft_model_id:
+        log(f"[boot] loading draft model: {settings.draft_model_id}")
+        draft_model, draft_processor = load(settings.draft_model_id)
+        DRAFT = (draft_model, draft_processor, load_config(settings.draft_model_id))
     _log_system_metrics("[boot][mem]")
+    # Todas as inferências passam pelo engine, que reutiliza o modelo carregado acima
+    ENGINE = InferenceEngine(
+        MlxBackend(
+            MODEL, PROCESSOR, CONFIG,
+            max_tokens=settings.max_tokens,
+            temperature=settings.temperature,
+            prefix_cache_mb=settings.prefix_cache_mb,
+            json_early_stop=settings.json_early_stop,
+            draft=DRAFT,
+            draft_tokens=settings.draft_tokens,
+        ),
+        max_batch_size=settings.batch_max_size,
+        batch_wait_ms=settings.batch_wait_ms,
+    )
 
 # Inicializa detector de objetos para recortes (lazy loading - não pré-carrega modelos)
 if _HAS_OBJECT_DETECTION:
@@ -233,18 +323,55 @@ if _HAS_OBJECT_DETECTION:
         OBJECT_DETECTOR = None
 
 
-# Semáforo para controlar concorrência dentro do mesmo worker
-# Com múltiplos workers, cada worker tem seu próprio modelo e processa independentemente
-_GATE = asyncio.Semaphore(settings.max_concurrency)
+# Resultados por conteúdo: reenvios da mesma fatura não repetem YOLO nem as gerações
+RESULT_CACHE: ResultCache | None = None
+if settings.result_cache_mb > 0 or (settings.result_cache_dir and settings.result_cache_disk_mb > 0):
+    RESULT_CACHE = ResultCache(
+        settings.result_cache_mb * 1024 * 1024,
+        disk_dir=settings.result_cache_dir,
+        max_disk_bytes=settings.result_cache_disk_mb * 1024 * 1024,
+    )
+# Extrações idênticas em andamento (mesmos bytes + concessionaria + uf) são compartilhadas.
+# Com cache de resultados, uma extração sem ninguém esperando termina e abastece o cache
+# para o retry do cliente; sem cache, ela é cancelada
+_FLIGHTS = SingleFlight(cancel_orphans=RESULT_CACHE is None)
+
+# Uploads quase idênticos apontam para a chave do cache de resultados da primeira extração
+NEAR_DUP_INDEX: NearDuplicateIndex | None = None
+if RESULT_CACHE is not None and settings.near_dup_enabled:
+    NEAR_DUP_INDEX = NearDuplicateIndex(settings.near_dup_max_distance, settings.near_dup_max_entries)
+
+
+# Admissão: limita pipelines simultâneos (imagem decodificada + YOLO + gerações em memória)
+# e segura o excesso numa fila limitada por prioridade em vez de acumular tudo no processo
+ADMISSION = AdmissionController(
+    settings.admission_max_active or settings.max_concurrency,
+    settings.admission_max_queue,
+    queue_timeout_s=settings.admission_queue_timeout_s,
+)
+_PRIORITY_NAMES = {"low": -1, "normal": 0, "high": 1}
+
+
+def _request_priority(value: str | None) -> int:
+    """Prioridade do header (inteiro, ou low/normal/high); ausente ou inválida = 0."""
+    if not value:
+        return 0
+    value = value.strip().lower()
+    if value in _PRIORITY_NAMES:
+        return _PRIORITY_NAMES[value]
+    try:
+        return max(-100, min(100, int(value)))
+    except ValueError:
+        log(f"[admission] prioridade inválida ignorada: {value!r}")
+        return 0
 
 
-def _read_prompt(concessionaria: str, uf: str) -> str:
+def _resolve_prompt_paths(concessionaria: str, uf: str) -> list[Path]:
+    """Arquivos que compõem o prompt da imagem completa: base.md + spec mapeada (se houver)."""
     base_path = PROMPTS_DIR / "base.md"
     if not base_path.exists():
         raise RuntimeError(f"Arquivo {base_path.as_posix()} não encontrado.")
 
-    base = base_path.read_text(encoding="utf-8").strip()
-
     mapper = _load_prompt_map()
     prompts = mapper.get("prompts", {}) if isinstance(mapper.get("prompts", {}), dict) else {}
     aliases = mapper.get("aliases", {}) if isinstance(mapper.get("aliases", {}), dict) else {}
@@ -264,7 +391,7 @@ def _read_prompt(concessionaria: str, uf: str) -> str:
     elif isinstance(by_uf, str) and by_uf.strip():
         spec_filename = by_uf.strip()
 
-    spec = ""
+    paths = [base_path]
     if spec_filename:
         spec_path = PROMPTS_DIR / spec_filename
         if not spec_path.exists():
@@ -272,59 +399,260 @@ def _read_prompt(concessionaria: str, uf: str) -> str:
                 f"Prompt mapeado não encontrado: {spec_path.as_posix()} "
                 f"(concessionaria={concessionaria_key}, uf={uf_key})"
             )
-        spec = spec_path.read_text(encoding="utf-8").strip()
+        paths.append(spec_path)
+    return paths
+
+
+def _join_prompt_files(paths: list[Path]) -> str:
+    texts = [p.read_text(encoding="utf-8").strip() for p in paths]
+    return "\n\n".join(t for t in texts if t)
+
+
+def _read_prompt(concessionaria: str, uf: str) -> str:
+    return _join_prompt_files(_resolve_prompt_paths(concessionaria, uf))
+
+
+_PROMPT_HASH_CACHE: dict[str, tuple[int, str]] = {}
 
-    return base + ("\n\n" + spec if spec else "")
+
+def _prompt_file_hash(path: Path) -> str:
+    """sha256 do arquivo de prompt, recalculado só quando o mtime muda."""
+    st = path.stat()
+    mtime_ns = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9)
+    cached = _PROMPT_HASH_CACHE.get(path.as_posix())
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    _PROMPT_HASH_CACHE[path.as_posix()] = (mtime_ns, digest)
+    return digest
 
 
-def _save_image_temp(img: Image.Image) -> str:
-    """Salva imagem PIL em arquivo temporário para uso com modelos YOLO"""
-    temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-    temp_path = temp_file.name
-    temp_file.close()
-    img.save(temp_path, format='PNG')
-    return temp_path
+def _prompt_cache_key(paths: list[Path]) -> tuple[str, ...]:
+    """Chave do cache de prefixo: (model_id, hashes dos arquivos de prompt usados)."""
+    return (settings.model_id, *(_prompt_file_hash(p) for p in paths))
 
 
-def _load_image(raw: bytes) -> Image.Image:
+def _extraction_scope(concessionaria: str, uf: str) -> str:
     """
-    Carrega e processa imagem de forma eficiente em memória.
+    Condições de uma extração: concessionaria + uf + modelo + hashes de todos os arquivos de
+    prompt que ela pode usar (editar um prompt invalida os resultados guardados).
+    """
+    paths = _resolve_prompt_paths(concessionaria, uf) + [
+        PROMPTS_DIR / "customer_address.md",
+        PROMPTS_DIR / "consumption.md",
+        PROMPTS_DIR / "crops_combined.md",
+        PROMPTS_DIR / "text_rules.json",
+    ]
+    model_id = settings.cpu_model_id if settings.inference_backend == "cpu" else settings.model_id
+    parts = [
+        _key(concessionaria), _key(uf), model_id, f"text_layer={settings.text_layer_enabled}",
+        *(_prompt_file_hash(p) for p in paths if p.exists()),
+    ]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _result_cache_key(content_hash: str, scope: str) -> str:
+    """Chave do cache de resultados: sha256 dos bytes enviados + escopo da extração."""
+    return hashlib.sha256(f"{content_hash}\n{scope}".encode("utf-8")).hexdigest()
+
+
+def _load_image(
+    raw: bytes, pdf_password: str | None = None, page: int = 0, max_pixels: int | None = None
+) -> Image.Image:
+    """
+    Carrega e processa imagem (ou a página page de um PDF/TIFF) de forma eficiente em memória,
+    em até max_pixels (padrão settings.max_pixels).
     Redimensiona AGressivamente se necessário para evitar alocações excessivas no Metal.
     
     IMPORTANTE: Imagens grandes podem causar alocações de dezenas de GB no Metal
     durante o processamento do modelo VLM. Redimensionamos ANTES de processar.
     """
-    # Carrega imagem diretamente do bytes
-    bio = io.BytesIO(raw)
+    if is_pdf(raw):
+        return _load_pdf_page(raw, pdf_password, page, max_pixels)
+
+    # Decodifica já reduzida: JPEG usa a escala da DCT (a resolução cheia nunca é alocada)
+    img, sizes = decode_downscaled(raw, max_pixels or settings.max_pixels, page)
+    (w, h), (dw, dh), (nw, nh) = sizes["original"], sizes["decoded"], sizes["final"]
+    if (w, h) != (nw, nh):
+        log(
+            f"[img] imagem grande detectada: {w}x{h} ({w*h:,} pixels) - decodificada em {dw}x{dh}, "
+            f"redimensionada para: {nw}x{nh} ({nw*nh:,} pixels)"
+        )
+    return img
+
+
+def _load_pdf_page(raw: bytes, password: str | None, page: int = 0, max_pixels: int | None = None) -> Image.Image:
+    """Uma página do PDF, renderizada já no tamanho final (só ela é desenhada)."""
+    with PdfPages(raw, password) as pdf:
+        return _render_pdf_page(pdf, page, max_pixels or settings.max_pixels)
+
+
+def _render_pdf_page(pdf: PdfPages, page: int, max_pixels: int) -> Image.Image:
+    w, h = pdf.page_size(page)
+    img = pdf.render(page, max_pixels, settings.pdf_max_dpi)
+    log(
+        f"[img] PDF com {len(pdf)} página(s): página {page + 1} ({w:.0f}x{h:.0f}pt) "
+        f"renderizada em {img.width}x{img.height} ({img.width * img.height:,} pixels)"
+    )
+    return img
+
+
+def _format_detection_timings(timings: Dict[str, float]) -> str:
+    """Tempos do detect_regions para o log (ms por etapa: preprocess, customer, consumption, total)."""
+    return " ".join(f"{name}={ms:.1f}ms" for name, ms in timings.items())
+
+
+def _cut_crop(
+    box: tuple[float, float, float, float] | None,
+    proxy: Image.Image,
+    source: Image.Image,
+    pdf: PdfPages | None,
+    page: int,
+    max_pixels: int,
+) -> Image.Image | None:
+    """
+    Recorte da caixa que o YOLO achou na prévia proxy. Em PDF, só a caixa é renderizada de
+    novo em alta (clip, até pdf_crop_max_dpi); nos demais, ela sai da fonte carregada.
+    """
+    if box is None:
+        return None
+    if pdf is not None:
+        w_pt, h_pt = pdf.page_size(page)
+        sx, sy = w_pt / proxy.width, h_pt / proxy.height
+        rect = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+        return pdf.render_clip(page, rect, max_pixels, settings.pdf_crop_max_dpi)
+    sx, sy = source.width / proxy.width, source.height / proxy.height
+    x1, y1 = max(0, int(box[0] * sx)), max(0, int(box[1] * sy))
+    x2, y2 = min(source.width, int(box[2] * sx)), min(source.height, int(box[3] * sy))
+    if x2 <= x1 or y2 <= y1:
+        return None
+    crop = source.crop((x1, y1, x2, y2))
+    fitted = fit_pixels(crop, max_pixels)
+    if fitted is not crop:
+        crop.close()
+    return fitted
+
+
+_TEXT_RULES_CACHE: tuple[int, dict[str, Any]] | None = None
+
+
+def _load_text_rules() -> dict[str, Any]:
+    """prompts/text_rules.json, relido só quando o mtime muda (como o mapper.json)."""
+    global _TEXT_RULES_CACHE
+    path = PROMPTS_DIR / "text_rules.json"
+    if not path.exists():
+        return {}
+    mtime_ns = path.stat().st_mtime_ns
+    if _TEXT_RULES_CACHE is None or _TEXT_RULES_CACHE[0] != mtime_ns:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        if not isinstance(data, dict):
+            raise RuntimeError(f"Formato inválido em {path.as_posix()}: esperado um JSON object.")
+        _TEXT_RULES_CACHE = (mtime_ns, data)
+    return _TEXT_RULES_CACHE[1]
+
+
+def _text_rules_for(concessionaria: str) -> dict[str, Any]:
+    """Regras da camada de texto da concessionária (aliases do mapper.json valem aqui também)."""
+    concessionaria_key = _key(concessionaria)
+    aliases = _load_prompt_map().get("aliases", {})
+    if isinstance(aliases, dict) and isinstance(aliases.get(concessionaria_key), str):
+        concessionaria_key = _key(aliases[concessionaria_key])
+    return merge_rules(_load_text_rules(), concessionaria_key)
+
+
+def _read_text_layer(raw: bytes, password: str | None, concessionaria: str) -> TextExtraction | None:
+    """Campos lidos da camada de texto do PDF; None se o PDF não tem texto (escaneado)."""
+    with PdfPages(raw, password) as pdf:
+        page_words = [pdf.words(i) for i in range(len(pdf))]
+    words = sum(len(w) for w in page_words)
+    if words < settings.text_layer_min_words:
+        return None
+    rows = [row for w in page_words for row in layout_rows(w)]
+    return extract_fields(rows, _text_rules_for(concessionaria), words)
+
+
+def _page_ranking_inputs(
+    raw: bytes, password: str | None, concessionaria: str
+) -> tuple[int, int, list[Image.Image], list[Dict[str, float]] | None]:
+    """
+    Insumos do ranking de páginas: (páginas consideradas, total de páginas, miniaturas para o
+    YOLO, densidade de texto por página). Documentos de uma página não geram nada.
+    """
+    side = settings.page_thumbnail_side
+    thumbs: list[Image.Image] = []
+    text_scores = None
+    if is_pdf(raw):
+        with PdfPages(raw, password) as pdf:
+            total = len(pdf)
+            pages = min(total, settings.page_ranking_max_pages)
+            if pages <= 1:
+                return pages, total, [], None
+            if settings.text_layer_enabled:
+                page_words = [pdf.words(i) for i in range(pages)]
+                if sum(len(w) for w in page_words) >= settings.text_layer_min_words:
+                    rules = _text_rules_for(concessionaria)
+                    text_scores = [text_page_scores(layout_rows(w), rules) for w in page_words]
+            if OBJECT_DETECTOR is not None:
+                thumbs = [pdf.render_thumbnail(i, side) for i in range(pages)]
+        return pages, total, thumbs, text_scores
+
+    with Image.open(io.BytesIO(raw)) as im:
+        total = getattr(im, "n_frames", 1)
+        pages = min(total, settings.page_ranking_max_pages)
+        if pages > 1 and OBJECT_DETECTOR is not None:
+            for i in range(pages):
+                im.seek(i)
+                # draft() deixa o decoder reduzir já na leitura quando o formato suporta
+                im.draft("RGB", (side, side))
+                thumb = im.convert("RGB")
+                thumb.thumbnail((side, side))
+                thumbs.append(thumb)
+    return pages, total, thumbs, None
+
+
+async def _rank_pages(raw: bytes, password: str | None, concessionaria: str) -> tuple[Dict[str, int], int]:
+    """
+    Página de cada recorte em faturas com várias páginas (PDF ou TIFF multipágina): as
+    miniaturas passam pelos dois detectores YOLO e, em PDFs nativos, a densidade de texto
+    desempata. Só as páginas escolhidas são renderizadas em resolução cheia e vão ao modelo.
+    """
+    t0 = time.time()
+    pages, total, thumbs, text_scores = await asyncio.to_thread(_page_ranking_inputs, raw, password, concessionaria)
+    if pages <= 1:
+        return dict.fromkeys(PAGE_KINDS, 0), total
+    # YOLO no mesmo thread das demais detecções (os modelos não são thread-safe)
+    detector = OBJECT_DETECTOR.score_pages(thumbs) if thumbs else None
+    for t in thumbs:
+        t.close()
+    picked = pick_pages(pages, detector, text_scores)
+    log(
+        f"[pages] {total} páginas ({pages} avaliadas em {(time.time() - t0)*1000:.1f}ms): "
+        f"cliente=página {picked['customer'] + 1}, consumo=página {picked['consumption'] + 1} "
+        f"detector={detector} texto={text_scores}"
+    )
+    return picked, total
+
+
+def _check_pdf_access(raw: bytes, password: str | None) -> None:
+    """Valida PDF e senha antes do cache: sem a senha certa, nem um resultado guardado sai."""
+    if not is_pdf(raw):
+        return
     try:
-        img = Image.open(bio).convert("RGB")
-        w, h = img.size
-        pixels = w * h
-        
-        # Log do tamanho original para debug
-        if pixels > settings.max_pixels:
-            log(f"[img] imagem grande detectada: {w}x{h} ({pixels:,} pixels) - redimensionando")
-        
-        # Redimensiona ANTES de criar cópia para economizar memória
-        if pixels > settings.max_pixels:
-            scale = (settings.max_pixels / float(pixels)) ** 0.5
-            nw, nh = max(1, int(w * scale)), max(1, int(h * scale))
-            img = img.resize((nw, nh), Image.Resampling.LANCZOS)
-            log(f"[img] redimensionada para: {nw}x{nh} ({nw*nh:,} pixels)")
-        
-        # Cria cópia final (já redimensionada se necessário)
-        img_copy = img.copy()
-        img.close()  # Fecha a imagem original
-    finally:
-        bio.close()  # Fecha o BytesIO
-    
-    return img_copy
+        PdfPages(raw, password).close()
+    except PdfError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 def _extract_json(text: str) -> Dict[str, Any] | list:
     """Extrai JSON do texto, removendo mensagens de deprecação e outros textos extras.
     Retorna dict ou list dependendo do formato do JSON encontrado."""
     text = text.strip()
+
+    # Caminho rápido: com decodificação restrita a saída já é JSON válido
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
     
     # Remove blocos markdown ```json ... ``` (faz antes de filtrar linhas)
     # Remove tanto ```json quanto ``` sozinho
@@ -512,6 +840,60 @@ def _normalize_cep(cep: str) -> str:
     return cep
 
 
+def _object_schema(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object", "properties": properties}
+
+
+_STR_OR_NULL = {"type": ["string", "null"]}
+
+# Schemas da decodificação restrita, na mesma ordem de chaves dos formatos pedidos nos prompts
+_ADDRESS_SCHEMA = _object_schema(
+    {k: {"type": "string"} for k in ["cep", "bairro", "estado", "cidade", "rua", "numero", "complemento"]}
+)
+
+_CONSUMPTION_SCHEMA = _object_schema({
+    "consumo_lista": {
+        "type": "array",
+        "maxItems": 13,
+        "items": _object_schema({"mes_ano": {"type": "string"}, "consumo": {"type": "integer"}}),
+    },
+})
+
+# Os dois recortes numa geração só (combined_crops): endereço + consumo_lista no mesmo objeto
+_CROPS_SCHEMA = _object_schema({**_ADDRESS_SCHEMA["properties"], **_CONSUMPTION_SCHEMA["properties"]})
+
+# Formato de base.md: campos ausentes podem vir null (regra "NÃO INVENTE VALORES")
+_CONTRACT_SCHEMA = _object_schema({
+    "cod_cliente": _STR_OR_NULL,
+    "conta_contrato": _STR_OR_NULL,
+    "complemento": _STR_OR_NULL,
+    "distribuidora": _STR_OR_NULL,
+    "num_instalacao": _STR_OR_NULL,
+    "classificacao": _STR_OR_NULL,
+    "tipo_instalacao": _STR_OR_NULL,
+    "tensao_nominal": _STR_OR_NULL,
+    "alta_tensao": {"type": "boolean"},
+    "mes_referencia": _STR_OR_NULL,
+    "valor_fatura": {"type": "number"},
+    "vencimento": _STR_OR_NULL,
+    "proximo_leitura": _STR_OR_NULL,
+    "aliquota_icms": {"type": ["number", "null"]},
+    "baixa_renda": {"type": "boolean"},
+    "energia_ativa_injetada": {"type": "boolean"},
+    "energia_reativa": {"type": "boolean"},
+    "orgao_publico": {"type": "boolean"},
+    "parcelamentos": {"type": "boolean"},
+    "tarifa_branca": {"type": "boolean"},
+    "ths_verde": {"type": "boolean"},
+    "faturas_venc": {"type": "boolean"},
+    "valores_em_aberto": {
+        "type": "array",
+        "items": _object_schema({"mes_ano": {"type": "string"}, "valor": {"type": "number"}}),
+    },
+    "nome_cliente": _STR_OR_NULL,
+})
+
+
 def _ensure_contract(payload: Dict[str, Any], concessionaria_input: str, uf: str = "") -> Dict[str, Any]:
     template: Dict[str, Any] = {
         "cod_cliente": "",
@@ -635,6 +1017,58 @@ def _ensure_contract(payload: Dict[str, Any], concessionaria_input: str, uf: str
     return out
 
 
+def _same_field_value(a: Any, b: Any) -> bool:
+    """Mesmo valor de campo, ignorando tipo numérico (187.79 == "187.79") e caixa/espaços."""
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        try:
+            return abs(float(a) - float(b)) < 0.005
+        except (TypeError, ValueError):
+            return False
+    if isinstance(a, str) and isinstance(b, str):
+        return a.strip().upper() == b.strip().upper()
+    return a == b
+
+
+def _confirm_near_dup(value: str, detail: bytes, text: TextExtraction | None) -> bool:
+    """
+    Confirma que o candidato do índice é a mesma fatura, não só o mesmo layout: a assinatura de
+    detalhe precisa bater e, com camada de texto, os campos lidos do texto também.
+    """
+    other = NEAR_DUP_INDEX.detail(value)
+    if other is None:
+        return False
+    diff = detail_difference(detail, other)
+    if diff > settings.near_dup_max_detail_diff:
+        log(f"[cache] candidato {value[:12]} recusado: detalhe difere ({diff} > {settings.near_dup_max_detail_diff})")
+        return False
+    if text is not None:
+        cached = RESULT_CACHE.get(value)
+        for key, v in text.values.items():
+            if key in text.constants or cached is None or key not in cached:
+                continue
+            if not _same_field_value(v, cached[key]):
+                log(f"[cache] candidato {value[:12]} recusado: {key} difere na camada de texto")
+                return False
+    return True
+
+
+def _field_provenance(before: Dict[str, Any], out: Dict[str, Any], sources: Dict[str, str]) -> Dict[str, str]:
+    """
+    Origem de cada campo da resposta: etapa do modelo (customer, consumption, crops, full),
+    camada de texto do PDF (text), regra da concessionária (rule), dados da requisição
+    (request) ou valor padrão do contrato (default).
+    """
+    origem = {k: sources.get(k, "default") for k in out}
+    # Preenchimentos feitos pelo próprio _ensure_contract
+    if not str(before.get("distribuidora") or "").strip():
+        origem["distribuidora"] = "request"
+    if out.get("estado") and out["estado"] != str(before.get("estado") or "").strip().upper():
+        origem["estado"] = "request"
+    if out.get("conta_contrato") is None and before.get("conta_contrato") is not None:
+        origem["conta_contrato"] = "rule"
+    return origem
+
+
 def _read_customer_address_prompt(concessionaria: str = "", uf: str = "") -> str:
     """Carrega prompt para extração de endereço do cliente"""
     # Retorna APENAS o prompt base de customer_address.md
@@ -670,326 +1104,467 @@ def _enhance_address_image(img: Image.Image) -> Image.Image:
         return img
 
 
-async def _infer_one(img: Image.Image, prompt_text: str) -> str:
-    if not _HAS_MLX_VLM:
-        raise RuntimeError("Dependência MLX-VLM indisponível para inferência.")
-
-    # Valida tamanho da imagem antes de processar
-    w, h = img.size
-    pixels = w * h
-    if pixels > settings.max_pixels:
-        raise ValueError(
-            f"Imagem muito grande: {w}x{h} ({pixels:,} pixels). "
-            f"Máximo permitido: {settings.max_pixels:,} pixels. "
-            f"Redimensione a imagem antes de enviar."
-        )
+def _find_balanced_json(text: str, start_char: str = '{') -> str | None:
+    """Encontra JSON completo com chaves/colchetes balanceados.
+    Se o JSON estiver incompleto (cortado), tenta fechar corretamente."""
+    if start_char == '{':
+        end_char = '}'
+        open_char, close_char = '{', '}'
+    else:
+        end_char = ']'
+        open_char, close_char = '[', ']'
     
-    log(f"[infer] processando imagem: {w}x{h} ({pixels:,} pixels)")
-
-    # Salva imagem temporariamente para subprocess
-    temp_img = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-    temp_prompt_file = None
-    try:
-        # Converte para RGB se necessário
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        img.save(temp_img.name, format='JPEG', quality=95)
-        temp_img_path = temp_img.name
+    start_pos = text.find(start_char)
+    if start_pos == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escape_next = False
+    last_valid_pos = start_pos
+    
+    for i in range(start_pos, len(text)):
+        char = text[i]
         
-        # Para prompts longos, salva em arquivo temporário para evitar problemas com shell
-        # O CLI pode ter limitações de tamanho de argumento
-        if len(prompt_text) > 8000:  # Limite conservador para argumentos de shell
-            temp_prompt_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix=".txt", encoding='utf-8')
-            temp_prompt_file.write(prompt_text)
-            temp_prompt_file.close()
-            temp_prompt_path = temp_prompt_file.name
-            use_prompt_file = True
-        else:
-            temp_prompt_path = None
-            use_prompt_file = False
-    except Exception as e:
-        if temp_img:
-            try:
-                os.unlink(temp_img.name)
-            except:
-                pass
-        raise
+        if escape_next:
+            escape_next = False
+            continue
+        
+        if char == '\\':
+            escape_next = True
+            continue
+        
+        if char == '"' and not escape_next:
+            in_string = not in_string
+            continue
+        
+        if in_string:
+            continue
+        
+        if char == open_char:
+            depth += 1
+        elif char == close_char:
+            depth -= 1
+            if depth == 0:
+                return text[start_pos:i+1]
+            elif depth > 0:
+                last_valid_pos = i
+    
+    # Se chegou ao fim e ainda tem chaves abertas, tenta fechar
+    if depth > 0:
+        # Tenta encontrar o último objeto/array válido antes do corte
+        # Procura pelo último } ou ] que fecha algo
+        potential_json = text[start_pos:last_valid_pos+1]
+        # Tenta adicionar as chaves fechadoras necessárias
+        potential_json += close_char * depth
+        try:
+            # Valida se é JSON válido
+            json.loads(potential_json)
+            return potential_json
+        except json.JSONDecodeError:
+            # Se não funcionar, retorna o que tem até o último válido
+            return text[start_pos:last_valid_pos+1] if last_valid_pos > start_pos else None
+    
+    return None
 
-    loop = asyncio.get_running_loop()
 
-    def _run() -> str:
-        try:
-            # Usa subprocess para chamar mlx_vlm.generate como processo separado
-            # Isso permite paralelismo real - cada chamada é um processo independente
-            # Usa python -m mlx_vlm.generate conforme documentação
-            # O CLI formata o prompt automaticamente, então passamos o prompt bruto
-            cmd = [
-                sys.executable, "-m", "mlx_vlm.generate",
-                "--model", settings.model_id,
-                "--max-tokens", str(settings.max_tokens),
-                "--temperature", str(settings.temperature),
-                "--verbose",
-            ]
-            
-            # Adiciona prompt: direto ou via arquivo
-            if use_prompt_file:
-                # Lê o prompt do arquivo e passa como argumento (alguns CLIs suportam @file)
-                # Mas mlx_vlm.generate não suporta @file, então vamos passar direto mesmo
-                # Se o arquivo for muito grande, pode ser necessário outra abordagem
-                with open(temp_prompt_path, 'r', encoding='utf-8') as f:
-                    prompt_content = f.read()
-                cmd.extend(["--prompt", prompt_content])
+def _clean_model_output(output: str) -> str:
+    """Isola o JSON da resposta bruta do modelo (remove markdown, tokens especiais e texto extra)."""
+    output = output.strip()
+
+    # Remove mensagens de deprecação primeiro
+    lines = output.split('\n')
+    filtered_lines = []
+    for line in lines:
+        line_lower = line.lower().strip()
+        # Pula linhas de deprecação
+        if any(x in line_lower for x in ['deprecated', 'calling', 'python -m']):
+            continue
+        filtered_lines.append(line)
+    output_cleaned = '\n'.join(filtered_lines).strip()
+    
+    # A resposta real do modelo vem após <|im_start|>assistant
+    # Procura por esse marcador e pega tudo depois
+    assistant_marker = '<|im_start|>assistant'
+    assistant_pos = output_cleaned.find(assistant_marker)
+    filtered_output = output_cleaned  # Inicialização padrão
+    
+    if assistant_pos >= 0:
+        # Pega tudo após o marcador assistant
+        response_section = output_cleaned[assistant_pos + len(assistant_marker):].strip()
+        
+        # Remove tokens de formatação restantes
+        response_section = re.sub(r'<\|[^|]+\|>', '', response_section).strip()
+        
+        # Remove delimitadores markdown primeiro (se houver)
+        # Isso ajuda a encontrar o JSON real
+        cleaned_section = re.sub(r'```json\s*', '', response_section)
+        cleaned_section = re.sub(r'\s*```', '', cleaned_section)
+        cleaned_section = cleaned_section.strip()
+        
+        # Tenta encontrar JSON completo com chaves balanceadas
+        json_start = cleaned_section.find('{')
+        if json_start != -1:
+            balanced_json = _find_balanced_json(cleaned_section[json_start:], '{')
+            if balanced_json:
+                # Valida se o JSON é válido tentando fazer parse
+                try:
+                    json.loads(balanced_json)
+                    filtered_output = balanced_json
+                except json.JSONDecodeError:
+                    # Fallback: tenta encontrar JSON válido de outra forma
+                    # Procura pelo último } que fecha o objeto principal
+                    last_brace = cleaned_section.rfind('}')
+                    if last_brace > json_start:
+                        potential_json = cleaned_section[json_start:last_brace+1]
+                        try:
+                            json.loads(potential_json)
+                            filtered_output = potential_json
+                        except json.JSONDecodeError:
+                            filtered_output = balanced_json  # Usa o que encontrou mesmo assim
+                    else:
+                        filtered_output = balanced_json
             else:
-                cmd.extend(["--prompt", prompt_text])
-            
-            cmd.extend(["--image", temp_img_path])
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=settings.request_timeout_s,
-            )
-            
-            # Log TUDO que vem do subprocess ANTES de processar
-            log(f"[infer] ========== SAÍDA COMPLETA DO SUBPROCESS ==========")
-            log(f"[infer] returncode: {result.returncode}")
-            log(f"[infer] STDOUT COMPLETO ({len(result.stdout)} chars):")
-            log(result.stdout)
-            log(f"[infer] STDERR COMPLETO ({len(result.stderr)} chars):")
-            log(result.stderr)
-            log(f"[infer] ========== FIM SAÍDA SUBPROCESS ==========")
-            
-            if result.returncode != 0:
-                error_msg = result.stderr or result.stdout or "Erro desconhecido no subprocesso"
-                log(f"[infer] erro no subprocesso (code {result.returncode}): {error_msg[:500]}")
-                raise RuntimeError(f"Falha no processamento: {error_msg[:200]}")
-            
-            output = result.stdout.strip()
-            
-            def _find_balanced_json(text: str, start_char: str = '{') -> str | None:
-                """Encontra JSON completo com chaves/colchetes balanceados.
-                Se o JSON estiver incompleto (cortado), tenta fechar corretamente."""
-                if start_char == '{':
-                    end_char = '}'
-                    open_char, close_char = '{', '}'
-                else:
-                    end_char = ']'
-                    open_char, close_char = '[', ']'
-                
-                start_pos = text.find(start_char)
-                if start_pos == -1:
-                    return None
-                
-                depth = 0
-                in_string = False
-                escape_next = False
-                last_valid_pos = start_pos
-                
-                for i in range(start_pos, len(text)):
-                    char = text[i]
-                    
-                    if escape_next:
-                        escape_next = False
-                        continue
-                    
-                    if char == '\\':
-                        escape_next = True
-                        continue
-                    
-                    if char == '"' and not escape_next:
-                        in_string = not in_string
-                        continue
-                    
-                    if in_string:
-                        continue
-                    
-                    if char == open_char:
-                        depth += 1
-                    elif char == close_char:
-                        depth -= 1
-                        if depth == 0:
-                            return text[start_pos:i+1]
-                        elif depth > 0:
-                            last_valid_pos = i
-                
-                # Se chegou ao fim e ainda tem chaves abertas, tenta fechar
-                if depth > 0:
-                    # Tenta encontrar o último objeto/array válido antes do corte
-                    # Procura pelo último } ou ] que fecha algo
-                    potential_json = text[start_pos:last_valid_pos+1]
-                    # Tenta adicionar as chaves fechadoras necessárias
-                    potential_json += close_char * depth
+                # Fallback: procura pelo último } que fecha o objeto
+                last_brace = cleaned_section.rfind('}')
+                if last_brace > json_start:
+                    potential_json = cleaned_section[json_start:last_brace+1]
                     try:
-                        # Valida se é JSON válido
                         json.loads(potential_json)
-                        return potential_json
+                        filtered_output = potential_json
                     except json.JSONDecodeError:
-                        # Se não funcionar, retorna o que tem até o último válido
-                        return text[start_pos:last_valid_pos+1] if last_valid_pos > start_pos else None
-                
-                return None
-            
-            # Remove mensagens de deprecação primeiro
-            lines = output.split('\n')
-            filtered_lines = []
-            for line in lines:
-                line_lower = line.lower().strip()
-                # Pula linhas de deprecação
-                if any(x in line_lower for x in ['deprecated', 'calling', 'python -m']):
-                    continue
-                filtered_lines.append(line)
-            output_cleaned = '\n'.join(filtered_lines).strip()
-            
-            # A resposta real do modelo vem após <|im_start|>assistant
-            # Procura por esse marcador e pega tudo depois
-            assistant_marker = '<|im_start|>assistant'
-            assistant_pos = output_cleaned.find(assistant_marker)
-            filtered_output = output_cleaned  # Inicialização padrão
-            
-            if assistant_pos >= 0:
-                # Pega tudo após o marcador assistant
-                response_section = output_cleaned[assistant_pos + len(assistant_marker):].strip()
-                
-                # Remove tokens de formatação restantes
-                response_section = re.sub(r'<\|[^|]+\|>', '', response_section).strip()
-                
-                # Remove delimitadores markdown primeiro (se houver)
-                # Isso ajuda a encontrar o JSON real
-                cleaned_section = re.sub(r'```json\s*', '', response_section)
-                cleaned_section = re.sub(r'\s*```', '', cleaned_section)
-                cleaned_section = cleaned_section.strip()
-                
-                # Tenta encontrar JSON completo com chaves balanceadas
-                json_start = cleaned_section.find('{')
-                if json_start != -1:
-                    balanced_json = _find_balanced_json(cleaned_section[json_start:], '{')
-                    if balanced_json:
-                        # Valida se o JSON é válido tentando fazer parse
-                        try:
-                            json.loads(balanced_json)
-                            filtered_output = balanced_json
-                        except json.JSONDecodeError:
-                            # Fallback: tenta encontrar JSON válido de outra forma
-                            # Procura pelo último } que fecha o objeto principal
-                            last_brace = cleaned_section.rfind('}')
-                            if last_brace > json_start:
-                                potential_json = cleaned_section[json_start:last_brace+1]
-                                try:
-                                    json.loads(potential_json)
-                                    filtered_output = potential_json
-                                except json.JSONDecodeError:
-                                    filtered_output = balanced_json  # Usa o que encontrou mesmo assim
+                        # Último recurso: tenta lista JSON
+                        list_start = cleaned_section.find('[')
+                        if list_start != -1:
+                            balanced_list = _find_balanced_json(cleaned_section[list_start:], '[')
+                            if balanced_list:
+                                filtered_output = balanced_list
                             else:
-                                filtered_output = balanced_json
-                    else:
-                        # Fallback: procura pelo último } que fecha o objeto
-                        last_brace = cleaned_section.rfind('}')
-                        if last_brace > json_start:
-                            potential_json = cleaned_section[json_start:last_brace+1]
-                            try:
-                                json.loads(potential_json)
-                                filtered_output = potential_json
-                            except json.JSONDecodeError:
-                                # Último recurso: tenta lista JSON
-                                list_start = cleaned_section.find('[')
-                                if list_start != -1:
-                                    balanced_list = _find_balanced_json(cleaned_section[list_start:], '[')
-                                    if balanced_list:
-                                        filtered_output = balanced_list
-                                    else:
-                                        filtered_output = cleaned_section
-                                else:
-                                    filtered_output = cleaned_section
+                                filtered_output = cleaned_section
                         else:
                             filtered_output = cleaned_section
                 else:
-                    # Tenta lista JSON se não encontrou objeto
-                    list_start = cleaned_section.find('[')
-                    if list_start != -1:
-                        balanced_list = _find_balanced_json(cleaned_section[list_start:], '[')
-                        if balanced_list:
-                            filtered_output = balanced_list
-                        else:
-                            filtered_output = cleaned_section
-                    else:
-                        filtered_output = cleaned_section
-                
-                filtered_output = filtered_output.strip()
-                
-                # Substitui vírgula por ponto em números (formato brasileiro)
-                filtered_output = re.sub(r'(?<=\d),(?=\d)', '.', filtered_output)
-            else:
-                # Fallback: procura pelo JSON válido no output_cleaned
-                # Remove markdown primeiro
-                cleaned_output = output_cleaned
-                cleaned_output = re.sub(r'```json\s*\n?', '', cleaned_output, flags=re.IGNORECASE | re.MULTILINE)
-                cleaned_output = re.sub(r'\n?\s*```\s*$', '', cleaned_output, flags=re.MULTILINE | re.IGNORECASE)
-                cleaned_output = cleaned_output.strip()
-                
-                # Encontra todas as posições de '{' e tenta extrair JSON completo de cada uma
-                json_candidates = []
-                pos = 0
-                while True:
-                    pos = cleaned_output.find('{', pos)
-                    if pos == -1:
-                        break
-                    balanced_json = _find_balanced_json(cleaned_output[pos:], '{')
-                    if balanced_json:
-                        # Valida se é JSON válido
-                        try:
-                            parsed = json.loads(balanced_json)
-                            json_candidates.append((pos, balanced_json, len(str(parsed))))
-                        except json.JSONDecodeError:
-                            pass
-                    pos += 1
-                
-                if json_candidates:
-                    # Para consumo, pega o primeiro JSON válido que tem consumo_lista
-                    # Não pega o maior, pois pode estar cortado ou ter múltiplas respostas
-                    for pos, json_str, size in json_candidates:
-                        try:
-                            parsed = json.loads(json_str)
-                            # Se for consumo, verifica se tem consumo_lista válida
-                            if isinstance(parsed, dict) and 'consumo_lista' in parsed:
-                                consumo_lista = parsed.get('consumo_lista', [])
-                                if isinstance(consumo_lista, list) and len(consumo_lista) <= 13:
-                                    filtered_output = json_str
-                                    break
-                        except json.JSONDecodeError:
-                            continue
-                    else:
-                        # Se não encontrou um JSON válido com consumo_lista, pega o primeiro válido
-                        _, filtered_output, _ = json_candidates[0]
-                    
-                    # Remove delimitadores markdown se houver (já removido, mas garante)
-                    filtered_output = re.sub(r'^```json\s*', '', filtered_output, flags=re.MULTILINE)
-                    filtered_output = re.sub(r'\s*```$', '', filtered_output, flags=re.MULTILINE)
-                    filtered_output = filtered_output.strip()
-                    # Substitui vírgula por ponto em números
-                    filtered_output = re.sub(r'(?<=\d),(?=\d)', '.', filtered_output)
+                    filtered_output = cleaned_section
+        else:
+            # Tenta lista JSON se não encontrou objeto
+            list_start = cleaned_section.find('[')
+            if list_start != -1:
+                balanced_list = _find_balanced_json(cleaned_section[list_start:], '[')
+                if balanced_list:
+                    filtered_output = balanced_list
                 else:
-                    # Último recurso: retorna o output completo
-                    filtered_output = cleaned_output
-            
-            return filtered_output
-        finally:
-            # Remove arquivos temporários
-            try:
-                if os.path.exists(temp_img_path):
-                    os.unlink(temp_img_path)
-            except Exception:
-                pass
-            if temp_prompt_file and os.path.exists(temp_prompt_path):
+                    filtered_output = cleaned_section
+            else:
+                filtered_output = cleaned_section
+        
+        filtered_output = filtered_output.strip()
+        
+        # Substitui vírgula por ponto em números (formato brasileiro)
+        filtered_output = re.sub(r'(?<=\d),(?=\d)', '.', filtered_output)
+    else:
+        # Fallback: procura pelo JSON válido no output_cleaned
+        # Remove markdown primeiro
+        cleaned_output = output_cleaned
+        cleaned_output = re.sub(r'```json\s*\n?', '', cleaned_output, flags=re.IGNORECASE | re.MULTILINE)
+        cleaned_output = re.sub(r'\n?\s*```\s*$', '', cleaned_output, flags=re.MULTILINE | re.IGNORECASE)
+        cleaned_output = cleaned_output.strip()
+        
+        # Encontra todas as posições de '{' e tenta extrair JSON completo de cada uma
+        json_candidates = []
+        pos = 0
+        while True:
+            pos = cleaned_output.find('{', pos)
+            if pos == -1:
+                break
+            balanced_json = _find_balanced_json(cleaned_output[pos:], '{')
+            if balanced_json:
+                # Valida se é JSON válido
                 try:
-                    os.unlink(temp_prompt_path)
-                except Exception:
+                    parsed = json.loads(balanced_json)
+                    json_candidates.append((pos, balanced_json, len(str(parsed))))
+                except json.JSONDecodeError:
                     pass
-            # Limpa cache e força garbage collection
-            _clear_metal_cache()
-            gc.collect()
+            pos += 1
+        
+        if json_candidates:
+            # Para consumo, pega o primeiro JSON válido que tem consumo_lista
+            # Não pega o maior, pois pode estar cortado ou ter múltiplas respostas
+            for pos, json_str, size in json_candidates:
+                try:
+                    parsed = json.loads(json_str)
+                    # Se for consumo, verifica se tem consumo_lista válida
+                    if isinstance(parsed, dict) and 'consumo_lista' in parsed:
+                        consumo_lista = parsed.get('consumo_lista', [])
+                        if isinstance(consumo_lista, list) and len(consumo_lista) <= 13:
+                            filtered_output = json_str
+                            break
+                except json.JSONDecodeError:
+                    continue
+            else:
+                # Se não encontrou um JSON válido com consumo_lista, pega o primeiro válido
+                _, filtered_output, _ = json_candidates[0]
+            
+            # Remove delimitadores markdown se houver (já removido, mas garante)
+            filtered_output = re.sub(r'^```json\s*', '', filtered_output, flags=re.MULTILINE)
+            filtered_output = re.sub(r'\s*```$', '', filtered_output, flags=re.MULTILINE)
+            filtered_output = filtered_output.strip()
+            # Substitui vírgula por ponto em números
+            filtered_output = re.sub(r'(?<=\d),(?=\d)', '.', filtered_output)
+        else:
+            # Último recurso: retorna o output completo
+            filtered_output = cleaned_output
+    
+    return filtered_output
+
+
+def _stage_timeout(name: str) -> float:
+    """Timeout da etapa do pipeline; etapas fora de stage_timeouts_s ficam com request_timeout_s."""
+    return settings.stage_timeouts_s.get(name, settings.request_timeout_s)
+
+
+async def _infer_one(
+    img: ImageInput,
+    prompt_text: str,
+    prefix: str = "",
+    prefix_key: tuple[str, ...] | None = None,
+    schema: Dict[str, Any] | None = None,
+    kind: str | None = None,
+) -> str:
+    """
+    Gera a resposta para img (uma imagem ou lista de imagens) com o prompt prefix + prompt_text.
+    prefix é a parte estática (arquivos de prompt), identificada por prefix_key para o cache de KV.
+    schema restringe a geração ao JSON esperado (quando constrained_decoding está ativo).
+    kind identifica o tipo de prompt nas métricas do backend (customer, consumption, crops, full).
+    """
+    if ENGINE is None:
+        raise RuntimeError(f"Backend de inferência {settings.inference_backend!r} indisponível.")
+
+    images = img if isinstance(img, list) else [img]
+
+    # Valida tamanho da imagem antes de processar
+    for im in images:
+        w, h = im.size
+        pixels = w * h
+        if pixels > settings.max_pixels:
+            raise ValueError(
+                f"Imagem muito grande: {w}x{h} ({pixels:,} pixels). "
+                f"Máximo permitido: {settings.max_pixels:,} pixels. "
+                f"Redimensione a imagem antes de enviar."
+            )
+        log(f"[infer] processando imagem: {w}x{h} ({pixels:,} pixels)")
+
+    images = [im if im.mode == 'RGB' else im.convert('RGB') for im in images]
+    img = images if isinstance(img, list) else images[0]
 
-    return await loop.run_in_executor(None, _run)
+    if not settings.constrained_decoding:
+        schema = None
+
+    # Geração no thread dedicado do engine, com o modelo já residente em memória. Sem timeout
+    # aqui: quem limita o tempo é a etapa do pipeline (stage_timeouts_s), que cancela a geração
+    result = await ENGINE.infer(img, prompt_text, prefix, prefix_key, schema, kind)
+    output = result.text
+    log(
+        f"[infer] tokens gerados={result.tokens} parada={result.finish_reason} "
+        f"economia_max={result.tokens_saved} tokens"
+    )
+
+    log(f"[infer] saída bruta do modelo ({len(output)} chars):")
+    log(output)
+
+    # Geração restrita que fechou o JSON dispensa a limpeza (a saída já é o JSON)
+    if schema is not None and result.finish_reason == "json_complete":
+        return output
+    return _clean_model_output(output)
+
+
+async def _infer_customer(crop_img: Image.Image) -> Dict[str, Any]:
+    """Etapa cliente: endereço a partir do recorte de dados do cliente."""
+    log("[infer] iniciando inferência recorte cliente/endereço")
+    prompt_customer = _read_customer_address_prompt()
+    result_customer = await _infer_one(
+        crop_img, "",
+        prefix=prompt_customer,
+        prefix_key=_prompt_cache_key([PROMPTS_DIR / "customer_address.md"]),
+        schema=_ADDRESS_SCHEMA,
+        kind="customer",
+    )
+    if not result_customer:
+        return {}
+    try:
+        return _extract_json(result_customer)
+    except Exception as e:
+        log(f"[infer] ERRO ao extrair JSON cliente/endereço: {e}")
+        return {}
+
+
+def _consumption_payload(payload_consumption: Any) -> Dict[str, Any]:
+    """Valida o JSON de consumo: garante consumo_lista como lista de no máximo 13 itens."""
+    log(f"[consumo] tem consumo_lista? {isinstance(payload_consumption, dict) and 'consumo_lista' in payload_consumption}")
+
+    # Garante que tem consumo_lista
+    if not isinstance(payload_consumption, dict) or 'consumo_lista' not in payload_consumption:
+        log(f"[consumo] AVISO: payload_consumption não tem consumo_lista. Keys: {list(payload_consumption.keys()) if isinstance(payload_consumption, dict) else 'N/A'}")
+        return {'consumo_lista': []}
+    consumo_lista = payload_consumption['consumo_lista']
+    if not isinstance(consumo_lista, list):
+        log(f"[consumo] AVISO: consumo_lista não é uma lista: {type(consumo_lista)}")
+        return {'consumo_lista': []}
+    # Limita a 13 itens (conforme prompt)
+    if len(consumo_lista) > 13:
+        log(f"[consumo] AVISO: consumo_lista tem {len(consumo_lista)} itens, limitando a 13")
+        consumo_lista = consumo_lista[:13]
+    log(f"[consumo] consumo_lista extraída com sucesso: {len(consumo_lista)} itens")
+    return {'consumo_lista': consumo_lista}
+
+
+async def _infer_consumption(crop_img: Image.Image) -> Dict[str, Any]:
+    """Etapa consumo: consumo_lista a partir do recorte do histórico de consumo."""
+    log("[infer] iniciando inferência recorte consumo")
+    prompt_consumption = _read_consumption_prompt()
+    result_consumption = await _infer_one(
+        crop_img, "",
+        prefix=prompt_consumption,
+        prefix_key=_prompt_cache_key([PROMPTS_DIR / "consumption.md"]),
+        schema=_CONSUMPTION_SCHEMA,
+        kind="consumption",
+    )
+    if not result_consumption:
+        return {}
+
+    # Log completo da saída BRUTA do modelo ANTES de qualquer processamento
+    # Loga EXATAMENTE como vem do modelo, sem formatação
+    log(f"[consumo] ========== SAÍDA BRUTA DO MODELO (ANTES DO _extract_json) ==========")
+    log(f"[consumo] TIPO: {type(result_consumption)}")
+    log(f"[consumo] TAMANHO: {len(result_consumption)} caracteres")
+    log(f"[consumo] CONTEÚDO BRUTO COMPLETO (EXATAMENTE COMO VEM DO MODELO):")
+    # Loga o texto bruto diretamente, sem formatação, caractere por caractere se necessário
+    log(result_consumption)
+    log(f"[consumo] REPR (para ver caracteres especiais): {repr(result_consumption)}")
+    log(f"[consumo] ========== FIM SAÍDA BRUTA ==========")
+
+    try:
+        log(f"[consumo] chamando _extract_json...")
+        payload_consumption = _extract_json(result_consumption)
+        log(f"[consumo] resultado do _extract_json: {payload_consumption}")
+        log(f"[consumo] tipo: {type(payload_consumption)}")
+        return _consumption_payload(payload_consumption)
+    except Exception as e:
+        log(f"[infer] ERRO ao extrair JSON consumo: {e}")
+        import traceback
+        log(f"[infer] traceback: {traceback.format_exc()}")
+        return {'consumo_lista': []}
+
+
+async def _infer_crops_combined(
+    customer_crop_img: Image.Image, consumption_crop_img: Image.Image
+) -> tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Etapa única para os dois recortes: uma geração multi-imagem (endereço + consumo) cujo JSON
+    combinado é separado de volta em (payload_customer, payload_consumption).
+    """
+    log("[infer] iniciando inferência combinada dos recortes (cliente + consumo)")
+    prompt_paths = [PROMPTS_DIR / "customer_address.md", PROMPTS_DIR / "consumption.md"]
+    prefix = (
+        "### IMAGEM 1 - ENDEREÇO DO CLIENTE\n\n" + _read_customer_address_prompt()
+        + "\n\n### IMAGEM 2 - CONSUMO MÉDIO\n\n" + _read_consumption_prompt()
+    )
+    combined_path = PROMPTS_DIR / "crops_combined.md"
+    if not combined_path.exists():
+        raise RuntimeError(f"Arquivo {combined_path.as_posix()} não encontrado.")
+    result = await _infer_one(
+        [customer_crop_img, consumption_crop_img],
+        "\n\n" + combined_path.read_text(encoding="utf-8").strip(),
+        prefix=prefix,
+        prefix_key=_prompt_cache_key(prompt_paths),
+        schema=_CROPS_SCHEMA,
+        kind="crops",
+    )
+    try:
+        data = _extract_json(result) if result else {}
+    except Exception as e:
+        log(f"[infer] ERRO ao extrair JSON combinado dos recortes: {e}")
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    payload_customer = {k: data[k] for k in _ADDRESS_SCHEMA["properties"] if k in data}
+    payload_consumption = _consumption_payload({"consumo_lista": data.get("consumo_lista", [])})
+    return payload_customer, payload_consumption
+
+
+def _address_context(payload_customer: Dict[str, Any]) -> str:
+    """Contexto do endereço já extraído, para evitar confusão no nome_cliente."""
+    if not payload_customer:
+        return ""
+    cidade_extraida = str(payload_customer.get("cidade") or "").strip()
+    estado_extraido = str(payload_customer.get("estado") or "").strip()
+    bairro_extraido = str(payload_customer.get("bairro") or "").strip()
+    rua_extraida = str(payload_customer.get("rua") or "").strip()
+
+    if not (cidade_extraida or estado_extraido or bairro_extraido or rua_extraida):
+        return ""
+    endereco_contexto = "\n\nIMPORTANTE - CONTEXTO DO ENDEREÇO JÁ EXTRAÍDO:\n"
+    endereco_contexto += "O endereço do cliente já foi extraído e é:\n"
+    if rua_extraida:
+        endereco_contexto += f"- Rua: {rua_extraida}\n"
+    if bairro_extraido:
+        endereco_contexto += f"- Bairro: {bairro_extraido}\n"
+    if cidade_extraida:
+        endereco_contexto += f"- Cidade: {cidade_extraida}\n"
+    if estado_extraido:
+        endereco_contexto += f"- Estado: {estado_extraido}\n"
+    endereco_contexto += "\nCRÍTICO: O campo 'nome_cliente' NÃO deve conter nenhuma dessas informações de endereço.\n"
+    endereco_contexto += "Se você encontrar essas palavras (cidade, estado, bairro, rua) junto com o nome do cliente, extraia APENAS o nome, parando antes dessas informações.\n"
+    endereco_contexto += "O nome_cliente é APENAS o nome da pessoa/empresa, sem qualquer informação geográfica.\n"
+    return endereco_contexto
+
+
+async def _infer_full(
+    img: Image.Image,
+    concessionaria: str,
+    uf: str,
+    payload_customer: Dict[str, Any],
+    fields: list[str] | None = None,
+) -> Dict[str, Any]:
+    """
+    Etapa imagem completa: contrato, com o endereço do recorte como contexto do prompt.
+    fields restringe a geração a esses campos (os demais já vieram da camada de texto).
+    """
+    # Parte estática (base.md + spec) vira prefixo cacheável; o resto depende da requisição
+    prompt_paths = _resolve_prompt_paths(concessionaria, uf)
+    prompt_prefix = _join_prompt_files(prompt_paths)
+    endereco_contexto = _address_context(payload_customer)
+    schema = _CONTRACT_SCHEMA
+    campos_contexto = ""
+    if fields is not None:
+        schema = _object_schema({k: _CONTRACT_SCHEMA["properties"][k] for k in fields})
+        campos_contexto = (
+            "\n\nOs demais campos já foram lidos do texto do PDF. "
+            f"Retorne APENAS estas chaves: {', '.join(fields)}\n"
+        )
+
+    prompt_full = f"""{endereco_contexto}{campos_contexto}
+
+Contexto da requisição: UF={uf}, Concessionária={concessionaria}
+
+Agora analise a imagem e retorne o JSON com os dados extraídos:"""
+
+    log(f"[prompt] tamanho do prompt completo: {len(prompt_prefix) + len(prompt_full)} caracteres")
+    log("[infer] iniciando inferência imagem completa")
+    result_full = await _infer_one(
+        img, prompt_full,
+        prefix=prompt_prefix,
+        prefix_key=_prompt_cache_key(prompt_paths),
+        schema=schema,
+        kind="full",
+    )
+    if not result_full:
+        return {}
+    try:
+        return _extract_json(result_full)
+    except Exception as e:
+        log(f"[infer] ERRO ao extrair JSON imagem completa: {e}")
+        return {}
 
 
 @app.get("/health")
@@ -998,234 +1573,499 @@ def health() -> Dict[str, Any]:
         "status": "ok",
         "model": settings.model_id,
         "max_concurrency": settings.max_concurrency,
+        "inference_backend": settings.inference_backend,
+        "backend_available": backend_available(settings.inference_backend),
         "mlx_vlm_available": _HAS_MLX_VLM,
+        "engine": ENGINE.stats() if ENGINE is not None else None,
+        "result_cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+        "near_duplicates": NEAR_DUP_INDEX.stats() if NEAR_DUP_INDEX is not None else None,
+        "single_flight": _FLIGHTS.stats(),
+        "admission": ADMISSION.stats(),
+        "jobs": JOBS.stats(),
     }
 
 
 @app.post("/extract/energy")
 async def extract_energy(
+    request: Request,
     concessionaria: str = Form(...),
     uf: str = Form(...),
     file: UploadFile = File(...),
+    bypass_near_dup: bool = Form(False),
+    password: Optional[str] = Form(None),
 ):
     t_request_start = time.time()
     log(f"[req] requisição recebida: concessionaria={concessionaria}, uf={uf}")
-    
-    if not _HAS_MLX_VLM:
+    raw = await _read_extraction_upload(concessionaria, uf, file)
+    payload, headers = await _extract(
+        raw, concessionaria, uf,
+        priority=_request_priority(request.headers.get(settings.admission_priority_header)),
+        bypass_near_dup=bypass_near_dup,
+        pdf_password=password,
+        t_request_start=t_request_start,
+    )
+    return JSONResponse(content=payload, headers=headers)
+
+
+async def _read_extraction_upload(concessionaria: str, uf: str, file: UploadFile) -> bytes:
+    """Validações comuns dos endpoints de extração; retorna os bytes do upload."""
+    _check_engine()
+    _check_extraction_fields(concessionaria, uf, file.content_type)
+    raw = await file.read()
+    _check_upload_size(raw)
+    return raw
+
+
+def _check_engine() -> None:
+    if ENGINE is None:
         raise HTTPException(
             status_code=503,
             detail=(
-                "Dependência 'mlx-vlm' não instalada/ativa (import mlx_vlm falhou). "
-                "Ative o venv do projeto ou rode via `uv run ...`."
+                f"Backend de inferência '{settings.inference_backend}' indisponível "
+                "(dependências não instaladas/ativas). Ative o venv do projeto ou rode via `uv run ...`; "
+                "fora do Apple Silicon use inference_backend=\"cpu\"."
             ),
         )
 
+
+def _check_extraction_fields(concessionaria: str, uf: str, content_type: str | None) -> None:
     if not concessionaria.strip():
         raise HTTPException(status_code=400, detail="concessionaria é obrigatório")
     if not uf.strip():
         raise HTTPException(status_code=400, detail="uf é obrigatório")
 
-    if file.content_type not in {"image/png", "image/jpeg", "image/jpg"}:
-        raise HTTPException(status_code=400, detail=f"content-type não suportado: {file.content_type}")
+    if content_type not in _IMAGE_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"content-type não suportado: {content_type}")
 
-    raw = await file.read()
+
+def _upload_size(upload: UploadFile) -> int:
+    """Tamanho do upload sem lê-lo (o multipart já está no arquivo temporário)."""
+    if upload.size is not None:
+        return upload.size
+    pos = upload.file.tell()
+    size = upload.file.seek(0, io.SEEK_END)
+    upload.file.seek(pos)
+    return size
+
+
+def _check_upload_size(raw: bytes) -> None:
     if len(raw) > settings.max_image_mb * 1024 * 1024:
         raise HTTPException(status_code=413, detail=f"imagem acima do limite de {settings.max_image_mb}MB")
 
+
+_IMAGE_CONTENT_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/tiff", "application/pdf"}
+
+
+async def _extract(
+    raw: bytes,
+    concessionaria: str,
+    uf: str,
+    *,
+    priority: int = 0,
+    bypass_near_dup: bool = False,
+    pdf_password: str | None = None,
+    t_request_start: float | None = None,
+) -> tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Extração de um upload já validado: cache de resultados -> single-flight -> admissão ->
+    pipeline. Retorna o payload e os headers da resposta (X-Cache, Server-Timing...).
+    """
+    t_request_start = t_request_start if t_request_start is not None else time.time()
+    await asyncio.to_thread(_check_pdf_access, raw, pdf_password)
+    content_hash = hashlib.sha256(raw).hexdigest()
+    cache_key = scope = None
+    if RESULT_CACHE is not None:
+        try:
+            scope = _extraction_scope(concessionaria, uf)
+            cache_key = _result_cache_key(content_hash, scope)
+        except RuntimeError as e:
+            log(f"[cache] chave indisponível, seguindo sem cache: {e}")
+        cached = RESULT_CACHE.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            log(f"[cache] hit {cache_key[:12]} concessionaria={concessionaria.lower()} uf={uf.upper()}")
+            return cached, {"X-Cache": "hit"}
+
+    # Reenvio de um upload que ainda está em processamento aguarda a mesma extração
+    flight_key = (content_hash, _key(concessionaria), _key(uf), bypass_near_dup)
+    (payload, headers), shared = await _FLIGHTS.do(
+        flight_key,
+        partial(
+            _admitted_extraction,
+            priority,
+            raw, concessionaria, uf, bypass_near_dup, cache_key, scope, t_request_start, pdf_password,
+        ),
+    )
+    if shared:
+        log(f"[req] requisição idêntica em andamento: resultado compartilhado ({content_hash[:12]})")
+        headers = {**headers, "X-Single-Flight": "shared"}
+    return payload, headers
+
+
+async def _extract_when_admitted(
+    raw: bytes, concessionaria: str, uf: str, *, priority: int = 0, pdf_password: str | None = None
+) -> tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    _extract para trabalho já enfileirado do lado do servidor (jobs, lotes): um 429 da admissão
+    vira espera pelo Retry-After em vez de falha.
+    """
+    while True:
+        try:
+            return await _extract(raw, concessionaria, uf, priority=priority, pdf_password=pdf_password)
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise
+            await asyncio.sleep(int((e.headers or {}).get("Retry-After", 1)))
+
+
+async def _run_job(job: Any) -> Dict[str, Any]:
+    """Handler da fila de jobs: mesma extração do endpoint síncrono."""
+    try:
+        payload, _ = await _extract_when_admitted(
+            job["payload"], job["concessionaria"], job["uf"],
+            priority=job["priority"], pdf_password=JOBS.store.password(job["id"]),
+        )
+        return payload
+    except HTTPException as e:
+        raise JobError(str(e.detail), e.status_code) from None
+
+
+JOBS = JobRunner(
+    JobStore(settings.jobs_db_path, max_attempts=settings.jobs_max_attempts),
+    _run_job,
+    workers=settings.jobs_workers,
+    callback_timeout_s=settings.jobs_callback_timeout_s,
+    callback_allowed_hosts=settings.jobs_callback_allowed_hosts,
+    retention_s=settings.jobs_retention_h * 3600,
+)
+
+
+@app.post("/jobs/extract/energy", status_code=202)
+async def submit_extraction_job(
+    request: Request,
+    concessionaria: str = Form(...),
+    uf: str = Form(...),
+    file: UploadFile = File(...),
+    callback_url: Optional[str] = Form(None),
+    password: Optional[str] = Form(None),
+):
+    """Enfileira a extração e responde na hora com o id do job (resultado via GET ou callback)."""
+    if callback_url:
+        try:
+            await asyncio.to_thread(check_callback_url, callback_url, settings.jobs_callback_allowed_hosts)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    raw = await _read_extraction_upload(concessionaria, uf, file)
+    # Senha errada falha aqui, não depois de o job esperar na fila
+    await asyncio.to_thread(_check_pdf_access, raw, password)
+    job_id = await asyncio.to_thread(
+        JOBS.store.submit, raw, concessionaria, uf,
+        priority=_request_priority(request.headers.get(settings.admission_priority_header)),
+        callback_url=callback_url or None,
+        pdf_password=password or None,
+    )
+    JOBS.notify()
+    log(f"[jobs] {job_id} enfileirado: concessionaria={concessionaria} uf={uf}")
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job_id, "status": "queued"},
+        headers={"Location": f"/jobs/{job_id}"},
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_extraction_job(job_id: str):
+    job = await asyncio.to_thread(JOBS.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job não encontrado")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "concessionaria": job["concessionaria"],
+        "uf": job["uf"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "result": job["result"],
+        "error": job["error"],
+        "error_status": job["error_status"],
+        "callback_status": job["callback_status"],
+    }
+
+
+async def _admitted_extraction(priority: int, *args: Any) -> tuple[Dict[str, Any], Dict[str, str]]:
+    """Roda _run_extraction dentro de um slot do controle de admissão (429 se não houver vaga)."""
+    try:
+        async with ADMISSION.slot(priority) as waited_ms:
+            if waited_ms > 0:
+                log(f"[admission] extração liberada após {waited_ms:.0f}ms na fila (prioridade={priority})")
+            return await _run_extraction(*args)
+    except AdmissionRejected as e:
+        log(f"[admission] rejeitada: {e.reason} (prioridade={priority}, retry_after={e.retry_after_s}s)")
+        raise HTTPException(
+            status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after_s)}
+        )
+
+
+async def _run_extraction(
+    raw: bytes,
+    concessionaria: str,
+    uf: str,
+    bypass_near_dup: bool,
+    cache_key: str | None,
+    scope: str | None,
+    t_request_start: float,
+    pdf_password: str | None = None,
+) -> tuple[Dict[str, Any], Dict[str, str]]:
+    """Pipeline completo de uma extração (imagem -> recortes -> etapas de inferência -> contrato)."""
     t_start = time.time()
     log(f"[timing] início processamento: {(t_start - t_request_start)*1000:.1f}ms após receber requisição")
     
     img = None
-    img_temp_path = None
     customer_crop_img = None
     consumption_crop_img = None
-    customer_crop_path = None
-    consumption_crop_path = None
-    
-    try:
-        t_load_start = time.time()
-        img = _load_image(raw)
-        # Libera os bytes da imagem imediatamente após carregar
-        del raw
-        gc.collect()
-        t_load_end = time.time()
-        log(f"[timing] carregamento imagem: {(t_load_end - t_load_start)*1000:.1f}ms")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"falha ao abrir imagem: {e}")
 
-    # Salva imagem temporariamente para detecção YOLO
-    if _HAS_OBJECT_DETECTION and OBJECT_DETECTOR is not None:
+    # PDF nativo: campos lidos da camada de texto não vão para o modelo. Sem nenhum campo
+    # faltando, a página nem é renderizada
+    text = None
+    if settings.text_layer_enabled and is_pdf(raw):
+        t_text_start = time.time()
         try:
-            t_crop_start = time.time()
-            img_temp_path = _save_image_temp(img)
-            log(f"[crop] imagem salva temporariamente: {img_temp_path}")
-            
-            # Faz recorte de dados do cliente
-            try:
-                t_customer_start = time.time()
-                customer_crop_path = OBJECT_DETECTOR.detect_and_crop_customer_data(img_temp_path)
-                t_customer_end = time.time()
-                log(f"[timing] detecção cliente: {(t_customer_end - t_customer_start)*1000:.1f}ms")
-                if customer_crop_path:
-                    customer_crop_img = Image.open(customer_crop_path).convert("RGB")
-                    log(f"[crop] recorte cliente/endereço criado: {customer_crop_path}")
-            except Exception as e:
-                log(f"[crop] erro ao recortar cliente/endereço: {e}")
-            
-            # Faz recorte de consumo
-            try:
-                t_consumption_start = time.time()
-                consumption_crop_path = OBJECT_DETECTOR.detect_and_crop_consumption(img_temp_path)
-                t_consumption_end = time.time()
-                log(f"[timing] detecção consumo: {(t_consumption_end - t_consumption_start)*1000:.1f}ms")
-                if consumption_crop_path:
-                    consumption_crop_img = Image.open(consumption_crop_path).convert("RGB")
-                    log(f"[crop] recorte consumo criado: {consumption_crop_path}")
-            except Exception as e:
-                log(f"[crop] erro ao recortar consumo: {e}")
-            
-            t_crop_end = time.time()
-            log(f"[timing] total recortes: {(t_crop_end - t_crop_start)*1000:.1f}ms")
+            text = await asyncio.to_thread(_read_text_layer, raw, pdf_password, concessionaria)
         except Exception as e:
-            log(f"[crop] erro ao processar recortes: {e}")
-
-    t0 = time.time()
-    log(f"[timing] tempo até início inferências: {(t0 - t_start)*1000:.1f}ms")
+            log(f"[text] falha ao ler a camada de texto, seguindo só com o modelo: {e}")
+        if text is not None:
+            log(
+                f"[text] camada de texto: {text.words} palavras, {len(text.values)} campos resolvidos "
+                f"em {(time.time() - t_text_start)*1000:.1f}ms"
+            )
+    text_values = text.values if text is not None else {}
+    missing_contract = [k for k in _CONTRACT_SCHEMA["properties"] if k not in text_values]
+    need_customer = any(k not in text_values for k in _ADDRESS_SCHEMA["properties"])
+    need_consumption = "consumo_lista" not in text_values
+    if text is not None:
+        log(f"[text] campos para o modelo: {missing_contract or 'nenhum'} (endereço={need_customer}, consumo={need_consumption})")
+
+    # Fatura com várias páginas: escolhe a página de cada recorte antes de renderizar qualquer
+    # uma em resolução cheia (a do cliente serve também à imagem completa)
+    page_for = dict.fromkeys(PAGE_KINDS, 0)
+    total_pages = 1
+    if settings.page_ranking_enabled and (missing_contract or need_customer or need_consumption):
+        try:
+            page_for, total_pages = await _rank_pages(raw, pdf_password, concessionaria)
+        except Exception as e:
+            log(f"[pages] falha ao classificar páginas, usando a primeira: {e}")
 
-    # Resultados das 3 inferências
-    result_full = None
-    result_customer = None
-    result_consumption = None
-    
-    # Extrai endereço e consumo PRIMEIRO para usar no prompt da imagem completa
-    payload_customer = {}
-    payload_consumption = {}
-    
-    # Inferência 1: Recorte cliente/endereço (PRIMEIRO)
-    if customer_crop_img is not None:
+    # Orçamento de resolução: com recortes a fazer, a página vem em alta (source_max_pixels) e
+    # o YOLO roda numa prévia; sem eles, basta o tamanho da imagem completa
+    need_crops = (
+        _HAS_OBJECT_DETECTION and OBJECT_DETECTOR is not None and (need_customer or need_consumption)
+    )
+    full_budget = min(settings.full_max_pixels, settings.max_pixels)
+    crop_budget = min(settings.crop_max_pixels, settings.max_pixels)
+    source = None
+    consumption_source = None
+    # PDF: a página sai no tamanho da imagem completa e os recortes são renderizados de novo
+    # só na caixa detectada (clip), sem a página inteira em alta
+    pdf_doc = None
+    if missing_contract or need_customer or need_consumption:
         try:
-            t_infer1_start = time.time()
-            log("[infer] iniciando inferência recorte cliente/endereço")
-            prompt_customer = _read_customer_address_prompt(concessionaria, uf)
-            result_customer = await _infer_one(customer_crop_img, prompt_customer)
-            t_infer1_end = time.time()
-            log(f"[timing] inferência cliente: {(t_infer1_end - t_infer1_start)*1000:.1f}ms")
-            
-            # Extrai JSON imediatamente
-            if result_customer:
-                try:
-                    payload_customer = _extract_json(result_customer)
-                except Exception as e:
-                    log(f"[infer] ERRO ao extrair JSON cliente/endereço: {e}")
+            t_load_start = time.time()
+            if need_crops and settings.pdf_clip_render and is_pdf(raw):
+                pdf_doc = await asyncio.to_thread(PdfPages, raw, pdf_password)
+                load = partial(_render_pdf_page, pdf_doc, max_pixels=full_budget)
+            else:
+                budget = max(settings.source_max_pixels, full_budget) if need_crops else full_budget
+                load = partial(_load_image, raw, pdf_password, max_pixels=budget)
+            # Decode/renderização e redução fora do event loop
+            source = await asyncio.to_thread(load, page=page_for["customer"])
+            if need_crops and need_consumption and page_for["consumption"] != page_for["customer"]:
+                consumption_source = await asyncio.to_thread(load, page=page_for["consumption"])
+            img = await asyncio.to_thread(fit_pixels, source, full_budget)
+            # Libera os bytes da imagem imediatamente após carregar
+            del raw
+            gc.collect()
+            t_load_end = time.time()
+            log(
+                f"[timing] carregamento imagem: {(t_load_end - t_load_start)*1000:.1f}ms "
+                f"(fonte {source.width}x{source.height}, imagem completa {img.width}x{img.height})"
+            )
         except Exception as e:
-            log(f"[infer] erro na inferência cliente/endereço: {e}")
-            result_customer = None
-    
-    # Inferência 2: Recorte consumo (SEGUNDO)
-    if consumption_crop_img is not None:
+            if pdf_doc is not None:
+                pdf_doc.close()
+            raise HTTPException(status_code=400, detail=f"falha ao abrir imagem: {e}")
+
+    def _release_sources() -> None:
+        # A fonte em alta só serve aos recortes; a imagem completa pode ser ela mesma
+        for im in (source, consumption_source):
+            if im is not None and im is not img:
+                im.close()
+        if pdf_doc is not None:
+            pdf_doc.close()
+
+    # Quase duplicata: mesma fatura re-encodada reaproveita a extração guardada.
+    # bypass_near_dup força a extração (o upload continua indexado para os próximos)
+    near_hashes = None
+    near_detail = None
+    if NEAR_DUP_INDEX is not None and cache_key is not None and img is not None:
+        near_hashes = await asyncio.to_thread(image_hashes, img)
+        near_detail = await asyncio.to_thread(detail_signature, img)
+        match = None if bypass_near_dup else await asyncio.to_thread(
+            NEAR_DUP_INDEX.find, scope, near_hashes, partial(_confirm_near_dup, detail=near_detail, text=text)
+        )
+        if match is not None:
+            cached = RESULT_CACHE.get(match[0])
+            if cached is None:
+                NEAR_DUP_INDEX.discard(match[0])
+            else:
+                log(f"[cache] quase duplicata de {match[0][:12]} (distância={match[1]} bits)")
+                _release_sources()
+                img.close()
+                return cached, {"X-Cache": "near-hit", "X-Near-Duplicate-Distance": str(match[1])}
+
+    # Detecção YOLO e recortes em memória: o YOLO roda numa prévia (detection_max_pixels) e os
+    # recortes saem da fonte em alta (em PDF, renderizados só na caixa), sem PNG nem disco
+    if need_crops and source is not None:
         try:
-            t_infer2_start = time.time()
-            log("[infer] iniciando inferência recorte consumo")
-            prompt_consumption = _read_consumption_prompt()
-            result_consumption = await _infer_one(consumption_crop_img, prompt_consumption)
-            t_infer2_end = time.time()
-            log(f"[timing] inferência consumo: {(t_infer2_end - t_infer2_start)*1000:.1f}ms")
-            
-            # Log completo da saída BRUTA do modelo ANTES de qualquer processamento
-            # Loga EXATAMENTE como vem do modelo, sem formatação
-            if result_consumption:
-                log(f"[consumo] ========== SAÍDA BRUTA DO MODELO (ANTES DO _extract_json) ==========")
-                log(f"[consumo] TIPO: {type(result_consumption)}")
-                log(f"[consumo] TAMANHO: {len(result_consumption)} caracteres")
-                log(f"[consumo] CONTEÚDO BRUTO COMPLETO (EXATAMENTE COMO VEM DO MODELO):")
-                # Loga o texto bruto diretamente, sem formatação, caractere por caractere se necessário
-                log(result_consumption)
-                log(f"[consumo] REPR (para ver caracteres especiais): {repr(result_consumption)}")
-                log(f"[consumo] ========== FIM SAÍDA BRUTA ==========")
-            
-            # Extrai JSON imediatamente
-            if result_consumption:
+            t_crop_start = time.time()
+            # Histórico na mesma página do cliente: os dois detectores numa passada só
+            same_page = consumption_source is None
+            proxy = await asyncio.to_thread(fit_pixels, source, settings.detection_max_pixels)
+            regions = await asyncio.to_thread(
+                OBJECT_DETECTOR.detect_regions,
+                proxy, customer=need_customer, consumption=need_consumption and same_page,
+                parallel=settings.detection_parallel,
+            )
+            log(f"[timing] detecção: {_format_detection_timings(regions.timings)}")
+
+            # Faz recorte de dados do cliente (se o endereço não veio todo da camada de texto)
+            if need_customer:
                 try:
-                    log(f"[consumo] chamando _extract_json...")
-                    payload_consumption = _extract_json(result_consumption)
-                    log(f"[consumo] resultado do _extract_json: {payload_consumption}")
-                    log(f"[consumo] tipo: {type(payload_consumption)}")
-                    log(f"[consumo] tem consumo_lista? {isinstance(payload_consumption, dict) and 'consumo_lista' in payload_consumption}")
-                    
-                    # Garante que tem consumo_lista
-                    if not isinstance(payload_consumption, dict) or 'consumo_lista' not in payload_consumption:
-                        log(f"[consumo] AVISO: payload_consumption não tem consumo_lista. Keys: {list(payload_consumption.keys()) if isinstance(payload_consumption, dict) else 'N/A'}")
-                        payload_consumption = {'consumo_lista': []}
-                    else:
-                        consumo_lista = payload_consumption['consumo_lista']
-                        if isinstance(consumo_lista, list):
-                            # Limita a 13 itens (conforme prompt)
-                            if len(consumo_lista) > 13:
-                                log(f"[consumo] AVISO: consumo_lista tem {len(consumo_lista)} itens, limitando a 13")
-                                payload_consumption['consumo_lista'] = consumo_lista[:13]
-                            consumo_count = len(payload_consumption['consumo_lista'])
-                            log(f"[consumo] consumo_lista extraída com sucesso: {consumo_count} itens")
-                        else:
-                            log(f"[consumo] AVISO: consumo_lista não é uma lista: {type(consumo_lista)}")
-                            payload_consumption = {'consumo_lista': []}
+                    customer_crop_img = await asyncio.to_thread(
+                        _cut_crop, regions.customer_box, proxy, source, pdf_doc, page_for["customer"], crop_budget
+                    )
+                    if customer_crop_img is not None:
+                        log(
+                            f"[crop] recorte cliente/endereço criado: {customer_crop_img.width}x{customer_crop_img.height} "
+                            f"(confiança {regions.customer_conf:.2f})"
+                        )
                 except Exception as e:
-                    log(f"[infer] ERRO ao extrair JSON consumo: {e}")
-                    import traceback
-                    log(f"[infer] traceback: {traceback.format_exc()}")
-                    payload_consumption = {'consumo_lista': []}
+                    log(f"[crop] erro ao recortar cliente/endereço: {e}")
+
+            # Faz recorte de consumo (se o histórico não veio da camada de texto), na página
+            # do histórico quando ela não é a mesma do cliente
+            if need_consumption:
+                try:
+                    consumption_base, consumption_index = source, page_for["customer"]
+                    if not same_page:
+                        if proxy is not source:
+                            proxy.close()
+                        proxy = await asyncio.to_thread(fit_pixels, consumption_source, settings.detection_max_pixels)
+                        consumption_base, consumption_index = consumption_source, page_for["consumption"]
+                        regions = await asyncio.to_thread(OBJECT_DETECTOR.detect_regions, proxy, customer=False)
+                        log(f"[timing] detecção (página do consumo): {_format_detection_timings(regions.timings)}")
+                    consumption_crop_img = await asyncio.to_thread(
+                        _cut_crop, regions.consumption_box, proxy, consumption_base, pdf_doc, consumption_index, crop_budget
+                    )
+                    if consumption_crop_img is not None:
+                        log(
+                            f"[crop] recorte consumo criado: {consumption_crop_img.width}x{consumption_crop_img.height} "
+                            f"(confiança {regions.consumption_conf:.2f})"
+                        )
+                except Exception as e:
+                    log(f"[crop] erro ao recortar consumo: {e}")
+            if proxy is not source and proxy is not consumption_source:
+                proxy.close()
+
+            t_crop_end = time.time()
+            log(f"[timing] total recortes: {(t_crop_end - t_crop_start)*1000:.1f}ms")
         except Exception as e:
-            log(f"[infer] erro na inferência consumo: {e}")
-            result_consumption = None
-    
-    # Inferência 3: Imagem completa (TERCEIRO) - agora com contexto do endereço extraído
-    # Monta prompt com informação do endereço extraído para evitar confusão no nome_cliente
-    prompt_full = _read_prompt(concessionaria, uf)
-    
-    # Adiciona informação do endereço extraído se disponível
-    endereco_contexto = ""
-    if payload_customer:
-        cidade_extraida = payload_customer.get("cidade", "").strip()
-        estado_extraido = payload_customer.get("estado", "").strip()
-        bairro_extraido = payload_customer.get("bairro", "").strip()
-        rua_extraida = payload_customer.get("rua", "").strip()
-        
-        if cidade_extraida or estado_extraido or bairro_extraido or rua_extraida:
-            endereco_contexto = "\n\nIMPORTANTE - CONTEXTO DO ENDEREÇO JÁ EXTRAÍDO:\n"
-            endereco_contexto += "O endereço do cliente já foi extraído e é:\n"
-            if rua_extraida:
-                endereco_contexto += f"- Rua: {rua_extraida}\n"
-            if bairro_extraido:
-                endereco_contexto += f"- Bairro: {bairro_extraido}\n"
-            if cidade_extraida:
-                endereco_contexto += f"- Cidade: {cidade_extraida}\n"
-            if estado_extraido:
-                endereco_contexto += f"- Estado: {estado_extraido}\n"
-            endereco_contexto += "\nCRÍTICO: O campo 'nome_cliente' NÃO deve conter nenhuma dessas informações de endereço.\n"
-            endereco_contexto += "Se você encontrar essas palavras (cidade, estado, bairro, rua) junto com o nome do cliente, extraia APENAS o nome, parando antes dessas informações.\n"
-            endereco_contexto += "O nome_cliente é APENAS o nome da pessoa/empresa, sem qualquer informação geográfica.\n"
-    
-    prompt_full = f"""{prompt_full}{endereco_contexto}
+            log(f"[crop] erro ao processar recortes: {e}")
+    _release_sources()
 
-Contexto da requisição: UF={uf}, Concessionária={concessionaria}
+    t0 = time.time()
+    log(f"[timing] tempo até início inferências: {(t0 - t_start)*1000:.1f}ms")
 
-Agora analise a imagem e retorne o JSON com os dados extraídos:"""
-    
-    log(f"[prompt] tamanho do prompt completo: {len(prompt_full)} caracteres")
-    
-    # Sem _GATE - cada subprocess é independente e pode rodar em paralelo
+    # Etapas do pipeline: consumo não depende de nada; a imagem completa espera o endereço
+    # (endereco_contexto), então cliente e consumo rodam em paralelo
+    combined_crops = (
+        settings.combined_crops and customer_crop_img is not None and consumption_crop_img is not None
+    )
+    # Com camada de texto, a imagem completa só gera os campos que o texto não resolveu
+    full_fields = missing_contract if text is not None else None
+    if combined_crops:
+        # Os dois recortes numa única geração multi-imagem; a imagem completa espera por ela
+        stages = [
+            Stage(
+                "crops",
+                lambda deps: _infer_crops_combined(customer_crop_img, consumption_crop_img),
+                timeout_s=_stage_timeout("crops"),
+            ),
+            Stage(
+                "full",
+                (lambda deps: _infer_full(
+                    img, concessionaria, uf, (deps["crops"].value or ({}, {}))[0], full_fields
+                )) if missing_contract else None,
+                deps=("crops",),
+                timeout_s=_stage_timeout("full"),
+            ),
+        ]
+    else:
+        stages = [
+            Stage(
+                "customer",
+                (lambda deps: _infer_customer(customer_crop_img)) if customer_crop_img is not None else None,
+                timeout_s=_stage_timeout("customer"),
+            ),
+            Stage(
+                "consumption",
+                (lambda deps: _infer_consumption(consumption_crop_img)) if consumption_crop_img is not None else None,
+                timeout_s=_stage_timeout("consumption"),
+            ),
+            Stage(
+                "full",
+                (lambda deps: _infer_full(
+                    img, concessionaria, uf, deps["customer"].value or {}, full_fields
+                )) if missing_contract else None,
+                deps=("customer",),
+                timeout_s=_stage_timeout("full"),
+            ),
+        ]
+    # Tokens de imagem de cada etapa que vai rodar: o custo de prefill de cada orçamento
+    stage_images = {
+        "customer": [customer_crop_img],
+        "consumption": [consumption_crop_img],
+        "crops": [customer_crop_img, consumption_crop_img],
+        "full": [img],
+    }
+    stage_tokens = {
+        st.name: sum(vision_tokens(*im.size, settings.vision_patch_px) for im in stage_images[st.name] if im is not None)
+        for st in stages if st.fn is not None
+    }
     try:
-        t_infer3_start = time.time()
-        log("[infer] iniciando inferência imagem completa")
-        result_full = await _infer_one(img, prompt_full)
-        t_infer3_end = time.time()
-        log(f"[timing] inferência completa: {(t_infer3_end - t_infer3_start)*1000:.1f}ms")
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="timeout na inferência do modelo (imagem completa)")
-    except Exception as e:
-        log(f"[infer] erro na inferência imagem completa: {e}")
-        result_full = None
+        stage_results = await run_dag(stages)
+    except asyncio.CancelledError:
+        # Extração cancelada (nenhum cliente esperando): libera imagens
+        for im in (img, customer_crop_img, consumption_crop_img):
+            if im is not None:
+                im.close()
+        raise
+    for r in stage_results.values():
+        log(
+            f"[timing] etapa {r.name}: status={r.status} início=+{r.start_ms:.1f}ms duração={r.elapsed_ms:.1f}ms "
+            f"tokens_imagem={stage_tokens.get(r.name, 0)}"
+        )
+        if r.error is not None:
+            log(f"[infer] erro na etapa {r.name}: {type(r.error).__name__}: {r.error}")
+
+    if combined_crops:
+        payload_customer, payload_consumption = stage_results["crops"].value or ({}, {})
+    else:
+        payload_customer = stage_results["customer"].value or {}
+        payload_consumption = stage_results["consumption"].value or {}
+    full_timed_out = stage_results["full"].status == "timeout"
     
-    # Limpa imagens da memória (fora do _GATE para não bloquear outras requisições)
+    # Limpa imagens da memória
     if img is not None:
         img.close()
         del img
@@ -1236,37 +2076,19 @@ Agora analise a imagem e retorne o JSON com os dados extraídos:"""
         consumption_crop_img.close()
         del consumption_crop_img
     
-    # Remove arquivos temporários
-    if img_temp_path and os.path.exists(img_temp_path):
-        try:
-            os.unlink(img_temp_path)
-        except Exception:
-            pass
-    
-    # Limpa arquivos temporários do ObjectDetection
-    if _HAS_OBJECT_DETECTION and OBJECT_DETECTOR is not None:
-        try:
-            OBJECT_DETECTOR.cleanup_temp_files()
-        except Exception:
-            pass
-    
     # Limpa cache do Metal e força garbage collection
     _clear_metal_cache()
     gc.collect()
 
+    if full_timed_out:
+        raise HTTPException(status_code=504, detail="timeout na inferência do modelo (imagem completa)")
+
     # Processa resultados e combina
-    # payload_customer e payload_consumption já foram extraídos acima
-    payload_full = {}
-    
-    # Extrai JSON da inferência completa (última a ser processada)
-    if result_full:
-        try:
-            payload_full = _extract_json(result_full)
-        except Exception as e:
-            log(f"[infer] ERRO ao extrair JSON imagem completa: {e}")
+    payload_full = stage_results["full"].value or {}
     
     # Combina resultados: dados gerais da imagem completa
     payload = payload_full.copy()
+    sources = dict.fromkeys(payload_full, "full")
     
     # Sobrescreve com dados do endereço APENAS se o crop tem valor válido
     # O nome_cliente vem apenas da inferência principal, não do crop
@@ -1291,17 +2113,233 @@ Agora analise a imagem e retorne o JSON com os dados extraídos:"""
                         continue  # Não sobrescreve com estado inválido
                 
                 payload[key] = customer_value
+                sources[key] = "crops" if combined_crops else "customer"
     
     # Adiciona consumo_lista do crop (sempre vem do crop, não do full-image)
     if payload_consumption and "consumo_lista" in payload_consumption:
         payload["consumo_lista"] = payload_consumption["consumo_lista"]
+        sources["consumo_lista"] = "crops" if combined_crops else "consumption"
         consumo_count = len(payload["consumo_lista"]) if isinstance(payload["consumo_lista"], list) else 0
         log(f"[consumo] extraído do crop: {consumo_count} itens")
     
-    payload = _ensure_contract(payload, concessionaria_input=concessionaria, uf=uf)
+    # Campos lidos da camada de texto valem mais que os do modelo
+    if text is not None:
+        payload.update(text.values)
+        sources.update({k: "rule" if k in text.constants else "text" for k in text.values})
+
+    merged = payload
+    payload = _ensure_contract(merged, concessionaria_input=concessionaria, uf=uf)
+    if settings.field_provenance:
+        payload["origem_campos"] = _field_provenance(merged, payload, sources)
+
+    # Só guarda extrações completas: uma etapa com erro/timeout não deve ser servida de novo
+    if cache_key is not None and all(r.status in ("ok", "skipped") for r in stage_results.values()):
+        RESULT_CACHE.put(cache_key, payload)
+        if NEAR_DUP_INDEX is not None and near_hashes is not None:
+            NEAR_DUP_INDEX.add(scope, near_hashes, cache_key, near_detail)
 
     ms = int((time.time() - t0) * 1000)
     log(f"[req] concessionaria={concessionaria.lower()} uf={uf.upper()} ms={ms}")
     _log_system_metrics("[req][mem]")
 
-    return JSONResponse(content=payload)
+    headers = {"Server-Timing": server_timing(stage_results)}
+    if stage_tokens:
+        headers["X-Vision-Tokens"] = ", ".join(f"{name}={n}" for name, n in stage_tokens.items())
+    if RESULT_CACHE is not None:
+        headers["X-Cache"] = "miss"
+    if total_pages > 1:
+        headers["X-Pages"] = "; ".join(f"{kind}={page + 1}" for kind, page in page_for.items())
+    return payload, headers
+
+
+_IMAGE_EXTENSIONS = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".pdf": "application/pdf",
+}
+
+
+def _batch_manifest(manifest: str | None) -> Dict[str, Dict[str, str]]:
+    """
+    Manifesto do lote: lista [{"file", "concessionaria", "uf", "password"}] ou dict
+    {arquivo: {...}} (password só para PDFs protegidos). Arquivos fora do manifesto usam a
+    concessionaria/uf padrão do formulário.
+    """
+    if not manifest:
+        return {}
+    try:
+        data = json.loads(manifest)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"manifest inválido: {e}")
+    if isinstance(data, dict):
+        data = [{"file": k, **v} for k, v in data.items() if isinstance(v, dict)]
+    if not isinstance(data, list):
+        raise HTTPException(status_code=400, detail="manifest deve ser uma lista ou um objeto")
+    return {str(it["file"]): it for it in data if isinstance(it, dict) and it.get("file")}
+
+
+def _read_batch_zip(
+    zf: zipfile.ZipFile, max_items: int
+) -> tuple[list[tuple[str, str | None, zipfile.ZipInfo | None]], str | None]:
+    """
+    Entradas de imagem do zip como (nome, content-type, ZipInfo) e o manifest.json/.jsonl dele,
+    se houver. Nada além do manifesto é descompactado aqui: cada fatura é lida só quando vai
+    rodar. O número de entradas e os tamanhos declarados (que limitam a descompactação) são
+    checados antes de ler qualquer entrada; imagens acima de max_image_mb voltam sem ZipInfo.
+    """
+    limit = settings.max_image_mb * 1024 * 1024
+    infos = [
+        info for info in zf.infolist()
+        if not info.is_dir() and not Path(info.filename).name.startswith(".")
+    ]
+    if len(infos) > max_items + 1:
+        raise HTTPException(status_code=413, detail=f"lote acima do limite de {settings.batch_max_files} arquivos")
+    if sum(info.file_size for info in infos) > settings.batch_max_files * limit:
+        raise HTTPException(
+            status_code=413,
+            detail=f"zip acima do limite de {settings.batch_max_files * settings.max_image_mb}MB descompactados",
+        )
+    items: list[tuple[str, str | None, zipfile.ZipInfo | None]] = []
+    manifest = None
+    for info in infos:
+        name = info.filename
+        if Path(name).name in ("manifest.json", "manifest.jsonl"):
+            if info.file_size > limit:
+                raise HTTPException(status_code=413, detail=f"manifest acima do limite de {settings.max_image_mb}MB")
+            text = zf.read(info).decode("utf-8")
+            if name.endswith(".jsonl"):
+                text = json.dumps([json.loads(line) for line in text.splitlines() if line.strip()])
+            manifest = text
+            continue
+        content_type = _IMAGE_EXTENSIONS.get(Path(name).suffix.lower())
+        items.append((name, content_type, info if info.file_size <= limit else None))
+    return items, manifest
+
+
+@app.post("/extract/energy/batch")
+async def extract_energy_batch(
+    request: Request,
+    files: list[UploadFile] = File(default=[]),
+    archive: Optional[UploadFile] = File(None),
+    manifest: Optional[str] = Form(None),
+    concessionaria: str = Form(""),
+    uf: str = Form(""),
+):
+    """
+    Extração em lote: vários arquivos (files) e/ou um zip (archive), cada um com a sua
+    concessionaria/uf via manifest (ou os valores padrão do formulário). Todas as faturas
+    passam pelo mesmo pipeline (cache, admissão, batching do engine) e os resultados voltam
+    em NDJSON na ordem em que terminam, uma linha por fatura + uma linha final de resumo.
+    """
+    _check_engine()
+    if len(files) > settings.batch_max_files:
+        raise HTTPException(status_code=413, detail=f"lote acima do limite de {settings.batch_max_files} arquivos")
+    # Arquivos avulsos e entradas do zip (ZipInfo) só são lidos quando a fatura vai rodar
+    items: list[tuple[str, str | None, UploadFile | zipfile.ZipInfo | None]] = [
+        (f.filename or f"arquivo_{i}", f.content_type, f) for i, f in enumerate(files)
+    ]
+    zf: zipfile.ZipFile | None = None
+    if archive is not None:
+        # O zip compactado não passa do que o lote pode descompactar; acima disso nem é aberto
+        if _upload_size(archive) > settings.batch_max_files * settings.max_image_mb * 1024 * 1024:
+            raise HTTPException(
+                status_code=413,
+                detail=f"zip acima do limite de {settings.batch_max_files * settings.max_image_mb}MB",
+            )
+        try:
+            # Lido direto do arquivo temporário do upload, sem copiar o zip inteiro para memória
+            zf = zipfile.ZipFile(archive.file)
+            zipped, zip_manifest = await asyncio.to_thread(
+                _read_batch_zip, zf, settings.batch_max_files - len(items)
+            )
+        except zipfile.BadZipFile as e:
+            raise HTTPException(status_code=400, detail=f"zip inválido: {e}")
+        except BaseException:
+            if zf is not None:
+                zf.close()
+            raise
+        items.extend(zipped)
+        manifest = manifest or zip_manifest
+    try:
+        if not items:
+            raise HTTPException(status_code=400, detail="nenhum arquivo enviado (files ou archive)")
+        if len(items) > settings.batch_max_files:
+            raise HTTPException(status_code=413, detail=f"lote acima do limite de {settings.batch_max_files} arquivos")
+        by_file = _batch_manifest(manifest)
+    except HTTPException:
+        if zf is not None:
+            zf.close()
+        raise
+    priority = _request_priority(request.headers.get(settings.admission_priority_header))
+    # Limita quantas faturas do lote disputam a admissão ao mesmo tempo: o resto espera aqui,
+    # sem ocupar a fila compartilhada com as requisições avulsas
+    parallel = asyncio.Semaphore(settings.batch_max_parallel or ADMISSION.max_active)
+    log(f"[batch] lote recebido: {len(items)} arquivos")
+
+    async def run_item(
+        index: int, name: str, content_type: str | None, raw: UploadFile | zipfile.ZipInfo | None
+    ) -> Dict[str, Any]:
+        spec = by_file.get(name) or by_file.get(Path(name).name) or {}
+        item_concessionaria = str(spec.get("concessionaria") or concessionaria)
+        item_uf = str(spec.get("uf") or uf)
+        item_password = str(spec["password"]) if spec.get("password") else None
+        line: Dict[str, Any] = {"index": index, "file": name, "concessionaria": item_concessionaria, "uf": item_uf}
+        t_item = time.perf_counter()
+        try:
+            if raw is None:
+                raise HTTPException(status_code=413, detail=f"imagem acima do limite de {settings.max_image_mb}MB")
+            _check_extraction_fields(item_concessionaria, item_uf, content_type)
+            if isinstance(raw, UploadFile) and _upload_size(raw) > settings.max_image_mb * 1024 * 1024:
+                raise HTTPException(status_code=413, detail=f"imagem acima do limite de {settings.max_image_mb}MB")
+            async with parallel:
+                # Lê (ou descompacta) só quando a fatura vai rodar: no máximo `parallel` em memória
+                if isinstance(raw, zipfile.ZipInfo):
+                    raw = await asyncio.to_thread(zf.read, raw)
+                else:
+                    upload, raw = raw, await raw.read()
+                    await upload.close()
+                _check_upload_size(raw)
+                payload, headers = await _extract_when_admitted(
+                    raw, item_concessionaria, item_uf, priority=priority, pdf_password=item_password
+                )
+            line.update(status="ok", cache=headers.get("X-Cache"), result=payload)
+        except HTTPException as e:
+            line.update(status="error", status_code=e.status_code, error=str(e.detail))
+        except zipfile.BadZipFile as e:
+            line.update(status="error", status_code=400, error=f"entrada do zip inválida: {e}")
+        except Exception as e:
+            line.update(status="error", status_code=500, error=f"{type(e).__name__}: {e}")
+        line["ms"] = int((time.perf_counter() - t_item) * 1000)
+        return line
+
+    async def stream():
+        t_batch = time.perf_counter()
+        tasks = [asyncio.create_task(run_item(i, *it)) for i, it in enumerate(items)]
+        items.clear()
+        ok = 0
+        try:
+            for fut in asyncio.as_completed(tasks):
+                line = await fut
+                ok += line["status"] == "ok"
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+            summary = {
+                "summary": True,
+                "total": len(tasks),
+                "ok": ok,
+                "errors": len(tasks) - ok,
+                "ms": int((time.perf_counter() - t_batch) * 1000),
+            }
+            log(f"[batch] lote concluído: {summary}")
+            yield json.dumps(summary) + "\n"
+        finally:
+            # Cliente desconectou no meio do lote: não segue processando o que falta
+            for t in tasks:
+                t.cancel()
+            if zf is not None:
+                # Leituras já em andamento terminam: o ZipFile só fecha o arquivo com a última
+                zf.close()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
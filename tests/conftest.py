@@ -0,0 +1,12 @@
+from __future__ import annotations
+
+import os
+import tempfile
+
+from config import settings
+
+# Os testes da API sobem o app com o backend determinístico, sem cache em disco e com a fila
+# de jobs num diretório temporário; precisa rodar antes do primeiro `import main`
+settings.inference_backend = "fake"
+settings.result_cache_dir = None
+settings.jobs_db_path = os.path.join(tempfile.mkdtemp(prefix="extractor-tests-"), "jobs.sqlite3")
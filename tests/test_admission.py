@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from utils.admission import AdmissionController, AdmissionRejected
+
+
+async def _hold(ctrl: AdmissionController, priority: int, order: list, release: asyncio.Event, name: str) -> None:
+    async with ctrl.slot(priority):
+        order.append(name)
+        await release.wait()
+
+
+def test_queue_is_ordered_by_priority_then_arrival():
+    async def run():
+        ctrl = AdmissionController(max_active=1, max_queue=10)
+        order: list[str] = []
+        release = asyncio.Event()
+        first = asyncio.create_task(_hold(ctrl, 0, order, release, "first"))
+        await asyncio.sleep(0)
+        waiting = [
+            asyncio.create_task(_hold(ctrl, prio, order, release, name))
+            for name, prio in [("low-a", 0), ("high", 5), ("low-b", 0), ("mid", 2)]
+        ]
+        await asyncio.sleep(0)
+        assert ctrl.stats()["queued"] == 4
+        release.set()
+        await asyncio.gather(first, *waiting)
+        return order, ctrl.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["first", "high", "mid", "low-a", "low-b"]
+    assert stats["active"] == 0 and stats["queued"] == 0
+    assert stats["admitted"] == 5
+
+
+def test_full_queue_rejects_or_preempts_lower_priority():
+    async def run():
+        ctrl = AdmissionController(max_active=1, max_queue=1)
+        release = asyncio.Event()
+        order: list[str] = []
+        running = asyncio.create_task(_hold(ctrl, 0, order, release, "running"))
+        await asyncio.sleep(0)
+        low = asyncio.create_task(_hold(ctrl, 0, order, release, "low"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as same:
+            await _hold(ctrl, 0, order, release, "same")
+        high = asyncio.create_task(_hold(ctrl, 3, order, release, "high"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as preempted:
+            await low
+        release.set()
+        await asyncio.gather(running, high)
+        return same.value, preempted.value, order, ctrl.stats()
+
+    same, preempted, order, stats = asyncio.run(run())
+    assert same.reason == "fila de extração cheia" and same.retry_after_s >= 1
+    assert "maior prioridade" in preempted.reason
+    assert order == ["running", "high"]
+    assert stats["preempted"] == 1 and stats["rejected"] == 2
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_queue_timeout_rejects_and_restores_counters():
+    async def run():
+        ctrl = AdmissionController(max_active=1, max_queue=5, queue_timeout_s=0.02)
+        release = asyncio.Event()
+        running = asyncio.create_task(_hold(ctrl, 0, [], release, "running"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await _hold(ctrl, 0, [], release, "late")
+        queued_after = ctrl.stats()["queued"]
+        release.set()
+        await running
+        return timed_out.value, queued_after, ctrl.stats()
+
+    err, queued_after, stats = asyncio.run(run())
+    assert "tempo máximo" in err.reason
+    assert queued_after == 0
+    assert stats["timed_out"] == 1 and stats["active"] == 0
+
+
+def test_preempted_and_cancelled_waiter_does_not_release_a_slot():
+    async def run():
+        ctrl = AdmissionController(max_active=1, max_queue=1)
+        release = asyncio.Event()
+        running = asyncio.create_task(_hold(ctrl, 0, [], release, "running"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(ctrl._acquire(0))
+        await asyncio.sleep(0)
+        # Preterido e cancelado no mesmo turno do loop
+        assert ctrl._preempt(5)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        active_while_running = ctrl.stats()["active"]
+        release.set()
+        await running
+        return active_while_running, ctrl.stats()
+
+    active_while_running, stats = asyncio.run(run())
+    assert active_while_running == 1
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_cancelled_waiter_with_granted_slot_hands_it_on():
+    async def run():
+        ctrl = AdmissionController(max_active=1, max_queue=5)
+        release = asyncio.Event()
+        order: list[str] = []
+        running = asyncio.create_task(_hold(ctrl, 0, order, release, "running"))
+        await asyncio.sleep(0)
+        granted = asyncio.create_task(_hold(ctrl, 0, order, release, "granted"))
+        nxt = asyncio.create_task(_hold(ctrl, 0, order, release, "next"))
+        await asyncio.sleep(0)
+        release.set()
+        await running
+        # O slot já foi passado para "granted", que é cancelado antes de acordar
+        granted.cancel()
+        await asyncio.gather(granted, return_exceptions=True)
+        await nxt
+        return order, ctrl.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["running", "next"]
+    assert stats["active"] == 0 and stats["queued"] == 0
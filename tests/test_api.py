@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import itertools
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+from inference.backends import GenerationOutput
+
+_COLORS = itertools.count(1)
+
+
+def _png() -> bytes:
+    """PNG com cor única por chamada, para não colidir no cache entre testes."""
+    n = next(_COLORS)
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), (n % 256, n // 256 % 256, 200)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+def _extract(client: TestClient, raw: bytes, concessionaria: str = "cemig", uf: str = "MG", **data):
+    return client.post(
+        "/extract/energy",
+        data={"concessionaria": concessionaria, "uf": uf, **data},
+        files={"file": ("fatura.png", raw, "image/png")},
+    )
+
+
+def test_repeated_upload_is_served_from_the_cache(client):
+    raw = _png()
+    first = _extract(client, raw)
+    assert first.status_code == 200 and first.headers["X-Cache"] == "miss"
+    second = _extract(client, raw)
+    assert second.headers["X-Cache"] == "hit"
+    assert second.json() == first.json()
+    # Outra concessionária é outra chave
+    assert _extract(client, raw, "copel", "PR").headers["X-Cache"] == "miss"
+    assert client.get("/health").json()["result_cache"]["memory_hits"] >= 1
+
+
+def _native_pdf(total: str) -> bytes:
+    """PDF com camada de texto: rótulos/valores em linhas e texto de preenchimento."""
+    import fitz
+
+    doc = fitz.open()
+    page = doc.new_page()
+    rows = [
+        [(40, "CODIGO DO CLIENTE"), (300, "12345678")],
+        [(40, "VENCIMENTO"), (300, "TOTAL A PAGAR")],
+        [(40, "05/11/2025"), (300, f"R$ {total}")],
+        [(40, "OUT/25"), (100, "350"), (300, "SET/25"), (360, "320")],
+        [(40, "AGO/25"), (100, "298"), (300, "JUL/25"), (360, "310")],
+    ]
+    rows += [[(40, "texto de preenchimento da fatura com varias palavras soltas")]] * 8
+    for i, row in enumerate(rows):
+        for x, text in row:
+            page.insert_text((x, 60 + 24 * i), text, fontsize=9)
+    raw = doc.tobytes()
+    doc.close()
+    return raw
+
+
+def test_native_pdf_fields_come_from_the_text_layer(client):
+    resp = client.post(
+        "/extract/energy",
+        data={"concessionaria": "cemig", "uf": "MG"},
+        files={"file": ("fatura.pdf", _native_pdf("187,79"), "application/pdf")},
+    )
+    assert resp.status_code == 200, resp.text
+    body = resp.json()
+    assert body["cod_cliente"] == "12345678" and body["valor_fatura"] == 187.79
+    origem = body["origem_campos"]
+    assert origem["cod_cliente"] == origem["valor_fatura"] == origem["vencimento"] == "text"
+    assert origem["consumo_lista"] == origem["baixa_renda"] == "text"
+    # O que o texto não resolveu vem do modelo (imagem completa) ou da requisição
+    assert origem["nome_cliente"] == "full" and origem["distribuidora"] == "request"
+
+
+def test_generation_time_is_bounded_by_the_stage_timeout(monkeypatch):
+    class SlowEngine:
+        async def infer(self, *args):
+            await asyncio.sleep(0.05)
+            return GenerationOutput('{"ok": true}', tokens=4, max_tokens=64, finish_reason="stop")
+
+    # request_timeout_s não corta a geração: o limite é o da etapa do pipeline
+    monkeypatch.setattr(main, "ENGINE", SlowEngine())
+    monkeypatch.setattr(main.settings, "request_timeout_s", 0.01)
+    assert asyncio.run(main._infer_one(Image.new("RGB", (8, 8)), "prompt")) == '{"ok": true}'
+    assert main._stage_timeout("full") == main.settings.stage_timeouts_s["full"]
+    assert main._stage_timeout("sem-etapa") == 0.01
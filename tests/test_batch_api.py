@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import io
+import json
+import os
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+from config import settings
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+def _png(color: tuple[int, int, int]) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _lines(resp) -> list[dict]:
+    assert resp.status_code == 200 and resp.headers["content-type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in resp.text.splitlines()]
+
+
+def test_results_stream_in_completion_order_with_a_summary(client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("faturas/copel.png", _png((40, 50, 60)))
+        zf.writestr("manifest.json", json.dumps([{"file": "copel.png", "concessionaria": "copel", "uf": "PR"}]))
+    resp = client.post(
+        "/extract/energy/batch",
+        data={"concessionaria": "cemig", "uf": "MG"},
+        files=[
+            ("files", ("a.png", _png((70, 80, 90)), "image/png")),
+            ("files", ("notas.txt", b"texto", "text/plain")),
+            ("archive", ("lote.zip", archive.getvalue(), "application/zip")),
+        ],
+    )
+    lines = _lines(resp)
+    summary = lines.pop()
+    assert summary == {**summary, "summary": True, "total": 3, "ok": 2, "errors": 1}
+    # O arquivo recusado termina antes das extrações, apesar de vir depois no formulário
+    assert lines[0]["index"] == 1 and lines[0]["status_code"] == 400
+    by_file = {line["file"]: line for line in lines}
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    assert by_file["a.png"]["status"] == "ok" and by_file["a.png"]["concessionaria"] == "cemig"
+    assert by_file["faturas/copel.png"]["concessionaria"] == "copel"
+    assert by_file["faturas/copel.png"]["result"]["estado"] == "PR"
+
+
+def test_oversized_batches_are_refused_before_reading(client, monkeypatch):
+    monkeypatch.setattr(settings, "batch_max_files", 1)
+    files = [("files", (f"{i}.png", _png((i, i, i)), "image/png")) for i in range(2)]
+    assert client.post("/extract/energy/batch", files=files).status_code == 413
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        # Declara mais que batch_max_files * max_image_mb descompactados
+        zf.writestr("grande.png", b"\0" * (settings.max_image_mb * 1024 * 1024 + 1))
+    resp = client.post("/extract/energy/batch", files=[("archive", ("lote.zip", archive.getvalue(), "application/zip"))])
+    assert resp.status_code == 413 and "descompactados" in resp.json()["detail"]
+
+    # O próprio zip acima do limite do lote é recusado antes de ser aberto
+    monkeypatch.setattr(settings, "max_image_mb", 1)
+    resp = client.post(
+        "/extract/energy/batch",
+        files=[("archive", ("lote.zip", os.urandom(1024 * 1024 + 1), "application/zip"))],
+    )
+    assert resp.status_code == 413 and resp.json()["detail"] == "zip acima do limite de 1MB"
+
+
+def test_empty_batch_is_a_400(client):
+    assert client.post("/extract/energy/batch", data={"concessionaria": "cemig", "uf": "MG"}).status_code == 400
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+
+import pytest
+from PIL import Image
+
+from inference.backends import FakeBackend
+from inference.batching import BatchScheduler, _Job
+from inference.engine import InferenceEngine
+
+IMAGE = Image.new("RGB", (32, 32))
+PROMPT = "Extraia APENAS dados de consumo"
+
+
+class FlakyBackend(FakeBackend):
+    """FakeBackend que falha em new_sequence/advance conforme marcadores no prompt."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.live = 0
+
+    def new_sequence(self, image, prompt, *args, **kwargs):
+        if "FALHA_NOVA" in prompt:
+            raise ValueError("new_sequence")
+        seq = super().new_sequence(image, prompt, *args, **kwargs)
+        self.live += 1
+        return seq
+
+    def advance(self, seq, token):
+        if "FALHA_AVANCO" in seq.prompt and len(seq.tokens) >= 5:
+            raise ValueError("advance")
+        return super().advance(seq, token)
+
+    def release(self, seq):
+        self.live -= 1
+        super().release(seq)
+
+
+class _Crash(BaseException):
+    pass
+
+
+@pytest.fixture
+def engine():
+    backend = FlakyBackend(step_delay_s=0.002)
+    eng = InferenceEngine(backend, max_batch_size=4, batch_wait_ms=5)
+    yield eng
+    eng.shutdown()
+
+
+def test_failures_only_fail_their_own_job(engine):
+    async def run():
+        prompts = [PROMPT, "FALHA_NOVA " + PROMPT, "FALHA_AVANCO " + PROMPT, PROMPT]
+        return await asyncio.gather(*(engine.infer(IMAGE, p) for p in prompts), return_exceptions=True)
+
+    ok, new_err, adv_err, ok2 = asyncio.run(run())
+    assert str(new_err) == "new_sequence"
+    assert str(adv_err) == "advance"
+    assert ok.text == ok2.text and ok.finish_reason == "json_complete"
+    # O loop continua vivo e todas as sequências foram liberadas
+    assert asyncio.run(engine.infer(IMAGE, PROMPT)).text == ok.text
+    assert engine.backend.live == 0
+
+
+def test_cancelled_job_frees_its_slot(engine):
+    async def run():
+        slow = asyncio.wait_for(engine.infer(IMAGE, PROMPT), timeout=0.05)
+        results = await asyncio.gather(slow, engine.infer(IMAGE, PROMPT), return_exceptions=True)
+        await asyncio.sleep(0.05)
+        return results
+
+    timed_out, ok = asyncio.run(run())
+    assert isinstance(timed_out, asyncio.TimeoutError)
+    assert ok.finish_reason == "json_complete"
+    stats = engine.scheduler.stats()
+    assert stats["cancelled"] == 1
+    assert stats["active"] == 0
+    assert engine.backend.live == 0
+
+
+def test_submit_after_shutdown_fails_immediately():
+    eng = InferenceEngine(FakeBackend(), max_batch_size=2)
+    eng.shutdown()
+    fut = eng.submit(IMAGE, PROMPT)
+    assert isinstance(fut.exception(timeout=1), RuntimeError)
+
+
+def test_loop_crash_fails_active_and_queued_futures():
+    backend = FlakyBackend()
+    started = threading.Event()
+
+    def decode_step(seqs, tokens):
+        started.wait()
+        raise _Crash()
+
+    backend.decode_step = decode_step
+    scheduler = BatchScheduler(backend, max_batch_size=1, wait_ms=0)
+    jobs: queue.Queue = queue.Queue()
+    active, queued = Future(), Future()
+    scheduler.enqueue(jobs, _Job(active, IMAGE, PROMPT, "", None, None, None))
+    scheduler.enqueue(jobs, _Job(queued, IMAGE, PROMPT, "", None, None, None))
+
+    def run():
+        with pytest.raises(_Crash):
+            scheduler.run_forever(jobs)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.set()
+    thread.join(timeout=5)
+
+    assert isinstance(active.exception(timeout=1), RuntimeError)
+    assert isinstance(queued.exception(timeout=1), RuntimeError)
+    assert backend.live == 0
+    late = Future()
+    scheduler.enqueue(jobs, _Job(late, IMAGE, PROMPT, "", None, None, None))
+    assert isinstance(late.exception(timeout=1), RuntimeError)
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import json
+
+from bulk_extract import _load_checkpoint, _Writer
+
+
+def test_checkpoint_skips_truncated_and_keyless_rows(tmp_path):
+    out = tmp_path / "saida.jsonl"
+    out.write_text(
+        json.dumps({"key": "a", "status": "ok"}) + "\n"
+        + json.dumps({"key": "b", "status": "error"}) + "\n"
+        + json.dumps({"status": "ok"}) + "\n"
+        + "[1, 2]\n"
+        + '{"key": "c", "sta',
+        encoding="utf-8",
+    )
+    assert _load_checkpoint(out, retry_errors=True) == {"a"}
+    assert _load_checkpoint(out, retry_errors=False) == {"a", "b"}
+
+
+def test_writer_starts_on_a_new_line_after_a_truncated_one(tmp_path):
+    out = tmp_path / "saida.jsonl"
+    out.write_text('{"key": "a"}\n{"key": "b", "sta', encoding="utf-8")
+    writer = _Writer(out, fsync_every=1)
+    writer.write({"key": "c", "status": "ok"})
+    writer.close()
+    assert out.read_text(encoding="utf-8").splitlines()[-1] == '{"key": "c", "status": "ok"}'
+
+    # Arquivo terminado em quebra de linha não ganha linha em branco
+    writer = _Writer(out, fsync_every=1)
+    writer.write({"key": "d"})
+    writer.close()
+    assert "" not in out.read_text(encoding="utf-8").splitlines()
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import json
+
+from PIL import Image
+
+from inference.backends import FakeBackend
+from inference.constrained import GrammarMasker, JsonSchemaGrammar, SchemaConstraint, TokenVocabulary
+
+EOS = -1
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cep": {"type": "string"},
+        "consumo_lista": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"mes_ano": {"type": "string"}, "consumo": {"type": "integer"}},
+            },
+        },
+        "valor": {"type": ["number", "null"]},
+        "baixa_renda": {"type": "boolean"},
+    },
+}
+SAMPLE = {
+    "cep": 'Rua "A" \\ 1',
+    "consumo_lista": [{"mes_ano": "01/2025", "consumo": 350}, {"mes_ano": "02/2025", "consumo": -7}],
+    "valor": 1.5e3,
+    "baixa_renda": False,
+}
+# Caracteres soltos + tokens de vários caracteres com aspas, escapes e espaços misturados
+TOKENS = [chr(c) for c in [9, 10, *range(0x20, 0x7F)]] + [
+    '"', '""', '":', '": "', '", "', '"}', '"]', '\\"', '"\\n', 'ab"', '"ab', '"ab",', " ab", "\n  ", "12", "0.", "e+",
+    "true", "fal", "null", "cep", '{"', '[{', "}]", "},", "},{", "Rua", " Rua", "ção",
+]
+
+
+def _vocabulary() -> TokenVocabulary:
+    return TokenVocabulary(list(enumerate(TOKENS)))
+
+
+def test_grammar_accepts_schema_and_rejects_violations():
+    grammar = JsonSchemaGrammar(SCHEMA)
+    state = grammar.feed(grammar.initial, json.dumps(SAMPLE, indent=2))
+    assert state is not None and grammar.is_complete(state)
+    assert grammar.feed(grammar.initial, '{"consumo_lista"') is None
+    assert grammar.feed(grammar.initial, '{"cep": 1') is None
+    integer = JsonSchemaGrammar({"type": "integer"})
+    assert integer.feed(integer.initial, "1.5") is None
+
+
+def test_masks_match_per_token_check():
+    grammar = JsonSchemaGrammar(SCHEMA)
+    masker = GrammarMasker(grammar, _vocabulary(), [EOS], to_array=frozenset)
+    state = grammar.initial
+    for ch in json.dumps(SAMPLE, indent=1, ensure_ascii=False):
+        expected = {i for i, text in enumerate(TOKENS) if grammar.feed(state, text) is not None} or {EOS}
+        assert masker.allowed(state) == expected, state
+        state = grammar.step(state, ch)
+    assert masker.allowed(state) == {EOS}
+
+
+def test_unbounded_array_items_reuse_mask_states():
+    grammar = JsonSchemaGrammar(SCHEMA)
+    masker = GrammarMasker(grammar, _vocabulary(), [EOS], to_array=frozenset)
+    cursor = SchemaConstraint(masker)
+    text = json.dumps({**SAMPLE, "consumo_lista": SAMPLE["consumo_lista"] * 10})
+    computed_at_item = []
+    for ch in text:
+        cursor.allowed()
+        cursor.advance(ch)
+        if ch == "}":
+            computed_at_item.append(masker.computed)
+    assert cursor.complete
+    # Do segundo item em diante nenhum estado novo
+    assert computed_at_item[1] == computed_at_item[-2]
+
+
+def test_mask_cache_is_lru():
+    grammar = JsonSchemaGrammar(SCHEMA)
+    masker = GrammarMasker(grammar, _vocabulary(), [EOS], to_array=frozenset, max_states=2)
+    a = grammar.initial
+    b = grammar.feed(a, "{")
+    c = grammar.feed(b, '"')
+    masker.allowed(a)
+    masker.allowed(b)
+    masker.allowed(a)
+    masker.allowed(c)
+    assert masker.computed == 3
+    masker.allowed(a)
+    assert masker.computed == 3
+    masker.allowed(b)
+    assert masker.computed == 4
+
+
+def test_state_outside_grammar_is_unconstrained():
+    masker = GrammarMasker(JsonSchemaGrammar(SCHEMA), _vocabulary(), [EOS], to_array=frozenset)
+    cursor = SchemaConstraint(masker)
+    cursor.advance("x")
+    assert cursor.state is None
+    assert cursor.allowed() is None
+    assert not cursor.complete
+
+
+def test_fake_backend_with_schema_drops_markdown_fence():
+    payload = json.dumps(SAMPLE, ensure_ascii=False)
+    backend = FakeBackend(responses={"full": f"```json\n{payload}\n```"})
+    out = backend.generate(Image.new("RGB", (8, 8)), "prompt", schema=SCHEMA)
+    assert json.loads(out.text) == SAMPLE
+    assert out.finish_reason == "json_complete"
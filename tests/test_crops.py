@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import pymupdf
+from PIL import Image, ImageStat
+
+import main
+from utils.pdf_pages import PdfPages
+
+
+def _source() -> Image.Image:
+    """Página 400x600 com um retângulo preto em (100, 200)-(300, 400)."""
+    img = Image.new("RGB", (400, 600), "white")
+    img.paste((0, 0, 0), (100, 200, 300, 400))
+    return img
+
+
+def test_box_found_on_the_proxy_is_cut_from_the_source():
+    source = _source()
+    proxy = source.resize((200, 300))
+    crop = main._cut_crop((50, 100, 150, 200), proxy, source, None, 0, 10**6)
+    assert crop.size == (200, 200)
+    assert crop.getextrema() == ((0, 0), (0, 0), (0, 0))
+
+
+def test_crop_is_clamped_and_fitted_to_the_budget():
+    source = _source()
+    crop = main._cut_crop((-20, 100, 500, 700), source, source, None, 0, 10_000)
+    # (0, 100)-(400, 600) reduzido para caber em 10k pixels
+    assert crop.width * crop.height <= 10_000
+    assert abs(crop.width / crop.height - 400 / 500) < 0.05
+    assert main._cut_crop(None, source, source, None, 0, 10_000) is None
+    assert main._cut_crop((300, 10, 300, 50), source, source, None, 0, 10_000) is None
+
+
+def test_pdf_box_is_rendered_again_as_a_clip():
+    doc = pymupdf.open()
+    page = doc.new_page(width=400, height=600)
+    page.draw_rect(pymupdf.Rect(100, 200, 300, 400), fill=(0, 0, 0))
+    raw = doc.tobytes()
+    doc.close()
+    with PdfPages(raw) as pdf:
+        preview = pdf.render(0, 200 * 300)
+        crop = main._cut_crop((55, 105, 145, 195), preview, preview, pdf, 0, 400 * 400)
+    # O clip sai em resolução maior que a prévia, dentro do orçamento
+    assert crop.width > 100 and crop.width * crop.height <= 400 * 400
+    assert ImageStat.Stat(crop.convert("L")).mean[0] < 8
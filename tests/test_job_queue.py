@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import http.server
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from utils import job_queue
+from utils.job_queue import JobRunner, JobStore, check_callback_url
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = JobStore(str(tmp_path / "jobs.sqlite3"), max_attempts=2)
+    yield s
+    s.close()
+
+
+def test_claim_takes_highest_priority_then_oldest(store):
+    first = store.submit(b"a", "cemig", "MG")
+    time.sleep(0.001)
+    urgent = store.submit(b"b", "cemig", "MG", priority=5)
+    time.sleep(0.001)
+    second = store.submit(b"c", "cemig", "MG")
+    claimed = [store.claim()["id"] for _ in range(3)]
+    assert claimed == [urgent, first, second]
+    assert store.claim() is None
+    assert store.get(first)["status"] == "running" and store.get(first)["attempts"] == 1
+
+
+def test_recover_requeues_until_max_attempts(store):
+    job_id = store.submit(b"a", "cemig", "MG", pdf_password="segredo")
+    store.claim()
+    assert store.recover() == 1
+    assert store.get(job_id)["status"] == "queued"
+
+    assert store.claim()["id"] == job_id and store.password(job_id) == "segredo"
+    assert store.get(job_id)["attempts"] == 2
+    assert store.recover() == 0
+    failed = store.get(job_id)
+    assert failed["status"] == "error" and "reiniciado" in failed["error"]
+
+
+def test_password_stays_in_memory_and_is_dropped_on_finish(store, tmp_path):
+    job_id = store.submit(b"a", "cemig", "MG", pdf_password="segredo")
+    assert b"segredo" not in (tmp_path / "jobs.sqlite3").read_bytes()
+    store.claim()
+    store.finish(job_id, result={"ok": True})
+    assert store._db.execute("SELECT payload FROM jobs WHERE id=?", (job_id,)).fetchone()[0] is None
+    assert store.password(job_id) is None
+    assert store.get(job_id)["result"] == {"ok": True}
+
+
+def test_protected_job_from_a_previous_process_fails_on_recover(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    old = JobStore(path)
+    protected = old.submit(b"a", "cemig", "MG", pdf_password="segredo")
+    plain = old.submit(b"b", "cemig", "MG")
+    old.close()
+
+    store = JobStore(path)
+    assert store.recover() == 0
+    failed = store.get(protected)
+    assert failed["status"] == "error" and "senha" in failed["error"]
+    assert store.get(plain)["status"] == "queued"
+    store.close()
+
+
+def test_purge_removes_only_old_finished_jobs(store):
+    done = store.submit(b"a", "cemig", "MG")
+    queued = store.submit(b"b", "cemig", "MG")
+    store.claim()
+    store.finish(done, error="falhou", error_status=400)
+    assert store.purge(older_than_s=3600) == 0
+    assert store.purge(older_than_s=-1) == 1
+    assert store.get(done) is None and store.get(queued) is not None
+    assert store.counts() == {"queued": 1}
+
+
+def test_old_database_gains_new_columns(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, "
+        "concessionaria TEXT NOT NULL, uf TEXT NOT NULL, callback_url TEXT, payload BLOB, result TEXT, error TEXT, "
+        "error_status INTEGER, attempts INTEGER NOT NULL DEFAULT 0, callback_status TEXT, created_at REAL NOT NULL, "
+        "started_at REAL, finished_at REAL)"
+    )
+    db.close()
+    store = JobStore(str(path))
+    job_id = store.submit(b"a", "cemig", "MG", pdf_password="x")
+    assert store.claim()["id"] == job_id
+    store.close()
+
+
+def test_plaintext_passwords_of_old_databases_are_wiped(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    JobStore(str(path)).close()
+    db = sqlite3.connect(path)
+    db.execute("ALTER TABLE jobs ADD COLUMN pdf_password TEXT")
+    db.execute(
+        "INSERT INTO jobs (id, status, concessionaria, uf, payload, pdf_password, created_at) "
+        "VALUES ('j1', 'queued', 'cemig', 'MG', x'00', 'segredo', 0)"
+    )
+    db.commit()
+    db.close()
+    store = JobStore(str(path))
+    row = store._db.execute("SELECT pdf_password, needs_password FROM jobs WHERE id='j1'").fetchone()
+    assert tuple(row) == (None, 1)
+    store.recover()
+    assert store.get("j1")["status"] == "error"
+    store.close()
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "ftp://8.8.8.8/cb",
+        "http:///sem-host",
+        "http://127.0.0.1:8000/cb",
+        "http://10.1.2.3/cb",
+        "http://192.168.0.10/cb",
+        "http://169.254.169.254/latest/meta-data",
+        "http://[::1]/cb",
+        "http://[::ffff:127.0.0.1]/cb",
+        "http://0.0.0.0/cb",
+    ],
+)
+def test_callback_url_refuses_non_public_targets(url):
+    with pytest.raises(ValueError):
+        check_callback_url(url)
+
+
+def test_callback_url_accepts_public_addresses_and_allowlist():
+    check_callback_url("https://8.8.8.8/cb")
+    check_callback_url("http://127.0.0.1:9000/cb", allowed_hosts=["127.0.0.1"])
+    with pytest.raises(ValueError):
+        check_callback_url("https://8.8.8.8/cb", allowed_hosts=["hooks.exemplo.com.br"])
+
+
+def test_callback_connects_to_the_validated_address(monkeypatch):
+    seen = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            seen["host"] = self.headers["Host"]
+            seen["body"] = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    port = server.server_address[1]
+    # O nome não resolve: a conexão só chega ao servidor pelo IP devolvido na validação
+    monkeypatch.setattr(job_queue, "check_callback_url", lambda url, allowed: "127.0.0.1")
+    runner = JobRunner(None, None)
+    try:
+        assert runner._post(f"http://callback.invalid:{port}/cb?x=1", b'{"ok": true}') == 204
+    finally:
+        thread.join(timeout=5)
+        server.server_close()
+    assert seen == {"host": f"callback.invalid:{port}", "body": {"ok": True}}
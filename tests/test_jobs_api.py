@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import io
+import time
+
+import pymupdf
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+def _png(color: tuple[int, int, int]) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _submit(client: TestClient, raw: bytes, content_type: str = "image/png", **data):
+    return client.post(
+        "/jobs/extract/energy",
+        data={"concessionaria": "cemig", "uf": "MG", **data},
+        files={"file": ("fatura", raw, content_type)},
+    )
+
+
+def _wait(client: TestClient, job_id: str, timeout_s: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("done", "error"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} não terminou em {timeout_s}s")
+
+
+def test_submitted_job_is_processed_and_polled(client):
+    raw = _png((10, 20, 30))
+    resp = _submit(client, raw)
+    assert resp.status_code == 202
+    job_id = resp.json()["job_id"]
+    assert resp.headers["Location"] == f"/jobs/{job_id}"
+
+    job = _wait(client, job_id)
+    assert job["status"] == "done" and job["attempts"] == 1 and job["error"] is None
+    # Mesmo pipeline da rota síncrona: o resultado já está no cache
+    sync = client.post(
+        "/extract/energy",
+        data={"concessionaria": "cemig", "uf": "MG"},
+        files={"file": ("fatura.png", raw, "image/png")},
+    )
+    assert sync.headers["X-Cache"] == "hit" and sync.json() == job["result"]
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/jobs/nao-existe").status_code == 404
+
+
+def test_wrong_pdf_password_and_private_callback_are_refused_at_submit(client):
+    doc = pymupdf.open()
+    doc.new_page().insert_text((40, 60), "fatura protegida")
+    raw = doc.tobytes(encryption=pymupdf.PDF_ENCRYPT_AES_256, owner_pw="dono", user_pw="segredo")
+    doc.close()
+    assert _submit(client, raw, "application/pdf").status_code == 400
+    assert _submit(client, raw, "application/pdf", password="errada").status_code == 400
+    assert _submit(client, raw, "application/pdf", password="segredo").status_code == 202
+
+    resp = _submit(client, _png((1, 2, 3)), callback_url="http://127.0.0.1:8000/cb")
+    assert resp.status_code == 400
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from PIL import Image
+
+from inference.backends import FakeBackend
+from inference.json_stop import JsonStopTracker
+
+IMAGE = Image.new("RGB", (8, 8))
+
+
+def test_tracker_ignores_preamble_and_strings():
+    tracker = JsonStopTracker()
+    assert not tracker.feed('```json\n{"a": "}{", "b": [1, {"c": "]"}')
+    assert tracker.feed("]}")
+    assert tracker.feed("texto depois")
+
+
+def test_tracker_handles_escaped_quotes_and_top_level_arrays():
+    tracker = JsonStopTracker()
+    assert not tracker.feed('[{"a": "x\\"]"')
+    assert tracker.feed("}]")
+    assert tracker.chars == len('[{"a": "x\\"]"}]')
+
+
+def test_generation_stops_after_the_json_closes():
+    backend = FakeBackend(responses={"full": '```json\n{"a": 1}\n```\nobrigado'})
+    out = backend.generate(IMAGE, "prompt")
+    assert out.text == '```json\n{"a": 1}'
+    assert out.finish_reason == "json_complete"
+    assert out.tokens_saved == out.max_tokens - out.tokens
+
+    full = FakeBackend(responses={"full": '{"a": 1} fim'}, json_early_stop=False).generate(IMAGE, "prompt")
+    assert full.text == '{"a": 1} fim'
+    assert not full.early_stopped
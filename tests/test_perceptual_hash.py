@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import io
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+from utils.perceptual_hash import (
+    BKTree,
+    NearDuplicateIndex,
+    detail_difference,
+    detail_signature,
+    hamming,
+    image_hashes,
+)
+
+
+def _bill(total: str) -> Image.Image:
+    """Fatura sintética: mesmo layout, só o valor muda."""
+    img = Image.new("RGB", (900, 1200), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((40, 40, 860, 160), outline="black", width=4)
+    for y in range(220, 900, 60):
+        draw.line((40, y, 860, y), fill="gray", width=2)
+        draw.text((60, y + 15), "CONSUMO kWh 350 OUT/25", fill="black")
+    draw.text((450, 1000), f"TOTAL R$ {total}", fill="black", font=ImageFont.load_default(40))
+    return img
+
+
+def _reencode(img: Image.Image, quality: int) -> Image.Image:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return Image.open(io.BytesIO(buf.getvalue())).convert("RGB")
+
+
+def test_bk_tree_search_matches_brute_force():
+    rng = random.Random(7)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    tree = BKTree()
+    for i, h in enumerate(hashes):
+        tree.add(h, i)
+    for probe in hashes[:20]:
+        expected = sorted((hamming(probe, h), i) for i, h in enumerate(hashes) if hamming(probe, h) <= 24)
+        assert sorted(tree.search(probe, 24)) == expected
+
+
+def test_detail_signature_separates_reencode_from_other_bill():
+    original = _bill("187,79")
+    sig = detail_signature(original)
+    assert detail_difference(sig, detail_signature(_reencode(original, 70))) <= 96
+    assert detail_difference(sig, detail_signature(_bill("187,78"))) > 96
+
+
+def test_index_serves_only_verified_candidates():
+    original, other = _bill("187,79"), _bill("187,78")
+    index = NearDuplicateIndex(max_distance=12)
+    index.add("cemig", image_hashes(original), "k1", detail_signature(original))
+
+    def verify(detail):
+        return lambda value: detail_difference(detail, index.detail(value)) <= 96
+
+    copy = _reencode(original, 60)
+    assert index.find("cemig", image_hashes(copy), verify(detail_signature(copy)))[0] == "k1"
+    # Mesmo layout fica perto nos hashes, mas a assinatura de detalhe recusa
+    assert index.find("cemig", image_hashes(other), verify(detail_signature(other))) is None
+    # Escopo diferente nunca compartilha
+    assert index.find("copel", image_hashes(copy)) is None
+    stats = index.stats()
+    assert stats["hits"] == 1 and stats["rejected"] >= 1
+
+
+def test_index_drops_oldest_half_when_full():
+    index = NearDuplicateIndex(max_distance=0, max_entries=4)
+    for i in range(5):
+        index.add("s", (i, i), f"k{i}")
+    assert index.stats()["entries"] == 3
+    assert index.find("s", (0, 0)) is None
+    assert index.find("s", (4, 4)) == ("k4", 0)
+    index.discard("k4")
+    assert index.find("s", (4, 4)) is None
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from PIL import Image
+
+from inference.backends import Sequence, _user_messages
+
+IMAGE = Image.new("RGB", (8, 8))
+
+
+def test_prefix_comes_before_the_images_and_the_prompt_after():
+    seq = Sequence(image=[IMAGE, IMAGE], prompt="Uf: MG", max_tokens=8, prefix="base.md", prefix_key=("base",))
+    assert _user_messages(seq, 2) == [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "base.md"},
+            {"type": "image"},
+            {"type": "image"},
+            {"type": "text", "text": "Uf: MG"},
+        ],
+    }]
+
+
+def test_without_prefix_the_images_open_the_message():
+    seq = Sequence(image=IMAGE, prompt="Uf: MG", max_tokens=8)
+    assert [part["type"] for part in _user_messages(seq, 1)[0]["content"]] == ["image", "text"]
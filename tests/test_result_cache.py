@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from utils.result_cache import ResultCache
+
+
+def _payload(n: int) -> dict:
+    return {"cod_cliente": str(n), "pad": "x" * 80}
+
+
+def test_memory_lru_is_bounded_by_bytes():
+    cache = ResultCache(max_memory_bytes=300)
+    for key in "abc":
+        cache.put(key, _payload(ord(key)))
+    assert cache.get("a") is None
+    assert cache.get("c") == _payload(ord("c"))
+    cache.get("b")
+    cache.put("d", _payload(4))
+    # "c" foi o menos usado recentemente
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    stats = cache.stats()
+    assert stats["memory_bytes"] <= 300 and stats["evictions"] == 2
+
+
+def test_get_returns_a_copy():
+    cache = ResultCache(max_memory_bytes=1024)
+    cache.put("k", {"lista": [1]})
+    cache.get("k")["lista"].append(2)
+    assert cache.get("k") == {"lista": [1]}
+
+
+def test_disk_layer_survives_restart_and_promotes_hits(tmp_path):
+    cache = ResultCache(max_memory_bytes=1024, disk_dir=str(tmp_path), max_disk_bytes=10_000)
+    cache.put("k", _payload(1))
+    assert (tmp_path / "k.json").exists()
+    assert not list(tmp_path.glob("*.tmp"))
+
+    reopened = ResultCache(max_memory_bytes=1024, disk_dir=str(tmp_path), max_disk_bytes=10_000)
+    assert reopened.get("k") == _payload(1)
+    assert reopened.get("k") == _payload(1)
+    stats = reopened.stats()
+    assert stats["disk_hits"] == 1 and stats["memory_hits"] == 1
+
+
+def test_disk_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=250)
+    cache.put("old", _payload(1))
+    cache.put("new", _payload(2))
+    assert cache.get("old") is not None
+    cache.put("newest", _payload(3))
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["newest", "old"]
+
+
+def test_file_removed_externally_is_a_miss(tmp_path):
+    cache = ResultCache(max_memory_bytes=0, disk_dir=str(tmp_path), max_disk_bytes=10_000)
+    cache.put("k", _payload(1))
+    (tmp_path / "k.json").unlink()
+    assert cache.get("k") is None
+    assert cache.stats()["disk_entries"] == 0
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from utils.single_flight import SingleFlight
+
+
+def test_identical_calls_share_one_execution():
+    async def run():
+        flights = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "ok"
+
+        results = await asyncio.gather(*(flights.do("k", work) for _ in range(3)))
+        other = await flights.do("k", work)
+        return results, other, calls, flights.stats()
+
+    results, other, calls, stats = asyncio.run(run())
+    assert results == [("ok", False), ("ok", True), ("ok", True)]
+    # Terminada a chamada, a chave é liberada e a próxima roda de novo
+    assert other == ("ok", False)
+    assert calls == 2
+    assert stats == {"in_flight": 0, "started": 2, "shared": 2, "cancelled": 0}
+
+
+def test_cancelling_one_waiter_keeps_the_others():
+    async def run():
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return 42
+
+        a = asyncio.create_task(flights.do("k", work))
+        b = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0)
+        a.cancel()
+        return await b, a.cancelled(), flights.stats()
+
+    result, a_cancelled, stats = asyncio.run(run())
+    assert result == (42, True)
+    assert a_cancelled
+    assert stats["cancelled"] == 0
+
+
+def test_orphaned_work_is_cancelled_only_when_asked():
+    async def run(cancel_orphans: bool):
+        flights = SingleFlight(cancel_orphans=cancel_orphans)
+        finished = asyncio.Event()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            finished.set()
+
+        waiter = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.05)
+        return finished.is_set(), flights.stats()
+
+    finished, stats = asyncio.run(run(True))
+    assert not finished and stats["cancelled"] == 1 and stats["in_flight"] == 0
+    finished, stats = asyncio.run(run(False))
+    assert finished and stats["cancelled"] == 0 and stats["in_flight"] == 0
+
+
+def test_errors_reach_every_waiter_and_free_the_key():
+    async def run():
+        flights = SingleFlight()
+
+        async def boom():
+            await asyncio.sleep(0.01)
+            raise ValueError("falhou")
+
+        results = await asyncio.gather(flights.do("k", boom), flights.do("k", boom), return_exceptions=True)
+        return results, flights.stats()
+
+    results, stats = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert stats["in_flight"] == 0
+
+
+def test_different_keys_do_not_share():
+    async def run():
+        flights = SingleFlight()
+
+        async def work(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(flights.do("a", lambda: work(1)), flights.do("b", lambda: work(2)))
+
+    assert asyncio.run(run()) == [(1, False), (2, False)]
+
+
+@pytest.mark.parametrize("waiters", [1, 4])
+def test_result_is_the_same_object_for_all_waiters(waiters):
+    async def run():
+        flights = SingleFlight()
+        payload = {"a": 1}
+
+        async def work():
+            await asyncio.sleep(0.01)
+            return payload
+
+        results = await asyncio.gather(*(flights.do("k", work) for _ in range(waiters)))
+        return payload, results
+
+    payload, results = asyncio.run(run())
+    assert all(r[0] is payload for r in results)
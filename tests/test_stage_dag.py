@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from utils.stage_dag import Stage, run_dag, server_timing
+
+
+def test_independent_stages_run_in_parallel_and_dependents_wait():
+    async def run():
+        order: list[str] = []
+
+        def stage(name: str, delay: float):
+            async def fn(deps):
+                order.append(f"{name}:start")
+                await asyncio.sleep(delay)
+                order.append(f"{name}:end")
+                return {d: r.value for d, r in deps.items()}
+
+            return fn
+
+        results = await run_dag([
+            Stage("a", stage("a", 0.02)),
+            Stage("b", stage("b", 0.01)),
+            Stage("c", stage("c", 0), deps=("a", "b")),
+        ])
+        return order, results
+
+    order, results = asyncio.run(run())
+    assert order[:2] == ["a:start", "b:start"]
+    assert order[-2:] == ["c:start", "c:end"]
+    assert results["c"].value == {"a": {}, "b": {}}
+    assert results["c"].start_ms >= results["a"].elapsed_ms
+
+
+def test_failures_and_timeouts_stay_in_their_stage():
+    async def boom(deps):
+        raise ValueError("falhou")
+
+    async def slow(deps):
+        await asyncio.sleep(1)
+
+    async def after(deps):
+        return sorted(name for name, r in deps.items() if not r.ok)
+
+    results = asyncio.run(run_dag([
+        Stage("boom", boom),
+        Stage("slow", slow, timeout_s=0.01),
+        Stage("skip", None),
+        Stage("after", after, deps=("boom", "slow", "skip")),
+    ]))
+    assert results["boom"].status == "error" and str(results["boom"].error) == "falhou"
+    assert results["slow"].status == "timeout"
+    assert results["skip"].status == "skipped"
+    assert results["after"].value == ["boom", "skip", "slow"]
+    assert 'slow;dur=' in server_timing(results) and 'desc="timeout"' in server_timing(results)
+
+
+@pytest.mark.parametrize(
+    "stages",
+    [
+        [Stage("a", None, deps=("x",))],
+        [Stage("a", None, deps=("b",)), Stage("b", None, deps=("a",))],
+    ],
+)
+def test_invalid_graphs_are_refused(stages):
+    with pytest.raises(ValueError):
+        asyncio.run(run_dag(stages))
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from utils.text_layer import PARSERS, extract_fields, find_consumption, find_field, layout_rows, merge_rules
+
+RULES = json.loads((Path(__file__).resolve().parent.parent / "prompts" / "text_rules.json").read_text("utf-8"))
+
+
+def _words(lines: list[list[tuple[float, str]]], height: float = 10.0) -> list[tuple]:
+    """Palavras (x0, y0, x1, y1, texto) em linhas de altura fixa; x1 estimado pelo comprimento."""
+    out = []
+    for row, words in enumerate(lines):
+        y0 = row * 2 * height
+        for x0, text in words:
+            out.append((x0, y0, x0 + 5 * len(text), y0 + height, text))
+    return out
+
+
+@pytest.mark.parametrize(
+    "kind, text, expected",
+    [
+        ("money", "TOTAL R$ 1.234,56", 1234.56),
+        ("money", "12,3", None),
+        ("date", "Vence em 05/11/2025.", "05/11/2025"),
+        ("month", "OUT/25", "10/2025"),
+        ("month", "Referência: MAR / 2024", "03/2024"),
+        ("month", "10/2025", "10/2025"),
+        ("month", "13/2025", None),
+        ("percent", "18,00 %", 18.0),
+        ("percent", "12", 12.0),
+        ("percent", "0%", None),
+        ("voltage", "127/220 V", "127/220V"),
+        ("phase", "Ligação Trifásica", "TRIFASICO"),
+        ("class", "B1 Residencial", "RESIDENCIAL"),
+        ("cep", "CEP 74.000-123", "74.000-123"),
+        ("code", "Nº 3001234567", "3001234567"),
+        ("code", "UC 123", None),
+        ("text", " : Fulano - ", "Fulano"),
+    ],
+)
+def test_parsers(kind, text, expected):
+    assert PARSERS[kind](text) == expected
+
+
+def test_layout_groups_words_into_rows_and_cells():
+    rows = layout_rows(_words([[(10, "TOTAL"), (40, "A"), (47, "PAGAR"), (200, "R$"), (215, "99,90")]]))
+    assert [c.text for c in rows[0]] == ["TOTAL A PAGAR", "R$ 99,90"]
+
+
+def test_find_field_looks_right_and_below_the_label():
+    rows = layout_rows(_words([
+        [(10, "VENCIMENTO"), (200, "TOTAL"), (230, "A"), (237, "PAGAR")],
+        [(10, "05/11/2025"), (200, "123,45")],
+    ]))
+    assert find_field(rows, ["VENCIMENTO"], PARSERS["date"]) == ("05/11/2025", "VENCIMENTO")
+    assert find_field(rows, ["VALOR A PAGAR", "TOTAL A PAGAR"], PARSERS["money"]) == (123.45, "TOTAL A PAGAR")
+    assert find_field(rows, ["PROXIMA LEITURA"], PARSERS["date"]) is None
+
+
+def test_find_consumption_reads_month_pairs_once():
+    rows = layout_rows(_words([
+        [(10, "OUT/25"), (60, "350"), (200, "SET/25"), (250, "1200")],
+        [(10, "08/2025"), (60, "298"), (200, "OUT/25"), (250, "999")],
+        [(10, "Vencimento"), (80, "10/2025"), (130, "12,50")],
+    ]))
+    assert find_consumption(rows) == [
+        {"mes_ano": "10/2025", "consumo": 350},
+        {"mes_ano": "09/2025", "consumo": 1200},
+        {"mes_ano": "08/2025", "consumo": 298},
+    ]
+
+
+def test_merge_rules_overrides_per_field():
+    rules = merge_rules(RULES, "energisa-mt")
+    assert rules["fields"]["cod_cliente"] == {"type": "code", "labels": ["CODIGO DO CLIENTE"]}
+    assert rules["flags"]["faturas_venc"]["present"] is True
+    assert rules["constants"]["distribuidora"] == "ENERGISA"
+    assert merge_rules(RULES, "desconhecida")["constants"] == {}
+
+
+def test_extract_fields_applies_flags_and_constants():
+    rows = layout_rows(_words([
+        [(10, "CODIGO"), (47, "DO"), (62, "CLIENTE"), (200, "12345678")],
+        [(10, "Tarifa"), (45, "Social"), (90, "de"), (105, "Energia")],
+        [(10, "JAN/25"), (60, "100"), (120, "FEV/25"), (170, "110"), (230, "MAR/25"), (280, "120")],
+    ]))
+    out = extract_fields(rows, merge_rules(RULES, "cpfl"), words=20)
+    assert out.values["cod_cliente"] == "12345678"
+    assert out.values["baixa_renda"] is True and out.evidence["baixa_renda"] == "palavra-chave TARIFA SOCIAL"
+    assert out.values["tarifa_branca"] is False
+    # Sem seção de débitos: nada em aberto
+    assert out.values["faturas_venc"] is False and out.values["valores_em_aberto"] == []
+    assert len(out.values["consumo_lista"]) == 3
+    assert out.values["conta_contrato"] is None and out.constants == {"conta_contrato", "complemento"}
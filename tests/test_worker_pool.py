@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from functools import partial
+
+import pytest
+from PIL import Image
+
+from inference.backends import FakeBackend
+from inference.worker_pool import WorkerPool
+
+IMAGE = Image.new("RGB", (16, 16))
+PROMPT = "Extraia APENAS dados de consumo"
+
+
+class DyingBackend(FakeBackend):
+    """FakeBackend cujo processo morre quando o prompt pede."""
+
+    def generate(self, image, prompt, *args, **kwargs):
+        if "MORRA" in prompt:
+            os._exit(1)
+        return super().generate(image, prompt, *args, **kwargs)
+
+
+def _env_backend() -> FakeBackend:
+    """Responde com o OMP_NUM_THREADS visto pelo worker."""
+    return FakeBackend(responses={"full": os.environ.get("OMP_NUM_THREADS", "ausente")})
+
+
+@pytest.fixture
+def pool():
+    p = WorkerPool(partial(DyingBackend), 2, start_timeout_s=60)
+    yield p
+    p.shutdown()
+
+
+def test_jobs_are_answered_by_the_workers(pool):
+    async def run():
+        return await asyncio.gather(*(pool.infer(IMAGE, PROMPT) for _ in range(4)))
+
+    expected = FakeBackend().generate(IMAGE, PROMPT)
+    assert asyncio.run(run()) == [expected] * 4
+    stats = pool.stats()
+    assert stats["calls"] == 4 and stats["errors"] == 0
+    assert sum(w["jobs"] for w in stats["workers"]) == 4
+
+
+def test_crashed_worker_fails_only_its_job_and_is_restarted():
+    pool = WorkerPool(partial(DyingBackend), 1, start_timeout_s=60)
+    try:
+        with pytest.raises(RuntimeError, match="falha no worker"):
+            pool.submit(IMAGE, "MORRA " + PROMPT).result(timeout=60)
+        assert pool.submit(IMAGE, PROMPT).result(timeout=60) == FakeBackend().generate(IMAGE, PROMPT)
+        stats = pool.stats()
+        assert stats["crashes"] == 1 and stats["workers"][0]["restarts"] == 1
+    finally:
+        pool.shutdown()
+
+
+def test_worker_is_recycled_after_max_jobs():
+    pool = WorkerPool(partial(FakeBackend), 1, max_jobs=2, start_timeout_s=60)
+    try:
+        pids = set()
+        for _ in range(5):
+            pool.submit(IMAGE, PROMPT).result(timeout=60)
+            pids.add(pool.stats()["workers"][0]["pid"])
+        assert pool.stats()["recycles"] == 2
+        assert len(pids) == 3
+    finally:
+        pool.shutdown()
+
+
+def test_submit_after_shutdown_is_refused():
+    pool = WorkerPool(partial(FakeBackend), 1, start_timeout_s=60)
+    pool.shutdown()
+    with pytest.raises(RuntimeError):
+        pool.submit(IMAGE, PROMPT)
+
+
+def test_worker_drops_thread_limits_inherited_from_the_api(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "1")
+    pool = WorkerPool(_env_backend, 1, start_timeout_s=60)
+    try:
+        assert pool.submit(IMAGE, "prompt").result(timeout=60).text == "ausente"
+    finally:
+        pool.shutdown()
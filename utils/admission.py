@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+# Limites superiores (ms) dos buckets do histograma de espera na fila
+WAIT_BUCKETS_MS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, math.inf)
+# Limites superiores dos buckets do histograma de profundidade da fila (vista por quem chega)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, math.inf)
+
+
+class AdmissionRejected(Exception):
+    """Fila cheia (ou espera esgotada): o cliente deve tentar de novo após retry_after_s."""
+
+    def __init__(self, reason: str, retry_after_s: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class Histogram:
+    """Contagem por bucket (limite superior inclusivo), no formato cumulativo do Prometheus."""
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.n += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        cumulative, acc = {}, 0
+        for bound, c in zip(self.bounds, self.counts):
+            acc += c
+            cumulative["+Inf" if bound == math.inf else f"{bound:g}"] = acc
+        return {"buckets": cumulative, "count": self.n, "sum": round(self.total, 1)}
+
+
+class AdmissionController:
+    """
+    Controle de admissão das extrações: até max_active em execução e até max_queue esperando.
+
+    A fila é ordenada por prioridade (maior primeiro) e, dentro da mesma prioridade, por ordem
+    de chegada. Com a fila cheia a requisição é rejeitada na hora (AdmissionRejected) com um
+    Retry-After estimado pelo tempo médio de serviço, a menos que tenha prioridade maior que a
+    última da fila, que então é rejeitada no lugar dela. Quem espera mais que queue_timeout_s
+    também é rejeitado. Tudo roda no event loop, sem locks.
+    """
+
+    def __init__(self, max_active: int, max_queue: int, *, queue_timeout_s: float | None = None):
+        self.max_active = max(1, max_active)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout_s = queue_timeout_s
+        self._active = 0
+        self._heap: list[tuple[int, int, asyncio.Future]] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        # Média móvel do tempo de serviço (s), base do Retry-After
+        self._service_s = 5.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.preempted = 0
+        self.wait_ms = Histogram(WAIT_BUCKETS_MS)
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self.by_priority: dict[int, int] = {}
+
+    def retry_after_s(self) -> int:
+        """Estimativa de quando abre vaga: fila atual drenada por max_active slots."""
+        rounds = (self._queued + self._active) / self.max_active
+        return max(1, math.ceil(rounds * self._service_s))
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0) -> AsyncIterator[float]:
+        """Ocupa um slot de execução durante o bloco; entrega a espera na fila em ms."""
+        waited_ms = await self._acquire(priority)
+        started = time.perf_counter()
+        try:
+            yield waited_ms
+        finally:
+            elapsed = time.perf_counter() - started
+            self._service_s = 0.8 * self._service_s + 0.2 * elapsed
+            self._release()
+
+    async def _acquire(self, priority: int) -> float:
+        self.queue_depth.observe(self._queued)
+        if self._active < self.max_active and not self._queued:
+            self._active += 1
+            self._admit(priority, 0.0)
+            return 0.0
+        if self._queued >= self.max_queue and not self._preempt(priority):
+            self.rejected += 1
+            raise AdmissionRejected("fila de extração cheia", self.retry_after_s())
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (-priority, next(self._seq), fut))
+        self._queued += 1
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=self.queue_timeout_s)
+        except AdmissionRejected:
+            # Preterido por uma chegada de maior prioridade (_preempt já ajustou a fila)
+            raise
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                if fut.exception() is not None:
+                    # Preterido junto com o cancelamento/timeout: _preempt já tirou da fila e não
+                    # houve slot a devolver
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise fut.exception() from None
+                    raise
+                # O slot foi concedido junto com o cancelamento/timeout: devolve para o próximo
+                self._active -= 1
+                self._wake()
+            else:
+                fut.cancel()
+                self._queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise AdmissionRejected("tempo máximo de espera na fila esgotado", self.retry_after_s()) from None
+            raise
+        waited_ms = (time.perf_counter() - t0) * 1000
+        self._admit(priority, waited_ms)
+        return waited_ms
+
+    def _preempt(self, priority: int) -> bool:
+        """Rejeita o último da fila de menor prioridade se ela for menor que priority."""
+        waiting = [e for e in self._heap if not e[2].done()]
+        if not waiting:
+            return False
+        victim = max(waiting, key=lambda e: (e[0], e[1]))
+        if -victim[0] >= priority:
+            return False
+        self._queued -= 1
+        self.preempted += 1
+        self.rejected += 1
+        victim[2].set_exception(
+            AdmissionRejected("substituída na fila por requisição de maior prioridade", self.retry_after_s())
+        )
+        return True
+
+    def _admit(self, priority: int, waited_ms: float) -> None:
+        self.admitted += 1
+        self.by_priority[priority] = self.by_priority.get(priority, 0) + 1
+        self.wait_ms.observe(waited_ms)
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        """Passa slots livres para os próximos da fila (o slot já sai contado em _active)."""
+        while self._heap and self._active < self.max_active:
+            _, _, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue
+            self._queued -= 1
+            self._active += 1
+            fut.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "preempted": self.preempted,
+            "service_s_avg": round(self._service_s, 2),
+            "by_priority": dict(sorted(self.by_priority.items())),
+            "wait_ms": self.wait_ms.snapshot(),
+            "queue_depth": self.queue_depth.snapshot(),
+        }
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import io
+
+from PIL import Image
+
+
+def target_size(width: int, height: int, max_pixels: int) -> tuple[int, int]:
+    """Tamanho que cabe em max_pixels mantendo a proporção (o mesmo cálculo do resize antigo)."""
+    pixels = width * height
+    if pixels <= max_pixels:
+        return width, height
+    scale = (max_pixels / float(pixels)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def decode_downscaled(raw: bytes, max_pixels: int, page: int = 0) -> tuple[Image.Image, dict[str, object]]:
+    """
+    Decodifica a imagem (ou o quadro page de um TIFF) já reduzida para caber em max_pixels.
+
+    JPEG usa o escalonamento da DCT do decoder (draft: 1/2, 1/4 ou 1/8 durante a leitura), então
+    a imagem em resolução cheia nunca é alocada. Nos demais formatos a redução inteira (reduce)
+    roda antes da conversão para RGB. O ajuste final, de no máximo 2x, é um BICUBIC.
+    Retorna a imagem RGB e o que foi feito (tamanho original, após o decoder e final).
+    """
+    with Image.open(io.BytesIO(raw)) as src:
+        if page:
+            src.seek(page)
+        original = src.size
+        size = target_size(*original, max_pixels)
+        im: Image.Image = src
+        if size != original and src.format == "JPEG":
+            src.draft("RGB", size)
+        decoded = src.size
+        if im.mode not in ("RGB", "L"):
+            # Paleta, CMYK, RGBA...: o resize precisa de um modo "contínuo"
+            im = im.convert("RGB")
+        if im.size != size:
+            # reducing_gap faz a redução inteira (média de blocos) antes do BICUBIC
+            im = im.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        img = im.convert("RGB") if im.mode != "RGB" else (im.copy() if im is src else im)
+    return img, {"original": original, "decoded": decoded, "final": img.size}
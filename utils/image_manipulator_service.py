@@ -2,15 +2,18 @@ import cv2
 import os
 import io
 import tempfile
-import fitz
 
 from pathlib import Path
 from PIL import Image
 
+from utils.pdf_pages import PdfPages
+
 class ImageManipulatorService:
     def __init__(self):
         self.max_size_mb = 10 
         self.max_size_px = 1500 
+        self.max_pixels = 1_500_000
+        self.pdf_max_dpi = 300
 
     def convert_to_png(self, input_path: str, password: str = None) -> Image.Image | list[Image.Image]:
         try:
@@ -27,43 +30,11 @@ class ImageManipulatorService:
             raise
 
     def _convert_pdf_to_png(self, pdf_path: str, password: str = None) -> list[Image.Image]:
-        pdf_document = None
-        try:
-            # Abrir PDF
-            pdf_document = fitz.open(pdf_path)
-            
-            # Autenticar com senha se fornecida e necessária
-            if pdf_document.needs_pass:
-                if password:
-                    if not pdf_document.authenticate(password):
-                        raise ValueError(f"Senha incorreta para PDF: {pdf_path}")
-                else:
-                    raise ValueError(f"PDF requer senha mas nenhuma foi fornecida: {pdf_path}")
-            
-            images = []
-            
-            for page_num in range(len(pdf_document)):
-                page = pdf_document.load_page(page_num)
-                
-                mat = fitz.Matrix(3.0, 3.0)  
-                pix = page.get_pixmap(matrix=mat, alpha=False)
-                
-                img_data = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_data))
-                images.append(img)
-                
-            
-            return images
-            
-        except Exception as e:
-            raise
-        finally:
-            # SEMPRE fechar o PDF, mesmo em caso de exceção
-            if pdf_document is not None:
-                try:
-                    pdf_document.close()
-                except Exception as close_error:
-                    raise
+        # Cada página é renderizada direto no tamanho usado pelo pipeline (max_pixels), sem o
+        # encode/decode PNG intermediário; senha ausente/incorreta vira PdfError (ValueError)
+        with PdfPages(Path(pdf_path).read_bytes(), password=password) as pdf:
+            return [pdf.render(i, self.max_pixels, self.pdf_max_dpi) for i in range(len(pdf))]
+
     def _convert_image_to_png(self, image_path: str) -> Image.Image:
         try:
             img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
@@ -149,35 +120,6 @@ class ImageManipulatorService:
         except Exception as e:
             return None
 
-    def crop_image(self, image_path, crop_area):
-        if not os.path.exists(image_path):
-            return None
-            
-        if not (isinstance(crop_area, tuple) and len(crop_area) == 4):
-            return None
-            
-        try:
-            img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-            if img is None:
-                return None
-                
-            cropped_img = img[crop_area[1]:crop_area[3], crop_area[0]:crop_area[2]]
-            
-            temp_file = tempfile.NamedTemporaryFile(
-                suffix=Path(image_path).suffix,
-                delete=False,
-                prefix="cropped_"
-            )
-            temp_path = temp_file.name
-            temp_file.close()
-            
-            cv2.imwrite(temp_path, cropped_img)
-            
-            return temp_path
-            
-        except Exception as e:
-            return None
-
     def rotate_image(self, image_path, angle):
         """
         Rotaciona uma imagem
@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+import asyncio
+import http.client
+import ipaddress
+import json
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Collection
+
+from utils.log import log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    concessionaria TEXT NOT NULL,
+    uf TEXT NOT NULL,
+    callback_url TEXT,
+    payload BLOB,
+    needs_password INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    error_status INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    callback_status TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at);
+"""
+# Colunas adicionadas depois da primeira versão do schema (bancos antigos ganham via ALTER TABLE)
+_ADDED_COLUMNS = {"needs_password": "INTEGER NOT NULL DEFAULT 0"}
+_PASSWORD_LOST = "senha do PDF perdida no reinício do processo; reenvie o job"
+
+
+class JobStore:
+    """
+    Fila persistente de jobs de extração em SQLite (sobrevive a reinícios do processo).
+
+    O upload fica no próprio banco até o job terminar. A senha do PDF, se houver, fica só na
+    memória do processo (nunca em disco): um job protegido que sobra de um processo anterior
+    termina em erro no boot, pedindo reenvio. Jobs que estavam em execução quando o processo
+    caiu voltam para a fila no boot, até max_attempts tentativas.
+    """
+
+    def __init__(self, path: str, *, max_attempts: int = 3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for name, kind in _ADDED_COLUMNS.items():
+            if name not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+        if "pdf_password" in columns:
+            # Bancos que guardavam a senha em texto: apaga e mantém só a marca de job protegido
+            self._db.execute(
+                "UPDATE jobs SET needs_password=1, pdf_password=NULL WHERE pdf_password IS NOT NULL"
+            )
+        self._passwords: dict[str, str] = {}
+
+    def recover(self) -> int:
+        """
+        Devolve à fila os jobs interrompidos; os que esgotaram as tentativas viram erro, assim
+        como os protegidos por senha cuja senha não está na memória deste processo.
+        """
+        with self._lock:
+            now = time.time()
+            self._db.execute(
+                "UPDATE jobs SET status='error', error='processo reiniciado durante a extração', "
+                "payload=NULL, finished_at=? WHERE status='running' AND attempts>=?",
+                (now, self.max_attempts),
+            )
+            pending = self._db.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') AND needs_password=1"
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET status='error', error=?, payload=NULL, finished_at=? WHERE id=?",
+                [(_PASSWORD_LOST, now, row["id"]) for row in pending if row["id"] not in self._passwords],
+            )
+            return self._db.execute(
+                "UPDATE jobs SET status='queued', started_at=NULL WHERE status='running'"
+            ).rowcount
+
+    def submit(
+        self,
+        payload: bytes,
+        concessionaria: str,
+        uf: str,
+        *,
+        priority: int = 0,
+        callback_url: str | None = None,
+        pdf_password: str | None = None,
+    ) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if pdf_password:
+                self._passwords[job_id] = pdf_password
+            self._db.execute(
+                "INSERT INTO jobs (id, status, priority, concessionaria, uf, callback_url, payload, needs_password, "
+                "created_at) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, priority, concessionaria, uf, callback_url, payload, int(bool(pdf_password)), time.time()),
+            )
+        return job_id
+
+    def password(self, job_id: str) -> str | None:
+        """Senha do PDF do job (só em memória; None se o job não tem senha)."""
+        with self._lock:
+            return self._passwords.get(job_id)
+
+    def claim(self) -> sqlite3.Row | None:
+        """Pega o próximo job da fila (maior prioridade, mais antigo) e o marca como running."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE status='queued' ORDER BY priority DESC, created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status='running', attempts=attempts+1, started_at=? WHERE id=?",
+                        (time.time(), row["id"]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return row
+
+    def finish(self, job_id: str, *, result: Any = None, error: str | None = None, error_status: int | None = None) -> None:
+        with self._lock:
+            self._passwords.pop(job_id, None)
+            self._db.execute(
+                "UPDATE jobs SET status=?, result=?, error=?, error_status=?, payload=NULL, "
+                "finished_at=? WHERE id=?",
+                (
+                    "error" if error is not None else "done",
+                    json.dumps(result, ensure_ascii=False) if error is None else None,
+                    error,
+                    error_status,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def set_callback_status(self, job_id: str, status: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE jobs SET callback_status=? WHERE id=?", (status, job_id))
+
+    def get(self, job_id: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, priority, concessionaria, uf, callback_url, result, error, error_status, "
+                "attempts, callback_status, created_at, started_at, finished_at FROM jobs WHERE id=?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        out = dict(row)
+        out["result"] = json.loads(out["result"]) if out["result"] is not None else None
+        return out
+
+    def purge(self, older_than_s: float) -> int:
+        """Remove jobs terminados há mais de older_than_s segundos."""
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?",
+                (time.time() - older_than_s,),
+            ).rowcount
+
+    def counts(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class JobError(Exception):
+    """Falha de um job com o status HTTP equivalente (ex: 400 imagem inválida, 504 timeout)."""
+
+    def __init__(self, message: str, status: int = 500):
+        super().__init__(message)
+        self.status = status
+
+
+def check_callback_url(url: str, allowed_hosts: Collection[str] = ()) -> str | None:
+    """
+    Valida o destino de um callback (ValueError se recusado): http(s) e, com allowed_hosts,
+    só esses hosts; sem allowlist, só hosts cujos endereços resolvidos são todos públicos
+    (nada de loopback, rede privada, link-local/metadata de nuvem etc.).
+
+    Devolve o endereço validado, em que a conexão deve ser feita (None com allowlist: o host
+    é confiável e resolve normalmente).
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("callback_url deve ser uma URL http(s)")
+    host = parts.hostname.lower()
+    if allowed_hosts:
+        if host not in {h.lower() for h in allowed_hosts}:
+            raise ValueError(f"host do callback_url fora da allowlist: {host}")
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"host do callback_url não resolve: {host}") from e
+    for info in infos:
+        addr = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if isinstance(addr, ipaddress.IPv6Address) and addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+        if not addr.is_global or addr.is_multicast:
+            raise ValueError(f"callback_url aponta para endereço não público: {host} ({addr})")
+    return infos[0][4][0]
+
+
+class JobRunner:
+    """
+    Loops locais que drenam o JobStore: cada job roda handler(job) e, se houver callback_url,
+    o resultado é enviado por POST JSON (com algumas tentativas e backoff). O destino é
+    revalidado (check_callback_url) a cada envio e a conexão vai ao endereço validado (sem
+    segunda resolução DNS). Redirects não são seguidos.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        handler: Callable[[sqlite3.Row], Awaitable[Any]],
+        *,
+        workers: int = 1,
+        callback_timeout_s: float = 10.0,
+        callback_attempts: int = 3,
+        callback_allowed_hosts: Collection[str] = (),
+        retention_s: float = 72 * 3600,
+        poll_s: float = 1.0,
+    ):
+        self.store = store
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.callback_timeout_s = callback_timeout_s
+        self.callback_attempts = max(1, callback_attempts)
+        self.callback_allowed_hosts = tuple(callback_allowed_hosts)
+        self.retention_s = retention_s
+        self.poll_s = poll_s
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._callbacks: set[asyncio.Task] = set()
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        recovered = self.store.recover()
+        if recovered:
+            log(f"[jobs] {recovered} jobs interrompidos voltaram para a fila")
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._loop(i), name=f"jobs-{i}") for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """Acorda os loops após um submit (sem esperar o próximo poll)."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self, index: int) -> None:
+        last_purge = 0.0
+        while True:
+            job = await asyncio.to_thread(self.store.claim)
+            if job is None:
+                if index == 0 and time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    await asyncio.to_thread(self.store.purge, self.retention_s)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: sqlite3.Row) -> None:
+        job_id = job["id"]
+        t0 = time.perf_counter()
+        try:
+            result = await self.handler(job)
+        except asyncio.CancelledError:
+            # Desligamento: o job continua como running e volta para a fila no próximo boot
+            raise
+        except Exception as e:
+            status = e.status if isinstance(e, JobError) else 500
+            await asyncio.to_thread(self.store.finish, job_id, error=str(e) or type(e).__name__, error_status=status)
+            self.failed += 1
+            log(f"[jobs] {job_id} erro ({status}): {e}")
+            body = {"job_id": job_id, "status": "error", "error": str(e), "error_status": status}
+        else:
+            await asyncio.to_thread(self.store.finish, job_id, result=result)
+            self.completed += 1
+            log(f"[jobs] {job_id} concluído em {(time.perf_counter() - t0) * 1000:.0f}ms")
+            body = {"job_id": job_id, "status": "done", "result": result}
+        if job["callback_url"]:
+            # Callback fora do loop de jobs: um endpoint lento não segura a fila
+            task = asyncio.create_task(self._callback(job_id, job["callback_url"], body))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    async def _callback(self, job_id: str, url: str, body: dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        status = "failed"
+        for attempt in range(self.callback_attempts):
+            try:
+                code = await asyncio.to_thread(self._post, url, data)
+                status = f"delivered ({code})"
+                break
+            except ValueError as e:
+                # Destino recusado (passou a resolver para endereço não público): não insiste
+                log(f"[jobs] callback {job_id} recusado: {e}")
+                status = "refused"
+                break
+            except Exception as e:
+                log(f"[jobs] callback {job_id} falhou (tentativa {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        await asyncio.to_thread(self.store.set_callback_status, job_id, status)
+
+    def _post(self, url: str, data: bytes) -> int:
+        address = check_callback_url(url, self.callback_allowed_hosts)
+        parts = urllib.parse.urlsplit(url)
+        conn_cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        # Host, SNI e verificação do certificado continuam com o nome do URL
+        conn = conn_cls(parts.hostname, parts.port, timeout=self.callback_timeout_s)
+        if address is not None:
+            # Conecta no IP que check_callback_url validou: um DNS que mude de resposta entre a
+            # checagem e a conexão (DNS rebinding) não leva o POST a um endereço interno
+            conn._create_connection = lambda addr, timeout, source: socket.create_connection(
+                (address, addr[1]), timeout, source
+            )
+        try:
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            conn.request("POST", path, body=data, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            # Sem seguir redirects: o destino novo não passou por check_callback_url
+            if resp.status >= 300:
+                raise OSError(f"HTTP {resp.status} {resp.reason}")
+            return resp.status
+        finally:
+            conn.close()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "completed": self.completed,
+            "failed": self.failed,
+            "by_status": self.store.counts(),
+        }
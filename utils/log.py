@@ -0,0 +1,6 @@
+from __future__ import annotations
+
+
+def log(msg: str) -> None:
+    """Log do serviço: stdout sem buffer (as linhas já trazem o prefixo [etapa])."""
+    print(msg, flush=True)
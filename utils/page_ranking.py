@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from typing import Any
+
+from utils.text_layer import Cell, contains_label, find_consumption, normalize
+
+# Tipos de página escolhidos: a principal (dados do cliente + contrato, usada também pela
+# imagem completa) e a do histórico de consumo
+PAGE_KINDS = ("customer", "consumption")
+
+
+def text_page_scores(rows: list[list[Cell]], rules: dict[str, Any]) -> dict[str, float]:
+    """
+    Densidade de conteúdo útil de uma página pela camada de texto: rótulos de campos do
+    contrato encontrados e pares mês/consumo do histórico.
+    """
+    text = "\n".join(" ".join(cell.norm for cell in row) for row in rows)
+    labels = {normalize(label) for rule in rules["fields"].values() for label in rule.get("labels", [])}
+    return {
+        "customer": float(sum(contains_label(text, label) for label in labels)),
+        "consumption": float(len(find_consumption(rows))),
+    }
+
+
+def pick_pages(
+    pages: int,
+    detector: list[tuple[float, float]] | None = None,
+    text: list[dict[str, float]] | None = None,
+) -> dict[str, int]:
+    """
+    Melhor página de cada tipo. A confiança do detector (cliente, consumo) decide; empate ou
+    nenhuma detecção cai para a densidade de texto; sem nenhum sinal fica a primeira página.
+    """
+    picked: dict[str, int] = {}
+    for i, kind in enumerate(PAGE_KINDS):
+        def score(p: int) -> tuple[float, float, int]:
+            return (detector[p][i] if detector else 0.0, text[p][kind] if text else 0.0, -p)
+
+        picked[kind] = max(range(pages), key=score)
+    return picked
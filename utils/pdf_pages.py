@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import math
+
+from PIL import Image
+
+try:
+    import pymupdf
+
+    _HAS_PYMUPDF = True
+except ImportError:
+    pymupdf = None
+    _HAS_PYMUPDF = False
+
+# Pontos por polegada do sistema de coordenadas do PDF (zoom 1.0 = 72 DPI)
+PDF_POINTS_PER_INCH = 72.0
+
+
+class PdfError(ValueError):
+    """PDF ilegível, protegido por senha ou sem páginas."""
+
+
+def is_pdf(raw: bytes) -> bool:
+    # A especificação permite lixo antes do cabeçalho dentro do primeiro KB
+    return b"%PDF-" in raw[:1024]
+
+
+def zoom_for_max_pixels(width_pt: float, height_pt: float, max_pixels: int, max_dpi: float) -> float:
+    """
+    Zoom que faz a página renderizada caber em max_pixels (sem passar de max_dpi). A margem de
+    0.5% absorve o arredondamento do pixmap, para o resize do _load_image não ser acionado à toa.
+    """
+    area = max(1.0, width_pt * height_pt)
+    zoom = math.sqrt(max_pixels / area) * 0.995
+    return min(zoom, max_dpi / PDF_POINTS_PER_INCH)
+
+
+class PdfPages:
+    """
+    PDF aberto direto dos bytes, com páginas renderizadas sob demanda.
+
+    render() desenha uma página no DPI que cabe em max_pixels e devolve a imagem PIL a partir
+    das amostras RGB do pixmap, sem o encode/decode PNG intermediário.
+    """
+
+    def __init__(self, raw: bytes, password: str | None = None):
+        if not _HAS_PYMUPDF:
+            raise PdfError("suporte a PDF indisponível (pymupdf não instalado)")
+        try:
+            self._doc = pymupdf.open(stream=raw, filetype="pdf")
+        except Exception as e:
+            raise PdfError(f"PDF inválido: {e}") from None
+        if self._doc.needs_pass:
+            if not password:
+                self.close()
+                raise PdfError("PDF protegido por senha: informe password")
+            if not self._doc.authenticate(password):
+                self.close()
+                raise PdfError("senha incorreta para o PDF")
+        if self._doc.page_count == 0:
+            self.close()
+            raise PdfError("PDF sem páginas")
+
+    def __len__(self) -> int:
+        return self._doc.page_count
+
+    def __enter__(self) -> PdfPages:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def page_size(self, index: int) -> tuple[float, float]:
+        """Largura e altura da página em pontos (já considerando a rotação)."""
+        rect = self._doc.load_page(index).rect
+        return rect.width, rect.height
+
+    def words(self, index: int) -> list[tuple[float, float, float, float, str]]:
+        """Palavras da camada de texto da página: (x0, y0, x1, y1, texto), em pontos."""
+        return [tuple(w[:5]) for w in self._doc.load_page(index).get_text("words")]
+
+    def render(self, index: int, max_pixels: int, max_dpi: float = 300) -> Image.Image:
+        page = self._doc.load_page(index)
+        zoom = zoom_for_max_pixels(page.rect.width, page.rect.height, max_pixels, max_dpi)
+        pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csRGB, alpha=False)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    def render_clip(
+        self, index: int, rect: tuple[float, float, float, float], max_pixels: int, max_dpi: float = 600
+    ) -> Image.Image:
+        """
+        Só a região rect (x0, y0, x1, y1 em pontos, como page_size) da página, no DPI que faz
+        a região caber em max_pixels (até max_dpi). O custo é proporcional à área desenhada.
+        """
+        page = self._doc.load_page(index)
+        clip = pymupdf.Rect(rect) & page.rect
+        if clip.is_empty:
+            raise PdfError(f"região fora da página: {rect}")
+        # clip usa as mesmas coordenadas de page.rect (já com a rotação), como page_size
+        zoom = zoom_for_max_pixels(clip.width, clip.height, max_pixels, max_dpi)
+        pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), clip=clip, colorspace=pymupdf.csRGB, alpha=False)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    def render_thumbnail(self, index: int, max_side: int) -> Image.Image:
+        """Miniatura com o lado maior em max_side pixels (ranking de páginas)."""
+        page = self._doc.load_page(index)
+        zoom = max_side / max(1.0, page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csRGB, alpha=False)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    def close(self) -> None:
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
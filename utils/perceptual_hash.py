@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import io
+import math
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+
+def dhash(img: Image.Image, hash_size: int = 16) -> int:
+    """Difference hash: hash_size² bits, 1 quando o pixel é mais claro que o vizinho à direita."""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    px = list(small.getdata())
+    bits = 0
+    for y in range(hash_size):
+        row = px[y * (hash_size + 1):(y + 1) * (hash_size + 1)]
+        for x in range(hash_size):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return bits
+
+
+_COS: dict[tuple[int, int], list[list[float]]] = {}
+
+
+def _cos_table(n: int, k: int) -> list[list[float]]:
+    table = _COS.get((n, k))
+    if table is None:
+        table = _COS[(n, k)] = [
+            [math.cos(math.pi * u * (2 * i + 1) / (2 * n)) for i in range(n)] for u in range(k)
+        ]
+    return table
+
+
+def phash(img: Image.Image, hash_size: int = 16, highfreq_factor: int = 4) -> int:
+    """
+    Perceptual hash: DCT 2D da imagem em cinza (hash_size*highfreq_factor)², mantendo só as
+    hash_size² frequências mais baixas; 1 quando o coeficiente está acima da mediana.
+    """
+    n = hash_size * highfreq_factor
+    small = img.convert("L").resize((n, n), Image.Resampling.LANCZOS)
+    px = list(small.getdata())
+    cos = _cos_table(n, hash_size)
+    # DCT separável: linhas (n x hash_size) e depois colunas (hash_size x hash_size)
+    rows = [
+        [sum(c * v for c, v in zip(cos[u], px[y * n:(y + 1) * n])) for u in range(hash_size)]
+        for y in range(n)
+    ]
+    coefs = [
+        sum(cos[v][y] * rows[y][u] for y in range(n))
+        for v in range(hash_size)
+        for u in range(hash_size)
+    ]
+    # O coeficiente DC (brilho médio) distorce a mediana
+    median = sorted(coefs[1:])[len(coefs[1:]) // 2]
+    bits = 0
+    for c in coefs:
+        bits = (bits << 1) | (c > median)
+    return bits
+
+
+def detail_signature(img: Image.Image, width: int = 640) -> bytes:
+    """
+    Página em cinza com width px de largura e contraste normalizado (percentis 1/99), em PNG
+    (~60KB). Os hashes de 256 bits não separam faturas diferentes do mesmo layout; isto sim.
+    """
+    height = max(1, round(width * img.height / img.width))
+    gray = ImageOps.autocontrast(img.convert("L").resize((width, height), Image.Resampling.BOX), cutoff=1)
+    buf = io.BytesIO()
+    gray.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def detail_difference(a: bytes, b: bytes) -> int:
+    """
+    Maior diferença (0-255) entre duas assinaturas de detalhe, tolerando deslocamento de 1 px:
+    cada pixel é comparado com o mínimo/máximo da vizinhança 3x3 do outro lado. Re-encodes e
+    reescalas ficam abaixo de ~70; um dígito ou nome diferente passa de 100.
+    """
+    ga, gb = Image.open(io.BytesIO(a)), Image.open(io.BytesIO(b))
+    if gb.size != ga.size:
+        gb = gb.resize(ga.size, Image.Resampling.BILINEAR)
+
+    def one_way(x: Image.Image, y: Image.Image) -> Image.Image:
+        # subtract satura em 0: só sobra o quanto x sai da faixa [mín, máx] local de y
+        above = ImageChops.subtract(x, y.filter(ImageFilter.MaxFilter(3)))
+        below = ImageChops.subtract(y.filter(ImageFilter.MinFilter(3)), x)
+        return ImageChops.lighter(above, below)
+
+    return ImageChops.lighter(one_way(ga, gb), one_way(gb, ga)).getextrema()[1]
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Árvore BK sobre a distância de Hamming: busca por raio sem comparar com todos os hashes."""
+
+    def __init__(self) -> None:
+        self._root: list | None = None  # [hash, valores, {distância: filho}]
+        self.size = 0
+
+    def add(self, h: int, value: Any) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [h, [value], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [value], {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> list[tuple[int, Any]]:
+        """(distância, valor) de todos os hashes a no máximo radius bits de h."""
+        out: list[tuple[int, Any]] = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                out.extend((d, v) for v in node[1])
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        return out
+
+
+class NearDuplicateIndex:
+    """
+    Índice de imagens quase idênticas (re-encode, JPEG de outra qualidade, screenshot).
+
+    Candidatos saem da árvore BK do dHash; o pHash filtra (as duas distâncias precisam ficar
+    dentro de max_distance). Os hashes sozinhos NÃO identificam a fatura (faturas diferentes do
+    mesmo layout ficam a poucos bits), então find() só devolve um candidato confirmado por
+    verify, tipicamente detail_difference sobre a assinatura guardada com add(..., detail).
+    Os hashes ficam separados por escopo (concessionaria, uf, modelo, prompts): uma extração só
+    é reaproveitada nas mesmas condições em que foi feita. Limitado a max_entries; ao estourar,
+    descarta a metade mais antiga e reconstrói as árvores.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int = 2_000):
+        self.max_distance = max(0, max_distance)
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[Hashable, tuple[Hashable, int, int, bytes | None]] = OrderedDict()
+        self._trees: dict[Hashable, BKTree] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def add(self, scope: Hashable, hashes: tuple[int, int], value: Hashable, detail: bytes | None = None) -> None:
+        d, p = hashes
+        with self._lock:
+            if value in self._entries:
+                return
+            self._entries[value] = (scope, d, p, detail)
+            self._trees.setdefault(scope, BKTree()).add(d, (p, value))
+            if len(self._entries) > self.max_entries:
+                for _ in range(len(self._entries) // 2):
+                    self._entries.popitem(last=False)
+                self._rebuild()
+
+    def detail(self, value: Hashable) -> bytes | None:
+        """Assinatura de detalhe guardada com o valor (None se não houver)."""
+        with self._lock:
+            entry = self._entries.get(value)
+            return entry[3] if entry is not None else None
+
+    def _rebuild(self) -> None:
+        self._trees = {}
+        for value, (scope, d, p, _) in self._entries.items():
+            self._trees.setdefault(scope, BKTree()).add(d, (p, value))
+
+    def find(
+        self, scope: Hashable, hashes: tuple[int, int], verify: Callable[[Hashable], bool] | None = None
+    ) -> tuple[Hashable, int] | None:
+        """
+        Valor do match mais próximo aceito por verify e a sua distância (maior entre dHash e
+        pHash), ou None. verify roda fora do lock, do candidato mais próximo ao mais distante.
+        """
+        d, p = hashes
+        with self._lock:
+            tree = self._trees.get(scope)
+            candidates = []
+            for dist_d, (cand_p, value) in tree.search(d, self.max_distance) if tree else []:
+                dist = max(dist_d, hamming(p, cand_p))
+                if dist <= self.max_distance:
+                    candidates.append((dist, value))
+        candidates.sort(key=lambda c: c[0])
+        best = None
+        rejected = 0
+        for dist, value in candidates:
+            if verify is None or verify(value):
+                best = (value, dist)
+                break
+            rejected += 1
+        with self._lock:
+            self.rejected += rejected
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def discard(self, value: Hashable) -> None:
+        """Remove um valor que deixou de existir (ex: evicção do cache de resultados)."""
+        with self._lock:
+            if self._entries.pop(value, None) is not None:
+                self._rebuild()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "scopes": len(self._trees),
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+            }
+
+
+def image_hashes(img: Image.Image, hash_size: int = 16) -> tuple[int, int]:
+    """(dHash, pHash) de uma imagem, na ordem esperada pelo NearDuplicateIndex."""
+    return dhash(img, hash_size), phash(img, hash_size)
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import math
+
+from PIL import Image
+
+
+def fit_pixels(img: Image.Image, max_pixels: int) -> Image.Image:
+    """
+    img reduzida para caber em max_pixels (a própria img se já cabe). Redução inteira por
+    blocos seguida de BICUBIC, como no decode.
+    """
+    w, h = img.size
+    if w * h <= max_pixels:
+        return img
+    scale = math.sqrt(max_pixels / float(w * h))
+    size = max(1, int(w * scale)), max(1, int(h * scale))
+    return img.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def vision_tokens(width: int, height: int, patch_px: int = 28) -> int:
+    """
+    Tokens de imagem que o VLM gera para width x height. No Qwen2.5-VL cada token cobre
+    28x28 px (patch 14 + merge 2x2), com os lados arredondados para múltiplos de 28.
+    """
+    cols = max(1, round(width / patch_px))
+    rows = max(1, round(height / patch_px))
+    return cols * rows
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+
+class ResultCache:
+    """
+    Cache de extrações por conteúdo: LRU em memória + camada em disco, ambos limitados por bytes.
+
+    A chave é um hex digest (sha256 dos bytes enviados + concessionaria + uf + modelo + prompts);
+    o valor é o payload JSON da resposta. Hits no disco são promovidos para a memória. No disco,
+    cada entrada é um arquivo <chave>.json e a evicção remove os menos acessados (mtime).
+    """
+
+    def __init__(self, max_memory_bytes: int, disk_dir: str | None = None, max_disk_bytes: int = 0):
+        self.max_memory_bytes = max(0, max_memory_bytes)
+        self.max_disk_bytes = max(0, max_disk_bytes)
+        self.disk_dir = Path(disk_dir) if disk_dir and self.max_disk_bytes > 0 else None
+        self._memory: OrderedDict[str, tuple[bytes, int]] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir is not None:
+            self._scan_disk()
+
+    def _scan_disk(self) -> None:
+        """Reconstrói o índice do disco (ordem de acesso = mtime) ao subir o processo."""
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for p in self.disk_dir.glob("*.json"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, p.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.json"
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(entry[0])
+            if self.disk_dir is None or key not in self._disk:
+                self.misses += 1
+                return None
+            try:
+                data = self._path(key).read_bytes()
+                os.utime(self._path(key))
+            except OSError:
+                # Arquivo removido por fora: esquece a entrada
+                self._disk_bytes -= self._disk.pop(key)
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+            self.disk_hits += 1
+            self._put_memory(key, data)
+            return json.loads(data)
+
+    def put(self, key: str, payload: dict[str, Any]) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._put_memory(key, data)
+            if self.disk_dir is not None and len(data) <= self.max_disk_bytes:
+                self._put_disk(key, data)
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[1]
+        while self._memory and self._memory_bytes + len(data) > self.max_memory_bytes:
+            _, (_, freed) = self._memory.popitem(last=False)
+            self._memory_bytes -= freed
+            self.evictions += 1
+        self._memory[key] = (data, len(data))
+        self._memory_bytes += len(data)
+
+    def _put_disk(self, key: str, data: bytes) -> None:
+        # Escrita atômica: um leitor nunca vê um JSON pela metade
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        old = self._disk.pop(key, None)
+        if old is not None:
+            self._disk_bytes -= old
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes if self.disk_dir is not None else 0,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesce chamadas idênticas em andamento: a primeira inicia o trabalho numa task e as
+    seguintes com a mesma chave aguardam a mesma task.
+
+    Cada chamador espera via asyncio.shield, então o cancelamento de um deles (cliente que
+    desconectou) não afeta os demais. Quando o último desiste, a task é cancelada se
+    cancel_orphans=True; caso contrário termina sozinha (útil quando o resultado vai para um
+    cache e o retry do cliente ainda pode aproveitá-lo).
+    """
+
+    def __init__(self, *, cancel_orphans: bool = True):
+        self.cancel_orphans = cancel_orphans
+        self._flights: dict[Hashable, _Flight] = {}
+        self.started = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Resultado de fn() (ou da chamada idêntica em andamento) e se ele foi compartilhado."""
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda t, f=flight: self._done(key, f, t))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done() and self.cancel_orphans:
+                # Ninguém mais espera: libera a chave já (um novo chamador começa do zero)
+                self._forget(key, flight)
+                flight.task.cancel()
+                self.cancelled += 1
+
+    def _done(self, key: Hashable, flight: _Flight, task: asyncio.Task) -> None:
+        self._forget(key, flight)
+        # Marca a exceção como consumida mesmo se todos os chamadores já tiverem desistido
+        if not task.cancelled():
+            task.exception()
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "shared": self.shared,
+            "cancelled": self.cancelled,
+        }
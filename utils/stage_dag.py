@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+
+@dataclass
+class Stage:
+    """
+    Etapa assíncrona do pipeline.
+
+    fn recebe um dict {dependência: StageResult} e roda assim que todas as dependências
+    terminam (com sucesso ou não); cabe à etapa decidir o que fazer com uma dependência falha.
+    fn=None marca a etapa como pulada (ex: recorte não detectado).
+    """
+
+    name: str
+    fn: Callable[[dict[str, "StageResult"]], Awaitable[Any]] | None
+    deps: tuple[str, ...] = ()
+    timeout_s: float | None = None
+
+
+@dataclass
+class StageResult:
+    name: str
+    status: str = "pending"  # ok | error | timeout | skipped
+    value: Any = None
+    error: BaseException | None = field(default=None, repr=False)
+    start_ms: float = 0.0  # relativo ao início do DAG
+    elapsed_ms: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "ok"
+
+
+async def run_dag(stages: list[Stage]) -> dict[str, StageResult]:
+    """
+    Executa as etapas respeitando as dependências: etapas independentes rodam em paralelo.
+    Cada etapa tem timeout próprio e falhas ficam isoladas no seu StageResult.
+    """
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        missing = [d for d in s.deps if d not in by_name]
+        if missing:
+            raise ValueError(f"etapa {s.name} depende de etapas inexistentes: {missing}")
+
+    t0 = time.perf_counter()
+    results = {s.name: StageResult(s.name) for s in stages}
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def _run(stage: Stage) -> None:
+        if stage.deps:
+            await asyncio.gather(*(tasks[d] for d in stage.deps))
+        res = results[stage.name]
+        if stage.fn is None:
+            res.status = "skipped"
+            return
+        started = time.perf_counter()
+        res.start_ms = (started - t0) * 1000
+        try:
+            res.value = await asyncio.wait_for(
+                stage.fn({d: results[d] for d in stage.deps}), timeout=stage.timeout_s
+            )
+            res.status = "ok"
+        except asyncio.TimeoutError as e:
+            res.status, res.error = "timeout", e
+        except Exception as e:
+            res.status, res.error = "error", e
+        finally:
+            res.elapsed_ms = (time.perf_counter() - started) * 1000
+
+    # Ordem topológica só para criar as tasks; a espera por dependências é feita em _run
+    pending = list(stages)
+    while pending:
+        ready = [s for s in pending if all(d in tasks for d in s.deps)]
+        if not ready:
+            raise ValueError(f"dependência circular entre etapas: {[s.name for s in pending]}")
+        for s in ready:
+            tasks[s.name] = asyncio.create_task(_run(s), name=f"stage-{s.name}")
+            pending.remove(s)
+
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for t in tasks.values():
+            t.cancel()
+    return results
+
+
+def server_timing(results: dict[str, StageResult]) -> str:
+    """Valor do header Server-Timing com a duração de cada etapa."""
+    return ", ".join(
+        f'{r.name};dur={r.elapsed_ms:.1f};desc="{r.status}"' for r in results.values()
+    )
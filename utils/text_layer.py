@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+# (x0, y0, x1, y1, texto) em pontos, como PdfPages.words
+Word = tuple[float, float, float, float, str]
+
+_MONTHS = {
+    "JAN": "01", "FEV": "02", "MAR": "03", "ABR": "04", "MAI": "05", "JUN": "06",
+    "JUL": "07", "AGO": "08", "SET": "09", "OUT": "10", "NOV": "11", "DEZ": "12",
+}
+_MONTH_RE = "|".join(_MONTHS)
+
+
+def normalize(text: str) -> str:
+    """Maiúsculas sem acento, caractere a caractere (mesmo comprimento do original)."""
+    out = []
+    for ch in text:
+        base = "".join(c for c in unicodedata.normalize("NFKD", ch) if not unicodedata.combining(c))
+        out.append((base or ch)[:1].upper() or ch)
+    return "".join(out)
+
+
+@dataclass
+class Cell:
+    """Trecho contínuo de uma linha visual (palavras separadas por no máximo um espaço)."""
+
+    text: str
+    x0: float
+    y0: float
+    x1: float
+    y1: float
+    norm: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.norm = normalize(self.text)
+
+
+def layout_rows(words: Iterable[Word]) -> list[list[Cell]]:
+    """
+    Agrupa as palavras em linhas visuais (centro vertical próximo) e, dentro de cada linha, em
+    células: um espaço maior que a altura da fonte separa rótulo e valor em colunas diferentes.
+    """
+    ws = sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0]))
+    rows: list[list[Word]] = []
+    for w in ws:
+        yc, h = (w[1] + w[3]) / 2, w[3] - w[1]
+        if rows:
+            last = rows[-1]
+            lyc = sum((x[1] + x[3]) / 2 for x in last) / len(last)
+            if abs(yc - lyc) <= 0.5 * max(h, last[0][3] - last[0][1]):
+                last.append(w)
+                continue
+        rows.append([w])
+
+    out: list[list[Cell]] = []
+    for row in rows:
+        row.sort(key=lambda w: w[0])
+        cells: list[Cell] = []
+        for x0, y0, x1, y1, text in row:
+            prev = cells[-1] if cells else None
+            if prev is not None and x0 - prev.x1 <= (y1 - y0):
+                prev.text += " " + text
+                prev.norm = normalize(prev.text)
+                prev.x1, prev.y0, prev.y1 = x1, min(prev.y0, y0), max(prev.y1, y1)
+            else:
+                cells.append(Cell(text, x0, y0, x1, y1))
+        out.append(cells)
+    return out
+
+
+def _parse_code(s: str) -> str | None:
+    m = re.search(r"(?<![\w/])(\d[\d./-]*\d)(?![\w/])", s)
+    if m and sum(ch.isdigit() for ch in m.group(1)) >= 4:
+        return m.group(1)
+    return None
+
+
+def _parse_date(s: str) -> str | None:
+    m = re.search(r"(?<!\d)(\d{2}/\d{2}/\d{4})(?!\d)", s)
+    return m.group(1) if m else None
+
+
+def _parse_month(s: str) -> str | None:
+    n = normalize(s)
+    m = re.search(rf"(?<![A-Z])({_MONTH_RE})\s*/?\s*(\d{{4}}|\d{{2}})(?!\d)", n)
+    if m:
+        year = m.group(2) if len(m.group(2)) == 4 else f"20{m.group(2)}"
+        return f"{_MONTHS[m.group(1)]}/{year}"
+    m = re.search(r"(?<![\d/])(0[1-9]|1[0-2])/(\d{4})(?!\d)", n)
+    return f"{m.group(1)}/{m.group(2)}" if m else None
+
+
+def _parse_money(s: str) -> float | None:
+    m = re.search(r"(?<![\d,])(\d{1,3}(?:\.\d{3})*,\d{2})(?![\d,])", s)
+    return float(m.group(1).replace(".", "").replace(",", ".")) if m else None
+
+
+def _parse_percent(s: str) -> float | None:
+    # "18%", "18,00 %" ou a célula inteira com o número (coluna "Alíquota ICMS" de uma tabela)
+    m = re.search(r"(\d{1,2}(?:[,.]\d{1,2})?)\s*%", s) or re.fullmatch(r"\s*(\d{1,2}(?:[,.]\d{1,2})?)\s*", s)
+    if not m:
+        return None
+    value = float(m.group(1).replace(",", "."))
+    return value or None
+
+
+def _parse_voltage(s: str) -> str | None:
+    m = re.search(r"(?<![\d/])(\d{2,3}(?:/\d{2,3})?)\s*V\b", normalize(s))
+    return f"{m.group(1)}V" if m else None
+
+
+def _parse_phase(s: str) -> str | None:
+    m = re.search(r"\b(MONOFASIC|BIFASIC|TRIFASIC)[OA]\b", normalize(s))
+    return f"{m.group(1)}O" if m else None
+
+
+def _parse_class(s: str) -> str | None:
+    m = re.search(r"\b(RESIDENCIAL|COMERCIAL|INDUSTRIAL|RURAL)\b", normalize(s))
+    return m.group(1) if m else None
+
+
+def _parse_cep(s: str) -> str | None:
+    m = re.search(r"(?<!\d)(\d{2}\.?\d{3}-?\d{3})(?!\d)", s)
+    return m.group(1) if m else None
+
+
+def _parse_text(s: str) -> str | None:
+    s = s.strip(" :-")
+    return s or None
+
+
+PARSERS: dict[str, Callable[[str], Any]] = {
+    "code": _parse_code,
+    "date": _parse_date,
+    "month": _parse_month,
+    "money": _parse_money,
+    "percent": _parse_percent,
+    "voltage": _parse_voltage,
+    "phase": _parse_phase,
+    "class": _parse_class,
+    "cep": _parse_cep,
+    "text": _parse_text,
+}
+
+
+def _label_pos(norm: str, label: str) -> int:
+    m = re.search(rf"(?<![A-Z0-9]){re.escape(label)}(?![A-Z0-9])", norm)
+    return m.end() if m else -1
+
+
+def contains_label(norm: str, label: str) -> bool:
+    """label (já normalizado) aparece como palavra(s) inteira(s) em norm."""
+    return _label_pos(norm, label) >= 0
+
+
+def _candidates(rows: list[list[Cell]], r: int, c: int, end: int) -> Iterable[str]:
+    """Onde o valor de um rótulo costuma estar: resto da célula, à direita, logo abaixo."""
+    cell = rows[r][c]
+    yield cell.text[end:]
+    for right in rows[r][c + 1:c + 3]:
+        yield right.text
+    for below in rows[r + 1:r + 3]:
+        for b in below:
+            if b.x0 < cell.x1 and b.x1 > cell.x0:
+                yield b.text
+
+
+def find_field(rows: list[list[Cell]], labels: list[str], parse: Callable[[str], Any]) -> tuple[Any, str] | None:
+    """Primeiro valor válido perto de um dos rótulos (na ordem dos rótulos) e o rótulo usado."""
+    for label in labels:
+        label = normalize(label)
+        for r, row in enumerate(rows):
+            for c, cell in enumerate(row):
+                end = _label_pos(cell.norm, label)
+                if end < 0:
+                    continue
+                for cand in _candidates(rows, r, c, end):
+                    value = parse(cand)
+                    if value is not None:
+                        return value, label
+    return None
+
+
+def find_consumption(rows: list[list[Cell]], max_items: int = 13) -> list[dict[str, Any]]:
+    """Pares mês/consumo na mesma linha ("OUT/25 350", "10/2025 350"), na ordem de leitura."""
+    pair = re.compile(
+        rf"(?<![A-Z])({_MONTH_RE})\s*/?\s*(\d{{4}}|\d{{2}})\s+(\d{{1,6}})(?![\d,.])"
+        rf"|(?<![\d/])(0[1-9]|1[0-2])/(\d{{4}})\s+(\d{{1,6}})(?![\d,./])"
+    )
+    out: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    for row in rows:
+        line = normalize(" ".join(cell.text for cell in row))
+        for m in pair.finditer(line):
+            if m.group(1):
+                year = m.group(2) if len(m.group(2)) == 4 else f"20{m.group(2)}"
+                mes_ano, kwh = f"{_MONTHS[m.group(1)]}/{year}", m.group(3)
+            else:
+                mes_ano, kwh = f"{m.group(4)}/{m.group(5)}", m.group(6)
+            if mes_ano not in seen:
+                seen.add(mes_ano)
+                out.append({"mes_ano": mes_ano, "consumo": int(kwh)})
+    return out[:max_items]
+
+
+def merge_rules(rules: dict[str, Any], concessionaria_key: str) -> dict[str, Any]:
+    """Regras default sobrepostas pelas da concessionária (campo a campo)."""
+    base = rules.get("default", {})
+    own = rules.get(concessionaria_key) or rules.get(concessionaria_key.split("-")[0]) or {}
+    fields = {k: dict(v) for k, v in base.get("fields", {}).items()}
+    for k, v in own.get("fields", {}).items():
+        fields[k] = {**fields.get(k, {}), **v}
+    return {
+        "fields": fields,
+        "flags": {**base.get("flags", {}), **own.get("flags", {})},
+        "consumption": own.get("consumption", base.get("consumption", False)),
+        "constants": {**base.get("constants", {}), **own.get("constants", {})},
+    }
+
+
+@dataclass
+class TextExtraction:
+    """Campos resolvidos pela camada de texto e, para cada um, de onde vieram."""
+
+    values: dict[str, Any] = field(default_factory=dict)
+    evidence: dict[str, str] = field(default_factory=dict)
+    # Campos fixados por regra da concessionária (ex: conta_contrato sempre null), não lidos
+    constants: set[str] = field(default_factory=set)
+    words: int = 0
+
+
+def extract_fields(rows: list[list[Cell]], rules: dict[str, Any], words: int = 0) -> TextExtraction:
+    out = TextExtraction(words=words)
+    for name, rule in rules["fields"].items():
+        parse = PARSERS.get(rule.get("type", "text"))
+        if parse is None or not rule.get("labels"):
+            continue
+        found = find_field(rows, rule["labels"], parse)
+        if found is not None:
+            out.values[name], label = found
+            out.evidence[name] = f"rótulo {label}"
+
+    text = "\n".join(" ".join(cell.norm for cell in row) for row in rows)
+    for name, rule in rules["flags"].items():
+        hit = next((k for k in rule.get("keywords", []) if _label_pos(text, normalize(k)) >= 0), None)
+        if hit is None:
+            out.values[name] = False
+            out.evidence[name] = "nenhuma palavra-chave"
+        elif rule.get("present", True) is not None:
+            out.values[name] = bool(rule.get("present", True))
+            out.evidence[name] = f"palavra-chave {hit}"
+    # Sem seção de débitos não há valores em aberto; com ela, a lista fica para o modelo
+    if out.values.get("faturas_venc") is False:
+        out.values["valores_em_aberto"] = []
+        out.evidence["valores_em_aberto"] = out.evidence["faturas_venc"]
+
+    if rules.get("consumption"):
+        consumo = find_consumption(rows)
+        # Poucos pares soltos costumam ser datas/valores de outras tabelas, não o histórico
+        if len(consumo) >= 3:
+            out.values["consumo_lista"] = consumo
+            out.evidence["consumo_lista"] = f"{len(consumo)} pares mês/consumo"
+
+    # Regras "sempre X" dos prompts valem mais que qualquer rótulo encontrado
+    for name, value in rules["constants"].items():
+        out.values[name] = value
+        out.evidence[name] = "constante da concessionária"
+        out.constants.add(name)
+    return out